@@ -1,7 +1,11 @@
 import sys
 from typing import Callable, Iterable, Iterator, Mapping, TypeVar
 
-__all__ = ["itertools_pairwise", "importlib_metadata_package_distributions"]
+__all__ = [
+    "itertools_batched",
+    "itertools_pairwise",
+    "importlib_metadata_package_distributions",
+]
 
 T = TypeVar("T")
 
@@ -26,6 +30,28 @@ def _itertools_pairwise() -> Callable[[Iterable[T]], Iterator[tuple[T, T]]]:
 itertools_pairwise = _itertools_pairwise()
 
 
+def _itertools_batched() -> Callable[[Iterable[T], int], Iterator[tuple[T, ...]]]:
+    if sys.version_info[:2] >= (3, 12):
+        from itertools import batched
+    else:
+        from itertools import islice
+        from typing import Iterable, Iterator
+
+        # https://docs.python.org/3/library/itertools.html#itertools.batched
+        def batched(iterable: Iterable[T], n: int) -> Iterator[tuple[T, ...]]:
+            # batched('ABCDEFG', 3) --> ABC DEF G
+            if n < 1:
+                raise ValueError("n must be at least one")
+            it = iter(iterable)
+            while batch := tuple(islice(it, n)):
+                yield batch
+
+    return batched
+
+
+itertools_batched = _itertools_batched()
+
+
 def _importlib_metadata_package_distributions() -> (
     Callable[[], Mapping[str, list[str]]]
 ):
@@ -1,4 +1,5 @@
-from typing import cast
+import json
+from typing import AsyncIterator, cast
 
 from ragna.core import RagnaException, Source
 
@@ -9,6 +10,8 @@ class AnthropicApiAssistant(ApiAssistant):
     _API_KEY_ENV_VAR = "ANTHROPIC_API_KEY"
     _MODEL: str
     _CONTEXT_SIZE: int
+    # Anthropic doesn't publish the tokenizer of its models.
+    _TOKEN_COUNT_MARGIN = 1.1
 
     @classmethod
     def display_name(cls) -> str:
@@ -28,12 +31,20 @@ class AnthropicApiAssistant(ApiAssistant):
         instruction += "\n\n".join(source.content for source in sources)
         return f"{instruction}\n\nQuestion: {prompt}\n\nAssistant:"
 
+    def _render_prompt(self, prompt: str, sources: list[Source]) -> str:
+        return self._instructize_prompt(prompt, sources)
+
     async def _call_api(
         self, prompt: str, sources: list[Source], *, max_new_tokens: int
-    ) -> str:
-        # # See https://docs.anthropic.com/claude/reference/complete_post
-        response = await self._client.post(
+    ) -> AsyncIterator[str]:
+        # See https://docs.anthropic.com/claude/reference/complete_post
+        # and https://docs.anthropic.com/claude/reference/streaming
+        async for event, data in self._stream_sse(
+            "POST",
             "https://api.anthropic.com/v1/complete",
+            num_tokens=self._estimate_num_tokens(
+                prompt, sources, max_new_tokens=max_new_tokens
+            ),
             headers={
                 "accept": "application/json",
                 "anthropic-version": "2023-06-01",
@@ -45,13 +56,13 @@ class AnthropicApiAssistant(ApiAssistant):
                 "prompt": self._instructize_prompt(prompt, sources),
                 "max_tokens_to_sample": max_new_tokens,
                 "temperature": 0.0,
+                "stream": True,
             },
-        )
-        if response.is_error:
-            raise RagnaException(
-                status_code=response.status_code, response=response.json()
-            )
-        return cast(str, response.json()["completion"])
+        ):
+            if event == "completion":
+                yield cast(str, json.loads(data)["completion"])
+            elif event == "error":
+                raise RagnaException(response=json.loads(data))
 
 
 class ClaudeInstant(AnthropicApiAssistant):
@@ -1,33 +1,602 @@
+from __future__ import annotations
+
 import abc
+import asyncio
+import collections
+import contextlib
+import datetime
+import email.utils
+import functools
+import hashlib
+import json
+import math
 import os
+import random
+import sqlite3
+import statistics
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, AsyncContextManager, AsyncIterator, Optional
+
+import anyio
 
 import ragna
-from ragna.core import Assistant, EnvVarRequirement, Requirement, Source
+from ragna.core import (
+    Assistant,
+    EnvVarRequirement,
+    PackageRequirement,
+    RagnaException,
+    Requirement,
+    Source,
+)
+from ragna.core._http import HttpClientMixin
+
+from ._rate_limit import get_rate_limiter
+
+if TYPE_CHECKING:
+    import httpx
+    import tiktoken
+
+
+class ResponseCache:
+    """Persistent cache for responses of deterministic API calls.
+
+    The responses are stored in an SQLite database. If the total size of the cached
+    responses exceeds `max_size`, the least recently used ones are evicted.
+
+    Args:
+        path: Path of the SQLite database.
+        max_size: Maximum total size of the cached responses in bytes.
+    """
+
+    def __init__(self, path: Path, *, max_size: int) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key BLOB PRIMARY KEY, "
+            "value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "last_used REAL NOT NULL"
+            ")"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(*parts: Any) -> bytes:
+        return hashlib.sha256(
+            json.dumps(parts, sort_keys=True, separators=(",", ":")).encode()
+        ).digest()
+
+    def get(self, key: bytes) -> Optional[Any]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._db.execute(
+                "UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: bytes, value: Any) -> None:
+        serialized = json.dumps(value)
+        size = len(serialized.encode())
+        if size > self._max_size:
+            return
+
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, last_used) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, serialized, size, time.time()),
+                )
+                self._evict()
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            else:
+                self._db.execute("COMMIT")
+
+    def _evict(self) -> None:
+        (total_size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        excess = total_size - self._max_size
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in self._db.execute(
+            "SELECT key, size FROM responses ORDER BY last_used"
+        ):
+            evicted.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+
+    def __len__(self) -> int:
+        with self._lock:
+            (size,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        return int(size)
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self),
+        )
+
+
+_RESPONSE_CACHES: dict[Path, ResponseCache] = {}
+_RESPONSE_CACHES_LOCK = threading.Lock()
+
+
+def get_response_cache(path: Path, *, max_size: int) -> ResponseCache:
+    # All assistants share the cache.
+    with _RESPONSE_CACHES_LOCK:
+        cache = _RESPONSE_CACHES.get(path)
+        if cache is None:
+            cache = _RESPONSE_CACHES[path] = ResponseCache(path, max_size=max_size)
+        return cache
+
+
+def response_cache_stats() -> dict[str, int]:
+    """Returns hit, miss, and eviction counters of the assistant response cache."""
+    with _RESPONSE_CACHES_LOCK:
+        caches = list(_RESPONSE_CACHES.values())
+    stats: dict[str, int] = dict(hits=0, misses=0, evictions=0, size=0)
+    for cache in caches:
+        for key, value in cache.stats().items():
+            stats[key] += value
+    return stats
+
+
+# Request timeout, rate limit, server errors, and Anthropic's "overloaded".
+_RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504, 529}
+
+
+class _RetryableError(Exception):
+    def __init__(self, reason: str, *, retry_after: Optional[float] = None) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # See https://httpwg.org/specs/rfc9110.html#field.retry-after
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(
+        (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.0
+    )
+
+
+@functools.lru_cache
+def _get_tokenizer(encoding: str) -> tiktoken.Encoding:
+    import tiktoken
+
+    return tiktoken.get_encoding(encoding)
+
+
+class ApiAssistant(Assistant, HttpClientMixin):
+    """Base class for assistants that are accessed through an HTTP API.
+
+    Before a request is sent, the sources are packed into the context window of the
+    model: the instruction, the prompt, and `max_new_tokens` are reserved first and
+    the remaining budget is filled with the sources in the order of their relevance.
+    Sources that don't fit are dropped. If not even the prompt fits, the request is
+    rejected without contacting the API.
+
+    The HTTP connections are shared with all other components of the
+    [ragna.core.Rag][] workflow through its [ragna.core.HttpClientPool][].
+
+    Since all API calls are made with a temperature of zero, the responses can be
+    cached persistently with `response_cache=True`. Identical calls, i.e. same
+    provider, model, and request body, are thus answered without contacting the API
+    again. Note that the cache stores the prompts and sources unencrypted in the
+    local root and is thus disabled by default.
+
+    Requests that fail with a transient error, i.e. a network error, a timeout, or a
+    `408`, `429`, `5xx` status code, are retried with jittered exponential backoff.
+    A `Retry-After` header sent by the provider is honoured. Streamed responses are
+    only retried until the response headers are received.
+
+    With hedging enabled, a duplicate request is sent if the first one takes longer
+    than the 95th percentile of the previously observed latencies. Whichever
+    response arrives first is used and the other request is cancelled. This trades
+    a few additional requests for a lower tail latency.
+
+    Optionally, the requests can be limited client-side to stay within the rate
+    limits of the provider. The limits are shared by all assistants of the same
+    provider and calls exceeding them are queued in the order they arrived. The
+    number of tokens of a call is estimated from the
+    [ragna.core.Source.num_tokens][] of its sources, the prompt, and
+    `max_new_tokens`. Responses served from the cache don't count against the
+    limits, while every retry and hedged request counts as separate request.
+    Assistants of a provider that already has limits have to either set the same
+    limits or none at all.
 
+    Args:
+        response_cache: Whether to cache the responses.
+        response_cache_size: Maximum total size of the cached responses in bytes.
+        max_retries: Maximum number of retries after the first attempt.
+        backoff_base: Base delay in seconds of the exponential backoff.
+        backoff_max: Maximum delay in seconds between two attempts, unless the
+            provider requests a longer one through `Retry-After`.
+        attempt_timeout: Deadline in seconds for a single attempt to return the
+            response headers.
+        hedge: Whether to send hedged requests.
+        hedge_min_samples: Minimum number of observed latencies before requests
+            are hedged.
+        requests_per_minute: Maximum number of requests per minute to the provider.
+        tokens_per_minute: Maximum number of tokens per minute to the provider.
+        max_concurrent_requests: Maximum number of concurrent requests to the
+            provider.
+    """
 
-class ApiAssistant(Assistant):
     _API_KEY_ENV_VAR: str
+    _MODEL: str
+    # Encoding used to count tokens. For models that don't use a tiktoken tokenizer,
+    # the counts are only an approximation and thus inflated by the margin.
+    _TOKENIZER_ENCODING = "cl100k_base"
+    _TOKEN_COUNT_MARGIN = 1.0
 
     @classmethod
     def requirements(cls) -> list[Requirement]:
-        return [EnvVarRequirement(cls._API_KEY_ENV_VAR)]
+        return [EnvVarRequirement(cls._API_KEY_ENV_VAR), PackageRequirement("tiktoken")]
 
-    def __init__(self) -> None:
-        import httpx
-
-        self._client = httpx.AsyncClient(
-            headers={"User-Agent": f"{ragna.__version__}/{self}"},
-            timeout=60,
-        )
+    def __init__(
+        self,
+        *,
+        response_cache: bool = False,
+        response_cache_size: int = 256 * 1024**2,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 20.0,
+        attempt_timeout: float = 60.0,
+        hedge: bool = False,
+        hedge_min_samples: int = 20,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_concurrent_requests: Optional[int] = None,
+    ) -> None:
+        self._user_agent = f"{ragna.__version__}/{self}"
         self._api_key = os.environ[self._API_KEY_ENV_VAR]
+        self._response_cache = (
+            get_response_cache(
+                ragna.local_root() / "assistant_responses.sqlite",
+                max_size=response_cache_size,
+            )
+            if response_cache
+            else None
+        )
+        self._max_retries = max_retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._attempt_timeout = attempt_timeout
+        self._hedge = hedge
+        self._hedge_min_samples = hedge_min_samples
+        self._latencies: collections.deque[float] = collections.deque(maxlen=200)
+        # Provider rate limits are tied to the API key.
+        self._rate_limiter = get_rate_limiter(
+            self._API_KEY_ENV_VAR,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_concurrent_requests=max_concurrent_requests,
+        )
 
     async def answer(
         self, prompt: str, sources: list[Source], *, max_new_tokens: int = 256
-    ) -> str:
-        return await self._call_api(prompt, sources, max_new_tokens=max_new_tokens)
+    ) -> AsyncIterator[str]:
+        sources = self._pack_sources(prompt, sources, max_new_tokens=max_new_tokens)
+        async for chunk in self._call_api(
+            prompt, sources, max_new_tokens=max_new_tokens
+        ):
+            yield chunk
 
     @abc.abstractmethod
-    async def _call_api(
+    def _call_api(
         self, prompt: str, sources: list[Source], *, max_new_tokens: int
-    ) -> str:
+    ) -> AsyncIterator[str]:
+        ...
+
+    @abc.abstractmethod
+    def _render_prompt(self, prompt: str, sources: list[Source]) -> str:
+        """Returns the full text that is sent to the model."""
         ...
+
+    def _count_tokens(self, text: str) -> int:
+        num_tokens = len(
+            _get_tokenizer(self._TOKENIZER_ENCODING).encode(text, disallowed_special=())
+        )
+        return math.ceil(num_tokens * self._TOKEN_COUNT_MARGIN)
+
+    def _count_prompt_tokens(self, prompt: str, sources: list[Source]) -> int:
+        return self._count_tokens(self._render_prompt(prompt, sources))
+
+    def _pack_sources(
+        self, prompt: str, sources: list[Source], *, max_new_tokens: int
+    ) -> list[Source]:
+        budget = self.max_input_size - max_new_tokens
+        num_tokens = self._count_prompt_tokens(prompt, [])
+        if num_tokens > budget:
+            raise RagnaException(
+                "Prompt exceeds the context window of the assistant",
+                http_status_code=400,
+                http_detail=(
+                    f"The prompt requires {num_tokens} tokens, but {self} only has "
+                    f"{max(budget, 0)} tokens left after reserving {max_new_tokens} "
+                    f"tokens for the answer."
+                ),
+                assistant=str(self),
+                num_tokens=num_tokens,
+                max_input_size=self.max_input_size,
+                max_new_tokens=max_new_tokens,
+            )
+
+        # The sources are joined by a separator. Since the tokenizer might merge
+        # characters across the boundaries, this is just an upper bound that we
+        # check below.
+        separator_tokens = self._count_tokens("\n\n")
+        packed = []
+        for source in sources:
+            source_tokens = self._count_tokens(source.content) + separator_tokens
+            if num_tokens + source_tokens > budget:
+                continue
+            packed.append(source)
+            num_tokens += source_tokens
+
+        while packed and self._count_prompt_tokens(prompt, packed) > budget:
+            packed.pop()
+
+        return packed
+
+    @staticmethod
+    def _estimate_num_tokens(
+        prompt: str, sources: list[Source], *, max_new_tokens: int
+    ) -> int:
+        # Providers count the maximum number of new tokens against the limit upfront.
+        # The prompt and instructions are short compared to the sources and thus we
+        # only approximate them with four characters per token.
+        return (
+            sum(source.num_tokens for source in sources)
+            + len(prompt) // 4
+            + max_new_tokens
+        )
+
+    def _rate_limit(self, num_tokens: int) -> AsyncContextManager[None]:
+        if self._rate_limiter is None:
+            return contextlib.nullcontext()
+        return self._rate_limiter.limit(num_tokens)
+
+    async def _rate_limit_request(self) -> None:
+        # Retries and hedged requests are sent in the rate limit context of the
+        # original request, but every one of them still counts as request.
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire_request()
+
+    def _response_cache_key(self, method: str, url: str, body: Any) -> bytes:
+        # The headers are deliberately not part of the key, since they contain the
+        # API key.
+        return ResponseCache.key(self.display_name(), self._MODEL, method, url, body)
+
+    def _with_user_agent(self, kwargs: dict[str, Any]) -> dict[str, Any]:
+        # The client is shared with other components and thus can't carry our
+        # User-Agent as default header.
+        return dict(
+            kwargs,
+            headers={"User-Agent": self._user_agent, **kwargs.get("headers", {})},
+        )
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        # "Full jitter" avoids that all clients that were rejected at the same time
+        # retry at the same time as well.
+        delay = random.uniform(
+            0, min(self._backoff_max, self._backoff_base * 2**attempt)
+        )
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self._hedge or len(self._latencies) < self._hedge_min_samples:
+            return None
+        return statistics.quantiles(self._latencies, n=20)[-1]
+
+    async def _attempt(self, request: httpx.Request, *, stream: bool) -> httpx.Response:
+        import httpx
+
+        async def send() -> httpx.Response:
+            response = await self._http_client.send(request, stream=True)
+            if response.status_code in _RETRYABLE_STATUS_CODES:
+                await response.aclose()
+                raise _RetryableError(
+                    f"status code {response.status_code}",
+                    retry_after=_parse_retry_after(response.headers.get("Retry-After")),
+                )
+            elif not stream or response.is_error:
+                try:
+                    await response.aread()
+                finally:
+                    await response.aclose()
+            return response
+
+        start = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(send(), timeout=self._attempt_timeout)
+        except asyncio.TimeoutError:
+            raise _RetryableError("timeout") from None
+        except httpx.TransportError as error:
+            raise _RetryableError(type(error).__name__) from error
+
+        if not response.is_error:
+            self._latencies.append(time.perf_counter() - start)
+        return response
+
+    async def _hedged_attempt(
+        self, request: httpx.Request, *, stream: bool
+    ) -> httpx.Response:
+        delay = self._hedge_delay()
+        if delay is None:
+            return await self._attempt(request, stream=stream)
+
+        tasks = {asyncio.create_task(self._attempt(request, stream=stream))}
+        winner: Optional[asyncio.Task[httpx.Response]] = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                await self._rate_limit_request()
+                tasks.add(asyncio.create_task(self._attempt(request, stream=stream)))
+
+            error: Optional[BaseException] = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    error = error or task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks - {winner}:
+                if not task.done():
+                    task.cancel()
+                elif stream and not task.cancelled() and task.exception() is None:
+                    # Both requests might have finished at the same time. Thus, the
+                    # response of the loser might be open as well.
+                    await task.result().aclose()
+
+    async def _send(
+        self, method: str, url: str, *, stream: bool, **kwargs: Any
+    ) -> httpx.Response:
+        request = self._http_client.build_request(
+            method, url, **self._with_user_agent(kwargs)
+        )
+        for attempt in range(self._max_retries + 1):
+            try:
+                response = await self._hedged_attempt(request, stream=stream)
+            except _RetryableError as error:
+                if attempt == self._max_retries:
+                    raise RagnaException(
+                        "API request failed",
+                        assistant=self.display_name(),
+                        reason=error.reason,
+                        attempts=attempt + 1,
+                    ) from error
+                await asyncio.sleep(self._backoff(attempt, error.retry_after))
+                await self._rate_limit_request()
+                continue
+
+            if response.is_error:
+                raise RagnaException(
+                    status_code=response.status_code, response=response.json()
+                )
+            return response
+
+        raise AssertionError("unreachable")
+
+    async def _request_json(
+        self, method: str, url: str, *, num_tokens: int = 0, **kwargs: Any
+    ) -> Any:
+        cache = self._response_cache
+        key = self._response_cache_key(method, url, kwargs.get("json"))
+        if cache is not None:
+            cached = await anyio.to_thread.run_sync(functools.partial(cache.get, key))
+            if cached is not None:
+                return cached
+
+        async with self._rate_limit(num_tokens):
+            response = await self._send(method, url, stream=False, **kwargs)
+        data = response.json()
+        if cache is not None:
+            await anyio.to_thread.run_sync(functools.partial(cache.put, key, data))
+        return data
+
+    async def _stream_sse(
+        self, method: str, url: str, *, num_tokens: int = 0, **kwargs: Any
+    ) -> AsyncIterator[tuple[str, str]]:
+        cache = self._response_cache
+        key = self._response_cache_key(method, url, kwargs.get("json"))
+        if cache is not None:
+            cached = await anyio.to_thread.run_sync(functools.partial(cache.get, key))
+            if cached is not None:
+                for event, data in cached:
+                    yield event, data
+                return
+
+        # The events are only cached if the stream was consumed completely.
+        events = []
+        # The concurrency limit applies until the stream is consumed.
+        async with self._rate_limit(num_tokens):
+            async for event, data in self._stream_sse_uncached(method, url, **kwargs):
+                events.append((event, data))
+                yield event, data
+
+        if cache is not None:
+            await anyio.to_thread.run_sync(functools.partial(cache.put, key, events))
+
+    async def _stream_sse_uncached(
+        self, method: str, url: str, **kwargs: Any
+    ) -> AsyncIterator[tuple[str, str]]:
+        # See https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+        response = await self._send(method, url, stream=True, **kwargs)
+        try:
+            event = "message"
+            data: list[str] = []
+            async for line in response.aiter_lines():
+                if not line:
+                    if data:
+                        yield event, "\n".join(data)
+                    event = "message"
+                    data = []
+                    continue
+
+                field, _, value = line.partition(":")
+                if value.startswith(" "):
+                    value = value[1:]
+
+                if field == "event":
+                    event = value
+                elif field == "data":
+                    data.append(value)
+
+            if data:
+                yield event, "\n".join(data)
+        finally:
+            await response.aclose()
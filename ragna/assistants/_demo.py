@@ -1,6 +1,7 @@
 import re
 import sys
 import textwrap
+from typing import Iterator
 
 from ragna.core import Assistant, Source
 
@@ -16,6 +17,8 @@ class RagnaDemoAssistant(Assistant):
 
         If you include the phrase `"markdown"` into your prompt, it will return a
         Markdown table including emojis.
+
+        The answer is streamed word by word.
     """
 
     @classmethod
@@ -26,11 +29,16 @@ class RagnaDemoAssistant(Assistant):
     def max_input_size(self) -> int:
         return sys.maxsize
 
-    def answer(self, prompt: str, sources: list[Source]) -> str:
+    def answer(self, prompt: str, sources: list[Source]) -> Iterator[str]:
         if re.search("markdown", prompt, re.IGNORECASE):
-            return self._markdown_answer()
+            content = self._markdown_answer()
         else:
-            return self._default_answer(prompt, sources)
+            content = self._default_answer(prompt, sources)
+
+        # We keep the whitespace with the chunks to be able to reconstruct the exact
+        # content by joining them.
+        for match in re.finditer(r"\s*\S+\s*", content):
+            yield match.group()
 
     def _markdown_answer(self) -> str:
         return textwrap.dedent(
@@ -1,6 +1,6 @@
-from typing import cast
+from typing import AsyncIterator, cast
 
-from ragna.core import RagnaException, Source
+from ragna.core import Source
 
 from ._api import ApiAssistant
 
@@ -9,6 +9,8 @@ class MosaicmlApiAssistant(ApiAssistant):
     _API_KEY_ENV_VAR = "MOSAICML_API_KEY"
     _MODEL: str
     _CONTEXT_SIZE: int
+    # The MPT models use the GPT-NeoX tokenizer, which is less efficient than ours.
+    _TOKEN_COUNT_MARGIN = 1.15
 
     @classmethod
     def display_name(cls) -> str:
@@ -27,13 +29,22 @@ class MosaicmlApiAssistant(ApiAssistant):
         instruction += "\n\n".join(source.content for source in sources)
         return f"{instruction}### Instruction: {prompt}\n### Response:"
 
+    def _render_prompt(self, prompt: str, sources: list[Source]) -> str:
+        return self._instructize_prompt(prompt, sources)
+
     async def _call_api(
         self, prompt: str, sources: list[Source], *, max_new_tokens: int
-    ) -> str:
+    ) -> AsyncIterator[str]:
         instruction = self._instructize_prompt(prompt, sources)
         # https://docs.mosaicml.com/en/latest/inference.html#text-completion-requests
-        response = await self._client.post(
+        # The MosaicML inference API does not support streaming. Thus, we yield the
+        # full answer as single chunk.
+        data = await self._request_json(
+            "POST",
             f"https://models.hosted-on.mosaicml.hosting/{self._MODEL}/v1/predict",
+            num_tokens=self._estimate_num_tokens(
+                prompt, sources, max_new_tokens=max_new_tokens
+            ),
             headers={
                 "Authorization": f"{self._api_key}",
                 "Content-Type": "application/json",
@@ -43,11 +54,7 @@ class MosaicmlApiAssistant(ApiAssistant):
                 "parameters": {"temperature": 0.0, "max_new_tokens": max_new_tokens},
             },
         )
-        if response.is_error:
-            raise RagnaException(
-                status_code=response.status_code, response=response.json()
-            )
-        return cast(str, response.json()["outputs"][0]).replace(instruction, "").strip()
+        yield cast(str, data["outputs"][0]).replace(instruction, "").strip()
 
 
 class Mpt7bInstruct(MosaicmlApiAssistant):
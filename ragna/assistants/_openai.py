@@ -1,6 +1,7 @@
-from typing import cast
+import json
+from typing import AsyncIterator, cast
 
-from ragna.core import RagnaException, Source
+from ragna.core import Source
 
 from ._api import ApiAssistant
 
@@ -27,13 +28,26 @@ class OpenaiApiAssistant(ApiAssistant):
         )
         return instruction + "\n\n".join(source.content for source in sources)
 
+    def _render_prompt(self, prompt: str, sources: list[Source]) -> str:
+        return f"{self._make_system_content(sources)}\n{prompt}"
+
+    def _count_prompt_tokens(self, prompt: str, sources: list[Source]) -> int:
+        # Each message is wrapped in a few special tokens and the reply is primed
+        # with another few. See
+        # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+        return super()._count_prompt_tokens(prompt, sources) + 2 * 3 + 3
+
     async def _call_api(
         self, prompt: str, sources: list[Source], *, max_new_tokens: int
-    ) -> str:
+    ) -> AsyncIterator[str]:
         # See https://platform.openai.com/docs/api-reference/chat/create
-        # and https://platform.openai.com/docs/api-reference/chat/object
-        response = await self._client.post(
+        # and https://platform.openai.com/docs/api-reference/chat/streaming
+        async for _, data in self._stream_sse(
+            "POST",
             "https://api.openai.com/v1/chat/completions",
+            num_tokens=self._estimate_num_tokens(
+                prompt, sources, max_new_tokens=max_new_tokens
+            ),
             headers={
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {self._api_key}",
@@ -52,13 +66,21 @@ class OpenaiApiAssistant(ApiAssistant):
                 "model": self._MODEL,
                 "temperature": 0.0,
                 "max_tokens": max_new_tokens,
+                "stream": True,
             },
-        )
-        if response.is_error:
-            raise RagnaException(
-                status_code=response.status_code, response=response.json()
-            )
-        return cast(str, response.json()["choices"][0]["message"]["content"])
+        ):
+            # We don't break out of the loop here, since the response is only cached
+            # if the stream was consumed completely. The stream ends after this event
+            # anyway.
+            if data == "[DONE]":
+                continue
+
+            choice = json.loads(data)["choices"][0]
+            # The first chunk only contains the role and the last one only the finish
+            # reason. Thus, the content might be missing.
+            content = choice["delta"].get("content")
+            if content:
+                yield cast(str, content)
 
 
 class Gpt35Turbo16k(OpenaiApiAssistant):
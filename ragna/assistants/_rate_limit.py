@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import threading
+import time
+import weakref
+from typing import AsyncIterator, Optional
+
+from ragna.core import RagnaException
+
+
+class TokenBucket:
+    """Token bucket that refills continuously at a rate given per minute.
+
+    The bucket holds at most one minute worth of budget, i.e. it allows bursts up to
+    the per-minute limit.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self._rate = per_minute / 60
+        self._level = per_minute
+        self._last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._last) * self._rate)
+        self._last = now
+
+    def wait_time(self, amount: float) -> float:
+        """Returns the time in seconds until `amount` is available."""
+        self._refill()
+        return max(amount - self._level, 0.0) / self._rate
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self._level -= amount
+
+
+class RateLimiter:
+    """Client-side rate and concurrency limits for a provider.
+
+    Calls that exceed the budget are queued and admitted in the order they arrived.
+    Thus, the aggregate throughput stays at the limit of the provider rather than
+    collapsing into a storm of rejected requests and retries.
+
+    Args:
+        requests_per_minute: Maximum number of requests per minute.
+        tokens_per_minute: Maximum number of tokens per minute.
+        max_concurrent_requests: Maximum number of requests in flight.
+    """
+
+    def __init__(
+        self,
+        *,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_concurrent_requests: Optional[int] = None,
+    ) -> None:
+        self.limits = (requests_per_minute, tokens_per_minute, max_concurrent_requests)
+        self._requests = (
+            TokenBucket(requests_per_minute)
+            if requests_per_minute is not None
+            else None
+        )
+        self._tokens = (
+            TokenBucket(tokens_per_minute) if tokens_per_minute is not None else None
+        )
+        self._max_concurrent_requests = max_concurrent_requests
+        # asyncio primitives are bound to the event loop they are first used in.
+        self._primitives: weakref.WeakKeyDictionary[
+            asyncio.AbstractEventLoop,
+            tuple[asyncio.Lock, Optional[asyncio.Semaphore]],
+        ] = weakref.WeakKeyDictionary()
+
+        self.num_waiting = 0
+
+    def _get_primitives(self) -> tuple[asyncio.Lock, Optional[asyncio.Semaphore]]:
+        loop = asyncio.get_running_loop()
+        primitives = self._primitives.get(loop)
+        if primitives is None:
+            primitives = self._primitives[loop] = (
+                asyncio.Lock(),
+                asyncio.Semaphore(self._max_concurrent_requests)
+                if self._max_concurrent_requests is not None
+                else None,
+            )
+        return primitives
+
+    async def _acquire_budget(
+        self, lock: asyncio.Lock, *, num_requests: int, num_tokens: int
+    ) -> None:
+        if self._requests is None and self._tokens is None:
+            return
+
+        # Only the first call in the queue holds the lock and waits for the buckets to
+        # refill. This makes sure that large calls are not starved by small ones.
+        async with lock:
+            while True:
+                wait_time = 0.0
+                if self._requests is not None:
+                    wait_time = self._requests.wait_time(num_requests)
+                if self._tokens is not None:
+                    # A single call can never use more than the full bucket.
+                    num_tokens = min(num_tokens, int(self._tokens.capacity))
+                    wait_time = max(wait_time, self._tokens.wait_time(num_tokens))
+                if wait_time == 0:
+                    break
+                await asyncio.sleep(wait_time)
+
+            if self._requests is not None:
+                self._requests.consume(num_requests)
+            if self._tokens is not None:
+                self._tokens.consume(num_tokens)
+
+    @contextlib.asynccontextmanager
+    async def limit(self, num_tokens: int = 0) -> AsyncIterator[None]:
+        """Waits until a request with `num_tokens` tokens may be sent.
+
+        The concurrency slot is held until the context is left.
+        """
+        lock, semaphore = self._get_primitives()
+        self.num_waiting += 1
+        try:
+            if semaphore is not None:
+                await semaphore.acquire()
+            try:
+                await self._acquire_budget(lock, num_requests=1, num_tokens=num_tokens)
+            except BaseException:
+                if semaphore is not None:
+                    semaphore.release()
+                raise
+        finally:
+            self.num_waiting -= 1
+
+        try:
+            yield
+        finally:
+            if semaphore is not None:
+                semaphore.release()
+
+    async def acquire_request(self) -> None:
+        """Waits until an additional request of an ongoing call may be sent.
+
+        Retries and hedged requests run inside the concurrency slot of the original
+        call and don't use any additional tokens. Still, every one of them counts
+        against the requests per minute.
+        """
+        lock, _ = self._get_primitives()
+        await self._acquire_budget(lock, num_requests=1, num_tokens=0)
+
+
+_RATE_LIMITERS: dict[str, RateLimiter] = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(
+    provider: str,
+    *,
+    requests_per_minute: Optional[float],
+    tokens_per_minute: Optional[float],
+    max_concurrent_requests: Optional[int],
+) -> Optional[RateLimiter]:
+    # The limits apply to all assistants of a provider, e.g. all models that are
+    # accessed with the same API key. The first assistant that sets limits defines
+    # them. Assistants without limits join the ones of their provider if present.
+    limits = (requests_per_minute, tokens_per_minute, max_concurrent_requests)
+    has_limits = any(limit is not None for limit in limits)
+    with _RATE_LIMITERS_LOCK:
+        limiter = _RATE_LIMITERS.get(provider)
+        if limiter is None:
+            if has_limits:
+                limiter = _RATE_LIMITERS[provider] = RateLimiter(
+                    requests_per_minute=requests_per_minute,
+                    tokens_per_minute=tokens_per_minute,
+                    max_concurrent_requests=max_concurrent_requests,
+                )
+        elif has_limits and limits != limiter.limits:
+            raise RagnaException(
+                "Rate limits conflict with the ones already set for the provider",
+                provider=provider,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                max_concurrent_requests=max_concurrent_requests,
+                limits=limiter.limits,
+            )
+        return limiter
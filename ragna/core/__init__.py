@@ -2,9 +2,11 @@ __all__ = [
     "Assistant",
     "Chat",
     "Component",
+    "ComponentExecutor",
     "Document",
     "DocumentHandler",
     "EnvVarRequirement",
+    "HttpClientPool",
     "LocalDocument",
     "Message",
     "MessageRole",
@@ -14,9 +16,12 @@ __all__ = [
     "Rag",
     "RagnaException",
     "Requirement",
+    "SemanticAnswerCache",
     "Source",
     "SourceStorage",
+    "Span",
     "TxtDocumentHandler",
+    "span",
 ]
 
 from ._utils import (
@@ -28,6 +33,12 @@ from ._utils import (
 
 # isort: split
 
+from ._executor import ComponentExecutor
+from ._http import HttpClientPool
+from ._timing import Span, span
+
+# isort: split
+
 from ._document import (
     Document,
     DocumentHandler,
@@ -50,6 +61,10 @@ from ._components import (
 
 # isort: split
 
+from ._answer_cache import SemanticAnswerCache
+
+# isort: split
+
 from ._rag import Chat, Rag
 
 # isort: split
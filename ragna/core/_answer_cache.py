@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import hashlib
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Hashable, Optional
+
+from ._components import Source
+from ._utils import PackageRequirement, Requirement, RequirementsMixin
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+
+class SemanticAnswerCache(RequirementsMixin):
+    """Cache for answers of semantically similar prompts.
+
+    Answers are cached per document set, source storage, assistant, and chat
+    parameters. A cached answer is returned if the cosine similarity between the
+    embedding of the new prompt and the one of a previously answered prompt
+    reaches the `similarity_threshold`. If the cache is full, expired entries are
+    replaced first and otherwise the least recently used one.
+
+    !!! info "Required packages"
+
+        - `numpy`
+
+    Pass an instance to [ragna.core.Rag][] to use it:
+
+    ```python
+    rag = Rag(answer_cache=SemanticAnswerCache(embedding_function))
+    ```
+
+    Args:
+        embedding_function: Embeds a batch of texts. Using the embedding model of the
+            source storage allows to share the prompt embeddings with the retrieval.
+        similarity_threshold: Minimum cosine similarity between two prompts for the
+            cached answer to be returned.
+        ttl: Time in seconds after which a cached answer expires.
+        max_size: Maximum number of answers to keep.
+    """
+
+    @classmethod
+    def requirements(cls) -> list[Requirement]:
+        return [PackageRequirement("numpy")]
+
+    def __init__(
+        self,
+        embedding_function: Callable[[list[str]], Any],
+        *,
+        similarity_threshold: float = 0.95,
+        ttl: float = 3600.0,
+        max_size: int = 1_024,
+    ) -> None:
+        self._embedding_function = embedding_function
+        self._similarity_threshold = similarity_threshold
+        self._ttl = ttl
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+        # The storage is allocated with the first answer, since we only know the
+        # embedding dimensions afterwards. A group of -1 marks a free slot.
+        self._embeddings: Optional[npt.NDArray[np.float32]] = None
+        self._groups: Optional[npt.NDArray[np.int64]] = None
+        self._expires: Optional[npt.NDArray[np.float64]] = None
+        self._last_used: Optional[npt.NDArray[np.float64]] = None
+        self._answers: list[Optional[tuple[str, list[Source]]]] = [None] * max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def embed(self, prompt: str) -> npt.NDArray[np.float32]:
+        """Embeds and normalizes a prompt. This can be expensive and blocking."""
+        import numpy as np
+
+        embedding = np.asarray(self._embedding_function([prompt])[0], dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    @staticmethod
+    def _group(key: Hashable) -> int:
+        # We use a stable digest rather than hash() to make collisions between
+        # different document sets practically impossible.
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little", signed=True) & ((1 << 62) - 1)
+
+    def get(
+        self, key: Hashable, embedding: npt.NDArray[np.float32]
+    ) -> Optional[tuple[str, list[Source]]]:
+        """Looks up the answer of the most similar prompt.
+
+        Args:
+            key: Identifies the context of the prompt, e.g. the document set.
+            embedding: Embedding of the prompt as returned by
+                [embed][ragna.core.SemanticAnswerCache.embed].
+
+        Returns:
+            Content and sources of the cached answer or `None` if no prompt is
+            similar enough.
+        """
+        import numpy as np
+
+        with self._lock:
+            if self._embeddings is None:
+                self.misses += 1
+                return None
+
+            assert self._groups is not None
+            assert self._expires is not None
+            assert self._last_used is not None
+
+            now = time.monotonic()
+            candidates = np.flatnonzero(
+                (self._groups == self._group(key)) & (self._expires > now)
+            )
+            if candidates.size == 0:
+                self.misses += 1
+                return None
+
+            similarities = self._embeddings[candidates] @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < self._similarity_threshold:
+                self.misses += 1
+                return None
+
+            slot = int(candidates[best])
+            self._last_used[slot] = now
+            self.hits += 1
+            return self._answers[slot]
+
+    def put(
+        self,
+        key: Hashable,
+        embedding: npt.NDArray[np.float32],
+        content: str,
+        sources: list[Source],
+    ) -> None:
+        """Caches an answer.
+
+        Args:
+            key: Identifies the context of the prompt, e.g. the document set.
+            embedding: Embedding of the prompt as returned by
+                [embed][ragna.core.SemanticAnswerCache.embed].
+            content: Content of the answer.
+            sources: Sources of the answer.
+        """
+        import numpy as np
+
+        with self._lock:
+            if self._embeddings is None:
+                self._embeddings = np.zeros(
+                    (self._max_size, embedding.shape[0]), dtype=np.float32
+                )
+                self._groups = np.full(self._max_size, -1, dtype=np.int64)
+                self._expires = np.zeros(self._max_size, dtype=np.float64)
+                self._last_used = np.zeros(self._max_size, dtype=np.float64)
+
+            assert self._groups is not None
+            assert self._expires is not None
+            assert self._last_used is not None
+
+            now = time.monotonic()
+            (available,) = np.nonzero((self._groups == -1) | (self._expires <= now))
+            if available.size > 0:
+                slot = int(available[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                self.evictions += 1
+
+            self._embeddings[slot] = embedding
+            self._groups[slot] = self._group(key)
+            self._expires[slot] = now + self._ttl
+            self._last_used[slot] = now
+            self._answers[slot] = (content, sources)
+
+    def __len__(self) -> int:
+        import numpy as np
+
+        with self._lock:
+            if self._groups is None:
+                return 0
+            assert self._expires is not None
+            return int(
+                np.count_nonzero(
+                    (self._groups != -1) & (self._expires > time.monotonic())
+                )
+            )
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self),
+        )
@@ -4,12 +4,14 @@ import abc
 import enum
 import functools
 import inspect
-from typing import Type
+from typing import AsyncIterator, Awaitable, Iterator, Optional, Type, Union
 
 import pydantic
 import pydantic.utils
 
 from ._document import Document
+from ._executor import ComponentExecutor
+from ._timing import Span
 from ._utils import RequirementsMixin, merge_models
 
 
@@ -37,6 +39,10 @@ class Component(RequirementsMixin):
     #  level
     __ragna_protocol_methods__: list[str]
 
+    # Dedicated executors for the synchronous protocol methods keyed by the method
+    # name. See ragna.core.ComponentExecutor for details.
+    __ragna_executors__: dict[str, ComponentExecutor] = {}
+
     @classmethod
     @functools.cache
     def _protocol_models(
@@ -100,18 +106,30 @@ class SourceStorage(Component, abc.ABC):
     __ragna_protocol_methods__ = ["store", "retrieve"]
 
     @abc.abstractmethod
-    def store(self, documents: list[Document]) -> None:
+    def store(self, documents: list[Document]) -> Union[None, Awaitable[None]]:
         """Store content of documents.
 
+        This might be called multiple times for the same chat, e.g. once per document
+        when preparing the chat in the background. Storing a document that was already
+        stored should replace it rather than duplicate its content.
+
+        Implementing this method as coroutine function, i.e. `async def`, runs it on
+        the event loop. Otherwise, it is run in a worker thread.
+
         Args:
             documents: Documents to store.
         """
         ...
 
     @abc.abstractmethod
-    def retrieve(self, documents: list[Document], prompt: str) -> list[Source]:
+    def retrieve(
+        self, documents: list[Document], prompt: str
+    ) -> Union[list[Source], Awaitable[list[Source]]]:
         """Retrieve sources for a given prompt.
 
+        Implementing this method as coroutine function, i.e. `async def`, runs it on
+        the event loop. Otherwise, it is run in a worker thread.
+
         Args:
             documents: Documents to retrieve sources from.
             prompt: Prompt to retrieve sources for.
@@ -141,10 +159,20 @@ class MessageRole(enum.Enum):
 class Message(pydantic.BaseModel):
     """Data class for messages.
 
+    A message can also be streamed, i.e. its content is produced in chunks. Iterate
+    over the message, e.g. `async for chunk in message`, to process the chunks as they
+    arrive or [read][ragna.core.Message.read] the full content.
+
     Attributes:
-        content: The content of the message.
+        content: The content of the message. For a streamed message, this is only
+            available after the message was iterated over or
+            [read][ragna.core.Message.read].
         role: The message producer.
         sources: The sources used to produce the message.
+        timings: Durations of the stages of the pipeline that produced the message.
+            Only recorded if enabled on the [ragna.core.Rag][] workflow. For a
+            streamed message, the timing of the assistant is only available after
+            the message was iterated over or [read][ragna.core.Message.read].
 
     !!! tip "See also"
 
@@ -155,6 +183,52 @@ class Message(pydantic.BaseModel):
     content: str
     role: MessageRole
     sources: list[Source] = pydantic.Field(default_factory=list)
+    timings: list[Span] = pydantic.Field(default_factory=list)
+
+    _content_stream: Optional[AsyncIterator[str]] = pydantic.PrivateAttr(default=None)
+
+    @classmethod
+    def stream(
+        cls,
+        content: AsyncIterator[str],
+        *,
+        role: MessageRole,
+        sources: Optional[list[Source]] = None,
+    ) -> Message:
+        """Create a message with streamed content.
+
+        Args:
+            content: Chunks of the content of the message.
+            role: The message producer.
+            sources: The sources used to produce the message.
+        """
+        message = cls(content="", role=role, sources=sources or [])
+        message._content_stream = content
+        return message
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        if self._content_stream is None:
+            yield self.content
+            return
+
+        content_stream, self._content_stream = self._content_stream, None
+        chunks = []
+        try:
+            async for chunk in content_stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            self.content = "".join(chunks)
+
+    async def read(self) -> str:
+        """Read the full content of the message.
+
+        Returns:
+            Content of the message.
+        """
+        async for _ in self:
+            pass
+        return self.content
 
     def __str__(self) -> str:
         return self.content
@@ -171,14 +245,18 @@ class Assistant(Component, abc.ABC):
         ...
 
     @abc.abstractmethod
-    def answer(self, prompt: str, sources: list[Source]) -> str:
+    def answer(
+        self, prompt: str, sources: list[Source]
+    ) -> Union[str, Iterator[str], AsyncIterator[str]]:
         """Answer a prompt given some sources.
 
+        Implementing this method as (async) generator enables streaming the answer.
+
         Args:
             prompt: Prompt to be answered.
             sources: Sources to use when answering answer the prompt.
 
         Returns:
-            Answer.
+            Answer or chunks of the answer.
         """
         ...
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import threading
+from typing import Any, Callable, Optional, TypeVar
+
+import anyio
+
+from ._utils import RagnaException
+
+T = TypeVar("T")
+
+
+class ComponentExecutor:
+    """Runs the synchronous protocol methods of a component outside of the event loop.
+
+    Without a dedicated executor, the synchronous methods of all components share the
+    global thread pool of `anyio`, which runs at most 40 calls concurrently. Thus, a
+    burst of CPU-heavy calls, e.g. storing many documents, delays cheap calls like
+    retrieving sources. A dedicated executor for a method isolates its calls from all
+    other calls.
+
+    Executors can be declared by the component class through the
+    `__ragna_executors__` attribute or be assigned per
+    [ragna.core.Rag][] workflow. Both map the names of the protocol methods, e.g.
+    `"store"` or `"retrieve"`, to executors. Coroutine functions are always run
+    on the event loop and ignore the executor.
+
+    Args:
+        max_workers: Maximum number of concurrent calls. Use `1` for components that
+            are not thread-safe.
+        processes: If `True`, calls are run in a dedicated process pool rather than in
+            threads. This side-steps the GIL for CPU-bound methods, but requires the
+            component as well as the arguments and return value of the method to be
+            picklable. Furthermore, state of the component modified by one call is not
+            visible to other calls. Generator methods can't be run in a process pool.
+    """
+
+    def __init__(self, *, max_workers: int = 40, processes: bool = False) -> None:
+        if max_workers < 1:
+            raise RagnaException(
+                "max_workers has to be positive", max_workers=max_workers
+            )
+
+        self._max_workers = max_workers
+        self._processes = processes
+
+        self._limiter: Optional[anyio.CapacityLimiter] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._process_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._process_pool_lock = threading.Lock()
+
+    @property
+    def max_workers(self) -> int:
+        return self._max_workers
+
+    @property
+    def processes(self) -> bool:
+        return self._processes
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}("
+            f"max_workers={self._max_workers}, processes={self._processes})"
+        )
+
+    def _get_limiter(self) -> anyio.CapacityLimiter:
+        # Limiters can't be shared across event loops. If the executor is used from a
+        # new one, e.g. after multiple asyncio.run() calls, we start over.
+        loop = asyncio.get_running_loop()
+        if self._limiter is None or self._loop is not loop:
+            self._limiter = anyio.CapacityLimiter(self._max_workers)
+            self._loop = loop
+        return self._limiter
+
+    def _get_process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                # Forking a process that runs other threads, e.g. the ones of the
+                # event loop, can deadlock the child.
+                self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                    self._max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._process_pool
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run a synchronous function and wait for its result.
+
+        Args:
+            fn: Function to run.
+            *args: Positional arguments passed to `fn`.
+            **kwargs: Keyword arguments passed to `fn`.
+
+        Returns:
+            Return value of `fn`.
+        """
+        call = functools.partial(fn, *args, **kwargs)
+        if self._processes:
+            return await asyncio.wrap_future(self._get_process_pool().submit(call))
+
+        return await anyio.to_thread.run_sync(call, limiter=self._get_limiter())
+
+    def shutdown(self) -> None:
+        """Shut down the process pool, if any. Pending calls are cancelled."""
+        with self._process_pool_lock:
+            process_pool, self._process_pool = self._process_pool, None
+        if process_pool is not None:
+            process_pool.shutdown(wait=False, cancel_futures=True)
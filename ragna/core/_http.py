@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Optional
+
+from ._utils import PackageRequirement, RagnaException
+
+if TYPE_CHECKING:
+    import httpx
+
+
+class HttpClientPool:
+    """Shared HTTP client for components that talk to remote APIs.
+
+    All components loaded by a [ragna.core.Rag][] workflow share the connections of
+    this pool. Thus, concurrent calls to the same host reuse warm connections
+    instead of performing new TLS handshakes. The pool is closed together with the
+    workflow.
+
+    !!! info "Required packages"
+
+        - `h2`, if `http2=True`
+
+    Args:
+        max_connections: Maximum number of concurrent connections.
+        max_keepalive_connections: Maximum number of idle connections that are kept
+            open.
+        keepalive_expiry: Time in seconds after which idle connections are closed.
+        http2: Whether to use HTTP/2 for hosts that support it.
+        connect_timeout: Timeout in seconds for establishing a connection.
+        read_timeout: Timeout in seconds for receiving a chunk of the response.
+        write_timeout: Timeout in seconds for sending a chunk of the request.
+        pool_timeout: Timeout in seconds for acquiring a connection from the pool.
+        transport: Optional transport to use instead of the default one, e.g. a
+            `httpx.MockTransport` for testing.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        connect_timeout: float = 10.0,
+        read_timeout: float = 60.0,
+        write_timeout: float = 10.0,
+        pool_timeout: float = 10.0,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ) -> None:
+        if http2 and not PackageRequirement("h2").is_available():
+            raise RagnaException(
+                "HTTP/2 requires the h2 package", requirement="h2", http2=http2
+            )
+
+        self._max_connections = max_connections
+        self._max_keepalive_connections = max_keepalive_connections
+        self._keepalive_expiry = keepalive_expiry
+        self._http2 = http2
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._write_timeout = write_timeout
+        self._pool_timeout = pool_timeout
+        self._transport = transport
+
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _create_client(self) -> httpx.AsyncClient:
+        import httpx
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self._max_connections,
+                max_keepalive_connections=self._max_keepalive_connections,
+                keepalive_expiry=self._keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=self._connect_timeout,
+                read=self._read_timeout,
+                write=self._write_timeout,
+                pool=self._pool_timeout,
+            ),
+            http2=self._http2,
+            transport=self._transport,
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """The shared client. It is created on first access."""
+        return self._get_client()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Connections can't be shared across event loops. If the pool is used from a
+        # new one, e.g. after multiple asyncio.run() calls, we start over. The
+        # connections of the old loop are unusable anyway.
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            self._client = self._create_client()
+            self._loop = loop
+        return self._client
+
+    async def start(self) -> None:
+        """Create the shared client ahead of the first request."""
+        self._get_client()
+
+    async def aclose(self) -> None:
+        """Close all connections of the pool."""
+        client, self._client = self._client, None
+        if client is not None and self._loop is asyncio.get_running_loop():
+            await client.aclose()
+        self._loop = None
+
+
+class HttpClientMixin:
+    """Gives a component access to the [ragna.core.HttpClientPool][] of the
+    [ragna.core.Rag][] workflow that loaded it.
+
+    Components that are used outside of a workflow fall back to a pool shared by the
+    whole process.
+    """
+
+    _http_client_pool: Optional[HttpClientPool] = None
+
+    @property
+    def _http_client(self) -> httpx.AsyncClient:
+        if self._http_client_pool is None:
+            return _default_http_client_pool().client
+        return self._http_client_pool.client
+
+
+_DEFAULT_HTTP_CLIENT_POOL: Optional[HttpClientPool] = None
+
+
+def _default_http_client_pool() -> HttpClientPool:
+    global _DEFAULT_HTTP_CLIENT_POOL
+    if _DEFAULT_HTTP_CLIENT_POOL is None:
+        _DEFAULT_HTTP_CLIENT_POOL = HttpClientPool()
+    return _DEFAULT_HTTP_CLIENT_POOL
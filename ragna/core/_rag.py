@@ -6,10 +6,14 @@ import inspect
 import uuid
 from typing import (
     Any,
+    AsyncIterator,
     Awaitable,
     Callable,
+    Collection,
     Generic,
+    Hashable,
     Iterable,
+    Iterator,
     Optional,
     Type,
     TypeVar,
@@ -20,8 +24,19 @@ from typing import (
 import anyio
 import pydantic
 
-from ._components import Assistant, Component, Message, MessageRole, SourceStorage
+from ._answer_cache import SemanticAnswerCache
+from ._components import (
+    Assistant,
+    Component,
+    Message,
+    MessageRole,
+    Source,
+    SourceStorage,
+)
 from ._document import Document, LocalDocument
+from ._executor import ComponentExecutor
+from ._http import HttpClientMixin, HttpClientPool
+from ._timing import NULL_RECORDER, Recorder, TimingSink, span
 from ._utils import RagnaException, default_user, merge_models
 
 T = TypeVar("T")
@@ -29,10 +44,70 @@ C = TypeVar("C", bound=Component)
 
 
 class Rag(Generic[C]):
-    """RAG workflow."""
+    """RAG workflow.
+
+    Args:
+        record_timings: If `True`, the duration of the individual stages of the
+            pipeline are recorded and attached to the messages as
+            [`timings`][ragna.core.Message].
+        timing_sink: Optional callable that is called with the recorded
+            [ragna.core.Span][]s after every message. This is independent of
+            `record_timings`, i.e. the timings are only attached to the messages if
+            requested.
+        answer_cache: Optional cache that answers prompts, which are semantically
+            similar to previous prompts on the same documents, without retrieving
+            sources or calling the assistant.
+        http_client_pool: HTTP connections shared by all components of this workflow
+            that talk to remote APIs. Defaults to a [ragna.core.HttpClientPool][]
+            with default settings. The pool is closed by
+            [aclose][ragna.core.Rag.aclose], e.g. when leaving
+            `async with Rag() as rag:`.
+        executors: Dedicated executors for the synchronous protocol methods of the
+            components. Maps the display name of a component to a mapping of method
+            names, e.g. `"store"` or `"retrieve"`, to
+            [ragna.core.ComponentExecutor][]s. These take precedence over the
+            executors declared by the components. The process pools of the executors
+            are shut down by [aclose][ragna.core.Rag.aclose].
+    """
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        *,
+        record_timings: bool = False,
+        timing_sink: Optional[TimingSink] = None,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        http_client_pool: Optional[HttpClientPool] = None,
+        executors: Optional[dict[str, dict[str, ComponentExecutor]]] = None,
+    ) -> None:
         self._components: dict[Type[C], C] = {}
+        self._record_timings = record_timings
+        self._timing_sink = timing_sink
+        self._answer_cache = answer_cache
+        self.http_client_pool = http_client_pool or HttpClientPool()
+        self._configured_executors = executors or {}
+        self._executors: dict[tuple[Type[Component], str], ComponentExecutor] = {}
+
+    async def __aenter__(self) -> Rag:
+        await self.http_client_pool.start()
+        return self
+
+    async def __aexit__(
+        self, exc_type: Type[Exception], exc: Exception, traceback: str
+    ) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Release the resources held by the workflow, e.g. open HTTP connections."""
+        await self.http_client_pool.aclose()
+        for executors in self._configured_executors.values():
+            for executor in executors.values():
+                executor.shutdown()
+
+    def _recorder(self) -> Recorder:
+        if not (self._record_timings or self._timing_sink is not None):
+            return NULL_RECORDER
+
+        return Recorder(self._timing_sink, attach=self._record_timings)
 
     def _load_component(self, component: Union[Type[C], C]) -> C:
         cls: Type[C]
@@ -55,10 +130,35 @@ class Rag(Generic[C]):
                     )
                 instance = cls()
 
+            if isinstance(instance, HttpClientMixin):
+                instance._http_client_pool = self.http_client_pool
+
+            self._register_executors(cls)
+
             self._components[cls] = instance
 
         return self._components[cls]
 
+    def _register_executors(self, cls: Type[Component]) -> None:
+        executors = {
+            **cls.__ragna_executors__,
+            **self._configured_executors.get(cls.display_name(), {}),
+        }
+        protocol_methods = {name for _, name in cls._protocol_models()}
+        for method_name, executor in executors.items():
+            if method_name not in protocol_methods:
+                raise RagnaException(
+                    "Executors can only be assigned to protocol methods",
+                    component=cls.display_name(),
+                    method=method_name,
+                    protocol_methods=sorted(protocol_methods),
+                )
+            self._executors[(cls, method_name)] = executor
+
+    def _executor(self, fn: Callable) -> Optional[ComponentExecutor]:
+        component = cast(Component, getattr(fn, "__self__"))
+        return self._executors.get((type(component), fn.__name__))
+
     def chat(
         self,
         *,
@@ -150,12 +250,28 @@ class Chat:
         self._prepared = False
         self._messages: list[Message] = []
 
-    async def prepare(self) -> Message:
+    async def prepare(
+        self,
+        *,
+        stored_document_ids: Collection[uuid.UUID] = frozenset(),
+        on_document_stored: Optional[Callable[[Document], Awaitable[None]]] = None,
+    ) -> Message:
         """Prepare the chat.
 
         This [`store`][ragna.core.SourceStorage.store]s the documents in the selected
         source storage. Afterwards prompts can be [`answer`][ragna.core.Chat.answer]ed.
 
+        By default, all documents are stored at once. If `on_document_stored` is
+        passed, the documents are stored one at a time instead. Together with
+        `stored_document_ids` this allows to persist the progress and to resume an
+        interrupted preparation.
+
+        Args:
+            stored_document_ids: IDs of documents that are already stored, e.g. by a
+                previous preparation that was interrupted. These are not stored again.
+            on_document_stored: Awaited with every document after it is stored. If it
+                raises, the preparation is aborted.
+
         Returns:
             Welcome message.
 
@@ -171,19 +287,39 @@ class Chat:
                 detail=RagnaException.EVENT,
             )
 
-        await self._run(self.source_storage.store, self.documents)
-        self._prepared = True
+        documents = [
+            document
+            for document in self.documents
+            if document.id not in stored_document_ids
+        ]
+        recorder = self._rag._recorder()
+        with recorder.activate():
+            if on_document_stored is None:
+                await self._run(self.source_storage.store, documents)
+            else:
+                for document in documents:
+                    await self._run(self.source_storage.store, [document])
+                    await on_document_stored(document)
 
+        self._prepared = True
         welcome = Message(
             content="How can I help you with the documents?",
             role=MessageRole.SYSTEM,
         )
         self._messages.append(welcome)
+        recorder.attach_to(welcome)
+        recorder.finish()
         return welcome
 
-    async def answer(self, prompt: str) -> Message:
+    async def answer(self, prompt: str, *, stream: bool = False) -> Message:
         """Answer a prompt.
 
+        Args:
+            prompt: Prompt to be answered.
+            stream: If `True`, the content of the answer is streamed. Iterate over the
+                returned message, e.g. `async for chunk in answer`, to receive the
+                chunks as soon as they are produced by the assistant.
+
         Returns:
             Answer.
 
@@ -202,14 +338,41 @@ class Chat:
         prompt = Message(content=prompt, role=MessageRole.USER)
         self._messages.append(prompt)
 
-        sources = await self._run(
-            self.source_storage.retrieve, self.documents, prompt.content
-        )
-        answer = Message(
-            content=await self._run(self.assistant.answer, prompt.content, sources),
+        recorder = self._rag._recorder()
+        cache = self._rag._answer_cache
+        if cache is not None:
+            with recorder.span("answer_cache") as cache_span:
+                embedding = await anyio.to_thread.run_sync(
+                    functools.partial(cache.embed, prompt.content)
+                )
+                cached = cache.get(self._answer_cache_key(), embedding)
+                cache_span.set(hit=cached is not None)
+            if cached is not None:
+                answer = self._cached_answer(*cached)
+                recorder.attach_to(answer)
+                recorder.finish()
+                self._messages.append(answer)
+                return answer
+
+        with recorder.activate():
+            sources = await self._run(
+                self.source_storage.retrieve, self.documents, prompt.content
+            )
+        content = self._answer_stream(recorder, prompt.content, sources)
+        if cache is not None:
+            content = self._cache_answer(
+                content, cache, self._answer_cache_key(), embedding, sources
+            )
+        answer = Message.stream(
+            content,
             role=MessageRole.ASSISTANT,
             sources=sources,
         )
+        # The timings of the assistant are only available after the answer was
+        # streamed, but will show up on the message automatically.
+        recorder.attach_to(answer)
+        if not stream:
+            await answer.read()
         self._messages.append(answer)
 
         # FIXME: add error handling
@@ -221,6 +384,83 @@ class Chat:
 
         return answer
 
+    async def _answer_stream(
+        self, recorder: Recorder, prompt: str, sources: list[Source]
+    ) -> AsyncIterator[str]:
+        # We can't rely on _run() to record the timing here, since the stream is
+        # consumed outside of this chat. The timings are also reported if the stream
+        # is not consumed completely, e.g. because the client disconnected or the
+        # assistant failed.
+        try:
+            with recorder.span(
+                "answer",
+                component=self.assistant.display_name(),
+                num_sources=len(sources),
+                num_source_tokens=sum(source.num_tokens for source in sources),
+            ) as answer_span:
+                num_chunks = 0
+                chunks = self._run_gen(self.assistant.answer, prompt, sources)
+                while True:
+                    # The recorder is only activated while the assistant runs, since
+                    # the stream might be resumed in a different context.
+                    with recorder.activate():
+                        try:
+                            chunk = await chunks.__anext__()
+                        except StopAsyncIteration:
+                            break
+                    if num_chunks == 0:
+                        answer_span.set(time_to_first_chunk=answer_span.elapsed())
+                    num_chunks += 1
+                    answer_span.set(num_chunks=num_chunks)
+                    yield chunk
+        finally:
+            recorder.finish()
+
+    def _answer_cache_key(self) -> Hashable:
+        # The chat ID and name are excluded, since answers should be shared between
+        # chats on the same documents.
+        return (
+            self.source_storage.display_name(),
+            self.assistant.display_name(),
+            tuple(sorted(str(document.id) for document in self.documents)),
+            tuple(
+                sorted(
+                    (key, repr(value))
+                    for key, value in self.params.items()
+                    if key not in {"chat_id", "chat_name"}
+                )
+            ),
+        )
+
+    def _cached_answer(self, content: str, sources: list[Source]) -> Message:
+        # The cached sources reference the documents of the chat that produced the
+        # answer. They have the same IDs, but we want to hand out the objects of this
+        # chat.
+        documents = {document.id: document for document in self.documents}
+        return Message(
+            content=content,
+            role=MessageRole.ASSISTANT,
+            sources=[
+                source.model_copy(update=dict(document=documents[source.document.id]))
+                for source in sources
+            ],
+        )
+
+    async def _cache_answer(
+        self,
+        content: AsyncIterator[str],
+        cache: SemanticAnswerCache,
+        key: Hashable,
+        embedding: Any,
+        sources: list[Source],
+    ) -> AsyncIterator[str]:
+        chunks = []
+        async for chunk in content:
+            chunks.append(chunk)
+            yield chunk
+        # This is only reached if the answer was streamed completely.
+        cache.put(key, embedding, "".join(chunks), sources)
+
     def _parse_documents(self, documents: Iterable[Any]) -> list[Document]:
         documents_ = []
         for document in documents:
@@ -263,14 +503,57 @@ class Chat:
 
     async def _run(self, fn: Callable[..., Union[T, Awaitable[T]]], *args: Any) -> T:
         kwargs = self._unpacked_params[fn]
-        if inspect.iscoroutinefunction(fn):
-            fn = cast(Callable[..., Awaitable[T]], fn)
-            return await fn(*args, **kwargs)
-        else:
-            fn = cast(Callable[..., T], fn)
+        component = cast(Component, getattr(fn, "__self__"))
+        with span(fn.__name__, component=component.display_name()):
+            if inspect.iscoroutinefunction(fn):
+                fn = cast(Callable[..., Awaitable[T]], fn)
+                return await fn(*args, **kwargs)
+            else:
+                fn = cast(Callable[..., T], fn)
+                return await self._run_sync(fn, *args, **kwargs)
+
+    async def _run_sync(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        executor = self._rag._executor(fn)
+        if executor is None:
             return await anyio.to_thread.run_sync(
                 functools.partial(fn, *args, **kwargs)
             )
+        return await executor.run(fn, *args, **kwargs)
+
+    async def _run_gen(
+        self,
+        fn: Callable[..., Union[T, Iterator[T], AsyncIterator[T]]],
+        *args: Any,
+    ) -> AsyncIterator[T]:
+        kwargs = self._unpacked_params[fn]
+        if inspect.isasyncgenfunction(fn):
+            async for item in fn(*args, **kwargs):
+                yield item
+        elif inspect.isgeneratorfunction(fn):
+            executor = self._rag._executor(fn)
+            if executor is not None and executor.processes:
+                raise RagnaException(
+                    "Generator methods can't be run in a process pool",
+                    component=cast(Component, getattr(fn, "__self__")).display_name(),
+                    method=fn.__name__,
+                )
+            iterator = fn(*args, **kwargs)
+            sentinel = object()
+            while True:
+                item = await (
+                    anyio.to_thread.run_sync(
+                        functools.partial(next, iterator, sentinel)
+                    )
+                    if executor is None
+                    else executor.run(next, iterator, sentinel)
+                )
+                if item is sentinel:
+                    break
+                yield item
+        else:
+            yield await self._run(
+                cast(Callable[..., Union[T, Awaitable[T]]], fn), *args
+            )
 
     async def __aenter__(self) -> Chat:
         await self.prepare()
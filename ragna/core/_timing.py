@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import contextlib
+import contextvars
+import time
+from typing import TYPE_CHECKING, Any, Callable, Iterator, Optional
+
+import pydantic
+
+if TYPE_CHECKING:
+    from ._components import Message
+
+
+class Span(pydantic.BaseModel):
+    """Timing of a single stage of the RAG pipeline.
+
+    Attributes:
+        name: Name of the stage, e.g. `"retrieve"` or `"embed"`.
+        start: Start of the stage in seconds relative to the start of the recording.
+        duration: Duration of the stage in seconds.
+        attributes: Additional information about the stage, e.g. the component that
+            ran it or the number of pages, chunks, or tokens that were processed.
+    """
+
+    name: str
+    start: float
+    duration: float
+    attributes: dict[str, Any] = pydantic.Field(default_factory=dict)
+
+
+TimingSink = Callable[[list[Span]], Any]
+
+
+class ActiveSpan:
+    __slots__ = ("_start", "attributes")
+
+    def __init__(self, start: float, attributes: dict[str, Any]) -> None:
+        self._start = start
+        self.attributes = attributes
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+
+class _NullSpan(ActiveSpan):
+    __slots__ = ()
+
+    def __init__(self) -> None:
+        pass
+
+    def elapsed(self) -> float:
+        return 0.0
+
+    def set(self, **attributes: Any) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Recorder:
+    def __init__(
+        self, sink: Optional[TimingSink] = None, *, attach: bool = True
+    ) -> None:
+        self._origin = time.perf_counter()
+        self._sink = sink
+        self._attach = attach
+        self.spans: list[Span] = []
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[ActiveSpan]:
+        start = time.perf_counter()
+        active_span = ActiveSpan(start, attributes)
+        try:
+            yield active_span
+        finally:
+            self.spans.append(
+                Span(
+                    name=name,
+                    start=start - self._origin,
+                    duration=time.perf_counter() - start,
+                    attributes=active_span.attributes,
+                )
+            )
+
+    @contextlib.contextmanager
+    def activate(self) -> Iterator[None]:
+        # Makes the recorder available to span() calls inside components. Since
+        # anyio.to_thread.run_sync copies the context, this also covers components
+        # that are run in a worker thread.
+        token = _RECORDER.set(self)
+        try:
+            yield
+        finally:
+            _RECORDER.reset(token)
+
+    def attach_to(self, message: Message) -> None:
+        # The list is shared on purpose. Spans that are recorded later, e.g. while an
+        # answer is streamed, show up on the message automatically.
+        if self._attach:
+            message.timings = self.spans
+
+    def finish(self) -> None:
+        if self._sink is not None:
+            self._sink(self.spans)
+
+
+class _NullRecorder(Recorder):
+    def __init__(self) -> None:
+        pass
+
+    @property  # type: ignore[override]
+    def spans(self) -> list[Span]:
+        return []
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[ActiveSpan]:
+        yield _NULL_SPAN
+
+    @contextlib.contextmanager
+    def activate(self) -> Iterator[None]:
+        yield
+
+    def attach_to(self, message: Message) -> None:
+        pass
+
+    def finish(self) -> None:
+        pass
+
+
+NULL_RECORDER = _NullRecorder()
+
+_RECORDER: contextvars.ContextVar[Recorder] = contextvars.ContextVar(
+    "_RECORDER", default=NULL_RECORDER
+)
+
+
+def span(name: str, **attributes: Any) -> contextlib.AbstractContextManager[ActiveSpan]:
+    """Record the timing of a stage of the RAG pipeline.
+
+    This is a no-op unless timings are recorded, e.g. by passing
+    `record_timings=True` to [ragna.core.Rag][].
+
+    ```python
+    from ragna.core import span
+
+    with span("embed", num_texts=len(texts)) as s:
+        embeddings = embed(texts)
+        s.set(num_cached=num_cached)
+    ```
+
+    Args:
+        name: Name of the stage.
+        **attributes: Additional information about the stage. More can be added
+            inside the block through `.set(**attributes)`.
+    """
+    return _RECORDER.get().span(name, **attributes)
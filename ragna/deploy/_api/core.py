@@ -1,27 +1,79 @@
 import contextlib
 import itertools
 import uuid
-from typing import Annotated, Any, Iterator, Type, cast
+from typing import Annotated, Any, AsyncIterator, Callable, Type, cast
 
 import aiofiles
 from fastapi import Depends, FastAPI, Form, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 
 import ragna
 import ragna.core
 from ragna._utils import handle_localhost_origins
-from ragna.core import Component, Rag, RagnaException
+from ragna.core import (
+    Component,
+    ComponentExecutor,
+    HttpClientPool,
+    Rag,
+    RagnaException,
+    SemanticAnswerCache,
+)
 from ragna.core._rag import SpecialChatParams
 from ragna.deploy import Config
 
 from . import database, schemas
+from .jobs import JobQueue
+from .metrics import ApiMetrics
+
+
+def _default_prompt_embedding_function() -> Callable[[list[str]], Any]:
+    from ragna.source_storages._embedding_cache import get_default_embedder
+
+    # Going through the query cache of the builtin vector database source storages
+    # shares the prompt embeddings with their retrieval.
+    embedder = get_default_embedder()
+
+    def embed(prompts: list[str]) -> list[Any]:
+        return [embedder.embed_query(prompt) for prompt in prompts]
+
+    return embed
 
 
 def app(config: Config) -> FastAPI:
     ragna.local_root(config.local_cache_root)
 
-    rag = Rag()  # type: ignore[var-annotated]
+    answer_cache = (
+        SemanticAnswerCache(
+            _default_prompt_embedding_function(),
+            similarity_threshold=config.api.answer_cache_similarity_threshold,
+            ttl=config.api.answer_cache_ttl,
+        )
+        if config.api.answer_cache
+        else None
+    )
+    metrics = ApiMetrics(answer_cache=answer_cache) if config.api.metrics else None
+
+    rag = Rag(  # type: ignore[var-annotated]
+        record_timings=config.api.record_timings,
+        timing_sink=metrics.observe_spans if metrics is not None else None,
+        answer_cache=answer_cache,
+        http_client_pool=HttpClientPool(
+            max_connections=config.api.http_max_connections,
+            max_keepalive_connections=config.api.http_max_keepalive_connections,
+            keepalive_expiry=config.api.http_keepalive_expiry,
+            http2=config.api.http2,
+            connect_timeout=config.api.http_connect_timeout,
+            read_timeout=config.api.http_read_timeout,
+        ),
+        executors={
+            display_name: {
+                method_name: ComponentExecutor(**executor_config.model_dump())
+                for method_name, executor_config in executor_configs.items()
+            }
+            for display_name, executor_configs in config.components.executors.items()
+        },
+    )
     components_map: dict[str, Component] = {
         component.display_name(): rag._load_component(component)
         for component in itertools.chain(
@@ -36,7 +88,31 @@ def app(config: Config) -> FastAPI:
 
         return component
 
-    app = FastAPI(title="ragna", version=ragna.__version__)
+    database_url = config.api.database_url
+    if database_url == "memory":
+        database_url = "sqlite://"
+    engine = database.create_engine(
+        database_url,
+        pool_size=config.api.database_pool_size,
+        max_overflow=config.api.database_max_overflow,
+        pool_timeout=config.api.database_pool_timeout,
+    )
+    if metrics is not None:
+        metrics.instrument_engine(engine)
+    make_session = database.get_sessionmaker(engine)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+        await database.create_tables(engine)
+        async with rag:
+            await job_queue.start()
+            try:
+                yield
+            finally:
+                await job_queue.stop()
+                await engine.dispose()
+
+    app = FastAPI(title="ragna", version=ragna.__version__, lifespan=lifespan)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=handle_localhost_origins(config.api.origins),
@@ -44,6 +120,8 @@ def app(config: Config) -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    if metrics is not None:
+        app.add_middleware(metrics.middleware)
 
     @app.exception_handler(RagnaException)
     async def ragna_exception_handler(
@@ -72,6 +150,12 @@ def app(config: Config) -> FastAPI:
 
     UserDependency = Annotated[str, Depends(authentication.get_user)]
 
+    if metrics is not None:
+
+        @app.get("/metrics", include_in_schema=False)
+        async def get_metrics(_: UserDependency) -> Response:
+            return Response(metrics.expose(), media_type=metrics.content_type)
+
     def _get_component_json_schema(
         component: Type[Component],
     ) -> dict[str, dict[str, Any]]:
@@ -102,14 +186,9 @@ def app(config: Config) -> FastAPI:
             ],
         )
 
-    database_url = config.api.database_url
-    if database_url == "memory":
-        database_url = "sqlite://"
-    make_session = database.get_sessionmaker(database_url)
-
-    @contextlib.contextmanager
-    def get_session() -> Iterator[database.Session]:
-        with make_session() as session:  # type: ignore[attr-defined]
+    @contextlib.asynccontextmanager
+    async def get_session() -> AsyncIterator[database.AsyncSession]:
+        async with make_session() as session:
             yield session
 
     @app.get("/document")
@@ -117,12 +196,12 @@ def app(config: Config) -> FastAPI:
         user: UserDependency,
         name: str,
     ) -> schemas.DocumentUploadInfo:
-        with get_session() as session:
+        async with get_session() as session:
             document = schemas.Document(name=name)
             url, data, metadata = await config.document.get_upload_info(
                 config=config, user=user, id=document.id, name=document.name
             )
-            database.add_document(
+            await database.add_document(
                 session, user=user, document=document, metadata=metadata
             )
             return schemas.DocumentUploadInfo(url=url, data=data, document=document)
@@ -136,9 +215,9 @@ def app(config: Config) -> FastAPI:
                 status_code=400,
                 detail="Ragna configuration does not support local upload",
             )
-        with get_session() as session:
+        async with get_session() as session:
             user, id = ragna.core.LocalDocument.decode_upload_token(token)
-            document, metadata = database.get_document(session, user=user, id=id)
+            document, metadata = await database.get_document(session, user=user, id=id)
 
             core_document = ragna.core.LocalDocument(
                 id=document.id, name=document.name, metadata=metadata
@@ -150,21 +229,18 @@ def app(config: Config) -> FastAPI:
 
             return document
 
-    def schema_to_core_chat(
-        session: database.Session, *, user: str, chat: schemas.Chat
+    async def schema_to_core_chat(
+        session: database.AsyncSession, *, user: str, chat: schemas.Chat
     ) -> ragna.core.Chat:
+        documents = await database.get_documents(
+            session,
+            user=user,
+            ids=[document.id for document in chat.metadata.documents],
+        )
         core_chat = rag.chat(
             documents=[
-                config.document(
-                    id=document.id,
-                    name=document.name,
-                    metadata=database.get_document(
-                        session,
-                        user=user,
-                        id=document.id,
-                    )[1],
-                )
-                for document in chat.metadata.documents
+                config.document(id=document.id, name=document.name, metadata=metadata)
+                for document, metadata in documents
             ],
             source_storage=get_component(chat.metadata.source_storage),  # type: ignore[arg-type]
             assistant=get_component(chat.metadata.assistant),  # type: ignore[arg-type]
@@ -182,69 +258,134 @@ def app(config: Config) -> FastAPI:
 
         return core_chat
 
+    job_queue = JobQueue(
+        make_session=get_session,
+        make_core_chat=schema_to_core_chat,
+        num_workers=config.api.job_workers,
+    )
+
     @app.post("/chats")
     async def create_chat(
         user: UserDependency,
         chat_metadata: schemas.ChatMetadata,
     ) -> schemas.Chat:
-        with get_session() as session:
+        async with get_session() as session:
             chat = schemas.Chat(metadata=chat_metadata)
 
             # Although we don't need the actual ragna.core.Chat object here,
             # we use it to validate the documents and metadata.
-            schema_to_core_chat(session, user=user, chat=chat)
+            await schema_to_core_chat(session, user=user, chat=chat)
 
-            database.add_chat(session, user=user, chat=chat)
+            await database.add_chat(session, user=user, chat=chat)
             return chat
 
     @app.get("/chats")
     async def get_chats(user: UserDependency) -> list[schemas.Chat]:
-        with get_session() as session:
-            return database.get_chats(session, user=user)
+        async with get_session() as session:
+            return await database.get_chats(session, user=user)
 
     @app.get("/chats/{id}")
     async def get_chat(user: UserDependency, id: uuid.UUID) -> schemas.Chat:
-        with get_session() as session:
-            return database.get_chat(session, user=user, id=id)
+        async with get_session() as session:
+            return await database.get_chat(session, user=user, id=id)
+
+    @app.post("/chats/{id}/prepare", status_code=202)
+    async def prepare_chat(user: UserDependency, id: uuid.UUID) -> schemas.Job:
+        async with get_session() as session:
+            chat = await database.get_chat(session, user=user, id=id)
+            if chat.prepared:
+                raise RagnaException(
+                    "Chat is already prepared",
+                    chat_id=str(id),
+                    http_status_code=400,
+                    http_detail=RagnaException.EVENT,
+                )
 
-    @app.post("/chats/{id}/prepare")
-    async def prepare_chat(
-        user: UserDependency, id: uuid.UUID
-    ) -> schemas.MessageOutput:
-        with get_session() as session:
-            chat = database.get_chat(session, user=user, id=id)
+            job = await database.get_active_job(session, user=user, chat_id=id)
+            if job is not None:
+                return job
+
+            job = schemas.Job(
+                chat_id=id,
+                documents=[
+                    schemas.JobDocument(document=document)
+                    for document in chat.metadata.documents
+                ],
+            )
+            added_job = await database.add_job(session, user=user, job=job)
 
-            core_chat = schema_to_core_chat(session, user=user, chat=chat)
-            welcome = schemas.Message.from_core(await core_chat.prepare())
-            chat.prepared = True
-            chat.messages.append(welcome)
+        if added_job.id != job.id:
+            # A concurrent request added a job for this chat first.
+            return added_job
 
-            database.update_chat(session, user=user, chat=chat)
+        job_queue.submit(user, job)
+        return job
 
-            return schemas.MessageOutput(message=welcome, chat=chat)
+    @app.get("/jobs/{id}")
+    async def get_job(user: UserDependency, id: uuid.UUID) -> schemas.Job:
+        async with get_session() as session:
+            return await database.get_job(session, user=user, id=id)
+
+    @app.post("/jobs/{id}/cancel")
+    async def cancel_job(user: UserDependency, id: uuid.UUID) -> schemas.Job:
+        return await job_queue.cancel(user, id)
 
     @app.post("/chats/{id}/answer")
     async def answer(
-        user: UserDependency, id: uuid.UUID, prompt: str
+        user: UserDependency, id: uuid.UUID, prompt: str, stream: bool = False
     ) -> schemas.MessageOutput:
-        with get_session() as session:
-            chat = database.get_chat(session, user=user, id=id)
-            chat.messages.append(
-                schemas.Message(content=prompt, role=ragna.core.MessageRole.USER)
-            )
+        # The sessions are deliberately kept short, since we don't want to pin a
+        # database connection while waiting for the components.
+        async with get_session() as session:
+            chat = await database.get_chat(session, user=user, id=id)
+            core_chat = await schema_to_core_chat(session, user=user, chat=chat)
 
-            core_chat = schema_to_core_chat(session, user=user, chat=chat)
+        question = schemas.Message(content=prompt, role=ragna.core.MessageRole.USER)
+        chat.messages.append(question)
 
-            answer = schemas.Message.from_core(await core_chat.answer(prompt))
+        core_answer = await core_chat.answer(prompt, stream=stream)
+
+        if not stream:
+            answer = schemas.Message.from_core(core_answer)
             chat.messages.append(answer)
 
-            database.update_chat(session, user=user, chat=chat)
+            async with get_session() as session:
+                await database.add_messages(
+                    session, user=user, chat_id=chat.id, messages=[question, answer]
+                )
 
             return schemas.MessageOutput(message=answer, chat=chat)
 
+        async def message_chunks() -> AsyncIterator[str]:
+            # All chunks share the ID of the answer, but only the first one carries
+            # the sources to avoid sending them multiple times.
+            answer = schemas.Message.from_core(core_answer)
+            answer_chunk = answer.model_copy(update=dict(timings=[]))
+            async for content_chunk in core_answer:
+                answer_chunk.content = content_chunk
+                yield f"{answer_chunk.model_dump_json()}\n"
+                answer_chunk.sources = []
+
+            answer.content = core_answer.content
+            if core_answer.timings:
+                # The timings are only complete after the answer was streamed. Thus,
+                # they are sent in a separate, final chunk.
+                answer_chunk.content = ""
+                answer_chunk.timings = answer.timings = core_answer.timings
+                yield f"{answer_chunk.model_dump_json()}\n"
+
+            async with get_session() as session:
+                await database.add_messages(
+                    session, user=user, chat_id=chat.id, messages=[question, answer]
+                )
+
+        return StreamingResponse(  # type: ignore[return-value]
+            message_chunks(), media_type="application/x-ndjson"
+        )
+
     @app.delete("/chats/{id}")
     async def delete_chat(user: UserDependency, id: uuid.UUID) -> None:
-        with get_session() as session:
-            database.delete_chat(session, user=user, id=id)
+        async with get_session() as session:
+            await database.delete_chat(session, user=user, id=id)
 
     return app
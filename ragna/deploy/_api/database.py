@@ -1,34 +1,70 @@
 from __future__ import annotations
 
-import functools
 import uuid
-from typing import Any, Callable, Optional, cast
-from urllib.parse import urlsplit
-
-from sqlalchemy import create_engine, select
-from sqlalchemy.orm import Session
-from sqlalchemy.orm import sessionmaker as _sessionmaker
+from typing import Any, Optional, cast
+
+from sqlalchemy import CursorResult, insert, select, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import StaticPool
 
 from ragna.core import RagnaException
 
 from . import orm, schemas
 
+# Default asyncio drivers for database URLs that don't specify one explicitly.
+_ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+
+def create_engine(
+    database_url: str,
+    *,
+    pool_size: int = 5,
+    max_overflow: int = 10,
+    pool_timeout: float = 30.0,
+) -> AsyncEngine:
+    url = make_url(database_url)
+    if url.drivername in _ASYNC_DRIVERS:
+        url = url.set(drivername=f"{url.drivername}+{_ASYNC_DRIVERS[url.drivername]}")
+
+    kwargs: dict[str, Any] = {}
+    if url.get_backend_name() == "sqlite":
+        kwargs["connect_args"] = dict(check_same_thread=False)
+        if url.database in {None, "", ":memory:"}:
+            # Every connection to an in-memory database creates a new one. Thus, all
+            # sessions need to share a single connection.
+            kwargs["poolclass"] = StaticPool
+
+    if "poolclass" not in kwargs:
+        kwargs.update(
+            pool_size=pool_size, max_overflow=max_overflow, pool_timeout=pool_timeout
+        )
+
+    return create_async_engine(url, **kwargs)
+
 
-def get_sessionmaker(database_url: str) -> Callable[[], Session]:
-    components = urlsplit(database_url)
-    if components.scheme == "sqlite":
-        connect_args = dict(check_same_thread=False)
-    else:
-        connect_args = dict()
-    engine = create_engine(database_url, connect_args=connect_args)
-    orm.Base.metadata.create_all(bind=engine)
-    return _sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async def create_tables(engine: AsyncEngine) -> None:
+    async with engine.begin() as connection:
+        await connection.run_sync(orm.Base.metadata.create_all)
 
 
-@functools.lru_cache(maxsize=1024)
-def _get_user_id(session: Session, username: str) -> uuid.UUID:
-    user: Optional[orm.User] = session.execute(
-        select(orm.User).where(orm.User.name == username)
+def get_sessionmaker(engine: AsyncEngine) -> async_sessionmaker[AsyncSession]:
+    return async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+
+async def _get_user_id(session: AsyncSession, username: str) -> uuid.UUID:
+    user: Optional[orm.User] = (
+        await session.execute(select(orm.User).where(orm.User.name == username))
     ).scalar_one_or_none()
 
     if user is None:
@@ -36,46 +72,81 @@ def _get_user_id(session: Session, username: str) -> uuid.UUID:
         # behind the authentication layer, we don't need any extra security here.
         user = orm.User(id=uuid.uuid4(), name=username)
         session.add(user)
-        session.commit()
+        await session.commit()
 
     return cast(uuid.UUID, user.id)
 
 
-def add_document(
-    session: Session, *, user: str, document: schemas.Document, metadata: dict[str, Any]
+async def add_document(
+    session: AsyncSession,
+    *,
+    user: str,
+    document: schemas.Document,
+    metadata: dict[str, Any],
 ) -> None:
     session.add(
         orm.Document(
             id=document.id,
-            user_id=_get_user_id(session, user),
+            user_id=await _get_user_id(session, user),
             name=document.name,
             metadata_=metadata,
         )
     )
-    session.commit()
+    await session.commit()
 
 
 def _orm_to_schema_document(document: orm.Document) -> schemas.Document:
     return schemas.Document(id=document.id, name=document.name)
 
 
-@functools.lru_cache(maxsize=1024)
-def get_document(
-    session: Session, *, user: str, id: uuid.UUID
+async def get_document(
+    session: AsyncSession, *, user: str, id: uuid.UUID
 ) -> tuple[schemas.Document, dict[str, Any]]:
-    document = session.execute(
-        select(orm.Document).where(
-            (orm.Document.user_id == _get_user_id(session, user))
-            & (orm.Document.id == id)
+    document = (
+        await session.execute(
+            select(orm.Document).where(
+                (orm.Document.user_id == await _get_user_id(session, user))
+                & (orm.Document.id == id)
+            )
         )
     ).scalar_one_or_none()
     return _orm_to_schema_document(document), document.metadata_
 
 
-def add_chat(session: Session, *, user: str, chat: schemas.Chat) -> None:
+async def get_documents(
+    session: AsyncSession, *, user: str, ids: list[uuid.UUID]
+) -> list[tuple[schemas.Document, dict[str, Any]]]:
+    documents = {
+        document.id: document
+        for document in (
+            await session.execute(
+                select(orm.Document).where(
+                    (orm.Document.user_id == await _get_user_id(session, user))
+                    & (orm.Document.id.in_(ids))
+                )
+            )
+        ).scalars()
+    }
+    if len(documents) != len(set(ids)):
+        raise RagnaException(
+            "Unknown documents",
+            ids=[str(id) for id in set(ids) - documents.keys()],
+            http_status_code=404,
+            http_detail=RagnaException.MESSAGE,
+        )
+    return [
+        (_orm_to_schema_document(documents[id]), documents[id].metadata_) for id in ids
+    ]
+
+
+async def add_chat(session: AsyncSession, *, user: str, chat: schemas.Chat) -> None:
     document_ids = {document.id for document in chat.metadata.documents}
     documents = (
-        session.execute(select(orm.Document).where(orm.Document.id.in_(document_ids)))
+        (
+            await session.execute(
+                select(orm.Document).where(orm.Document.id.in_(document_ids))
+            )
+        )
         .scalars()
         .all()
     )
@@ -86,7 +157,7 @@ def add_chat(session: Session, *, user: str, chat: schemas.Chat) -> None:
     session.add(
         orm.Chat(
             id=chat.id,
-            user_id=_get_user_id(session, user),
+            user_id=await _get_user_id(session, user),
             name=chat.metadata.name,
             documents=documents,
             source_storage=chat.metadata.source_storage,
@@ -95,7 +166,7 @@ def add_chat(session: Session, *, user: str, chat: schemas.Chat) -> None:
             prepared=chat.prepared,
         )
     )
-    session.commit()
+    await session.commit()
 
 
 def _orm_to_schema_chat(chat: orm.Chat) -> schemas.Chat:
@@ -134,21 +205,40 @@ def _orm_to_schema_chat(chat: orm.Chat) -> schemas.Chat:
     )
 
 
-def get_chats(session: Session, *, user: str) -> list[schemas.Chat]:
+# Relationships cannot be lazy loaded with asyncio. Thus, we load everything that is
+# needed to build a schemas.Chat upfront.
+_CHAT_LOADER_OPTIONS = (
+    selectinload(orm.Chat.documents),
+    selectinload(orm.Chat.messages)
+    .selectinload(orm.Message.sources)
+    .selectinload(orm.Source.document),
+)
+
+
+async def get_chats(session: AsyncSession, *, user: str) -> list[schemas.Chat]:
     return [
         _orm_to_schema_chat(chat)
-        for chat in session.execute(
-            select(orm.Chat).where(orm.Chat.user_id == _get_user_id(session, user))
+        for chat in (
+            await session.execute(
+                select(orm.Chat)
+                .where(orm.Chat.user_id == await _get_user_id(session, user))
+                .options(*_CHAT_LOADER_OPTIONS)
+            )
         )
         .scalars()
         .all()
     ]
 
 
-def _get_orm_chat(session: Session, *, user: str, id: uuid.UUID) -> orm.Chat:
-    chat: Optional[orm.Chat] = session.execute(
-        select(orm.Chat).where(
-            (orm.Chat.id == id) & (orm.Chat.user_id == _get_user_id(session, user))
+async def _get_orm_chat(session: AsyncSession, *, user: str, id: uuid.UUID) -> orm.Chat:
+    chat: Optional[orm.Chat] = (
+        await session.execute(
+            select(orm.Chat)
+            .where(
+                (orm.Chat.id == id)
+                & (orm.Chat.user_id == await _get_user_id(session, user))
+            )
+            .options(*_CHAT_LOADER_OPTIONS)
         )
     ).scalar_one_or_none()
     if chat is None:
@@ -156,66 +246,215 @@ def _get_orm_chat(session: Session, *, user: str, id: uuid.UUID) -> orm.Chat:
     return chat
 
 
-def get_chat(session: Session, *, user: str, id: uuid.UUID) -> schemas.Chat:
-    return _orm_to_schema_chat(_get_orm_chat(session, user=user, id=id))
+async def get_chat(session: AsyncSession, *, user: str, id: uuid.UUID) -> schemas.Chat:
+    return _orm_to_schema_chat(await _get_orm_chat(session, user=user, id=id))
 
 
-def _schema_to_orm_source(session: Session, source: schemas.Source) -> orm.Source:
-    orm_source: Optional[orm.Source] = session.execute(
-        select(orm.Source).where(orm.Source.id == source.id)
-    ).scalar_one_or_none()
+async def add_messages(
+    session: AsyncSession,
+    *,
+    user: str,
+    chat_id: uuid.UUID,
+    messages: list[schemas.Message],
+    prepared: Optional[bool] = None,
+) -> None:
+    # Messages are immutable once they are part of a chat. Thus, we only ever need to
+    # insert the new ones rather than synchronizing the full chat.
+    chat_filter = (orm.Chat.id == chat_id) & (
+        orm.Chat.user_id == await _get_user_id(session, user)
+    )
+    if (await session.execute(select(orm.Chat.id).where(chat_filter))).first() is None:
+        raise RagnaException()
 
-    if orm_source is None:
-        orm_source = orm.Source(
-            id=source.id,
-            document_id=source.document.id,
-            location=source.location,
+    if prepared is not None:
+        await session.execute(
+            update(orm.Chat).where(chat_filter).values(prepared=prepared)
         )
-        session.add(orm_source)
-        session.commit()
-        session.refresh(orm_source)
-
-    return orm_source
 
-
-def _schema_to_orm_message(
-    session: Session, chat_id: uuid.UUID, message: schemas.Message
-) -> orm.Message:
-    orm_message: Optional[orm.Message] = session.execute(
-        select(orm.Message).where(orm.Message.id == message.id)
-    ).scalar_one_or_none()
-    if orm_message is None:
-        orm_message = orm.Message(
-            id=message.id,
-            chat_id=chat_id,
-            content=message.content,
-            role=message.role,
-            sources=[
-                _schema_to_orm_source(session, source=source)
-                for source in message.sources
+    sources = {source.id: source for message in messages for source in message.sources}
+    if sources:
+        existing_source_ids: set[str] = set(
+            (
+                await session.execute(
+                    select(orm.Source.id).where(orm.Source.id.in_(sources))
+                )
+            )
+            .scalars()
+            .all()
+        )
+        new_sources = [
+            dict(id=source.id, document_id=source.document.id, location=source.location)
+            for id, source in sources.items()
+            if id not in existing_source_ids
+        ]
+        if new_sources:
+            await session.execute(insert(orm.Source), new_sources)
+
+    if messages:
+        await session.execute(
+            insert(orm.Message),
+            [
+                dict(
+                    id=message.id,
+                    chat_id=chat_id,
+                    content=message.content,
+                    role=message.role,
+                    timestamp=message.timestamp,
+                )
+                for message in messages
             ],
-            timestamp=message.timestamp,
         )
-        session.add(orm_message)
-        session.commit()
-        session.refresh(orm_message)
 
-    return orm_message
+    source_message_associations = [
+        dict(source_id=source_id, message_id=message.id)
+        for message in messages
+        for source_id in dict.fromkeys(source.id for source in message.sources)
+    ]
+    if source_message_associations:
+        await session.execute(
+            insert(orm.source_message_association_table), source_message_associations
+        )
 
+    await session.commit()
+
+
+async def delete_chat(session: AsyncSession, user: str, id: uuid.UUID) -> None:
+    orm_chat = await _get_orm_chat(session, user=user, id=id)
+    await session.delete(orm_chat)
+    await session.commit()
+
+
+def _orm_to_schema_job(job: orm.Job) -> schemas.Job:
+    stored_document_ids = set(job.stored_document_ids)
+    return schemas.Job(
+        id=job.id,
+        chat_id=job.chat_id,
+        status=job.status,
+        stage=job.stage,
+        documents=[
+            schemas.JobDocument(
+                document=_orm_to_schema_document(document),
+                stored=str(document.id) in stored_document_ids,
+            )
+            for document in job.chat.documents
+        ],
+        error=job.error,
+    )
 
-def update_chat(session: Session, user: str, chat: schemas.Chat) -> None:
-    orm_chat = _get_orm_chat(session, user=user, id=chat.id)
 
-    orm_chat.prepared = chat.prepared
-    orm_chat.messages = [
-        _schema_to_orm_message(session, chat_id=chat.id, message=message)
-        for message in chat.messages
-    ]
+_JOB_LOADER_OPTIONS = (selectinload(orm.Job.chat).selectinload(orm.Chat.documents),)
+_UNFINISHED_JOB_STATUSES = [schemas.JobStatus.PENDING, schemas.JobStatus.RUNNING]
 
-    session.commit()
 
+async def add_job(session: AsyncSession, *, user: str, job: schemas.Job) -> schemas.Job:
+    """Adds the job unless the chat already has an unfinished one.
 
-def delete_chat(session: Session, user: str, id: uuid.UUID) -> None:
-    orm_chat = _get_orm_chat(session, user=user, id=id)
-    session.delete(orm_chat)  # type: ignore[no-untyped-call]
-    session.commit()
+    Returns:
+        The added job or the unfinished job of the chat, which was added by a
+        concurrent request.
+    """
+    await _get_orm_chat(session, user=user, id=job.chat_id)
+    session.add(
+        orm.Job(
+            id=job.id,
+            chat_id=job.chat_id,
+            status=job.status,
+            stage=job.stage,
+            stored_document_ids=[
+                str(job_document.document.id)
+                for job_document in job.documents
+                if job_document.stored
+            ],
+            error=job.error,
+        )
+    )
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        active_job = await get_active_job(session, user=user, chat_id=job.chat_id)
+        if active_job is None:
+            raise
+        return active_job
+    return job
+
+
+async def get_job(session: AsyncSession, *, user: str, id: uuid.UUID) -> schemas.Job:
+    job: Optional[orm.Job] = (
+        await session.execute(
+            select(orm.Job)
+            .join(orm.Chat)
+            .where(
+                (orm.Job.id == id)
+                & (orm.Chat.user_id == await _get_user_id(session, user))
+            )
+            .options(*_JOB_LOADER_OPTIONS)
+        )
+    ).scalar_one_or_none()
+    if job is None:
+        raise RagnaException(
+            "Unknown job",
+            id=str(id),
+            http_status_code=404,
+            http_detail=RagnaException.MESSAGE,
+        )
+    return _orm_to_schema_job(job)
+
+
+async def get_active_job(
+    session: AsyncSession, *, user: str, chat_id: uuid.UUID
+) -> Optional[schemas.Job]:
+    job: Optional[orm.Job] = (
+        await session.execute(
+            select(orm.Job)
+            .join(orm.Chat)
+            .where(
+                (orm.Job.chat_id == chat_id)
+                & (orm.Chat.user_id == await _get_user_id(session, user))
+                & orm.Job.status.in_(_UNFINISHED_JOB_STATUSES)
+            )
+            .options(*_JOB_LOADER_OPTIONS)
+        )
+    ).scalar_one_or_none()
+    return _orm_to_schema_job(job) if job is not None else None
+
+
+async def get_unfinished_jobs(session: AsyncSession) -> list[tuple[str, schemas.Job]]:
+    return [
+        (user, _orm_to_schema_job(job))
+        for job, user in (
+            await session.execute(
+                select(orm.Job, orm.User.name)
+                .join(orm.Chat, orm.Job.chat_id == orm.Chat.id)
+                .join(orm.User, orm.Chat.user_id == orm.User.id)
+                .where(orm.Job.status.in_(_UNFINISHED_JOB_STATUSES))
+                .options(*_JOB_LOADER_OPTIONS)
+            )
+        ).all()
+    ]
+
+
+async def update_job(session: AsyncSession, job: schemas.Job) -> bool:
+    # Jobs that are done, e.g. because they were cancelled, are never updated again.
+    # Thus, the return value indicates whether the job should continue.
+    result = cast(
+        CursorResult,
+        await session.execute(
+            update(orm.Job)
+            .where(
+                (orm.Job.id == job.id) & orm.Job.status.in_(_UNFINISHED_JOB_STATUSES)
+            )
+            .values(
+                status=job.status,
+                stage=job.stage,
+                stored_document_ids=[
+                    str(job_document.document.id)
+                    for job_document in job.documents
+                    if job_document.stored
+                ],
+                error=job.error,
+            )
+        ),
+    )
+    await session.commit()
+    return result.rowcount == 1
@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import uuid
+from typing import AsyncContextManager, Awaitable, Callable, Optional
+
+import ragna.core
+from ragna.core import RagnaException
+
+from . import database, schemas
+
+# Called as make_core_chat(session, *, user, chat)
+CoreChatFactory = Callable[..., Awaitable[ragna.core.Chat]]
+
+
+class _JobCancelled(Exception):
+    # Raised if the job was cancelled while a document was stored.
+    pass
+
+
+class JobQueue:
+    """In-process queue that prepares chats in the background.
+
+    The jobs are run by a fixed number of workers independent of the number of
+    requests the API is handling. The progress is persisted after every stored
+    document. Thus, unfinished jobs are resumed from the last stored document
+    when the queue is started again, e.g. after a crash.
+
+    Args:
+        make_session: Creates a new database session.
+        make_core_chat: Creates a `ragna.core.Chat` from a `schemas.Chat`.
+        num_workers: Number of jobs that are run concurrently.
+    """
+
+    def __init__(
+        self,
+        *,
+        make_session: Callable[[], AsyncContextManager[database.AsyncSession]],
+        make_core_chat: CoreChatFactory,
+        num_workers: int,
+    ) -> None:
+        self._make_session = make_session
+        self._make_core_chat = make_core_chat
+        self._num_workers = num_workers
+        self._queue: Optional[asyncio.Queue[tuple[str, schemas.Job]]] = None
+        self._workers: list[asyncio.Task] = []
+        self._running: dict[uuid.UUID, asyncio.Task] = {}
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._work()) for _ in range(self._num_workers)
+        ]
+
+        async with self._make_session() as session:
+            for user, job in await database.get_unfinished_jobs(session):
+                self._queue.put_nowait((user, job))
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        # Interrupted jobs keep their status and are resumed on the next start.
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    def submit(self, user: str, job: schemas.Job) -> None:
+        if self._queue is None:
+            raise RagnaException("Job queue is not running")
+        self._queue.put_nowait((user, job))
+
+    async def cancel(self, user: str, id: uuid.UUID) -> schemas.Job:
+        async with self._make_session() as session:
+            job = await database.get_job(session, user=user, id=id)
+            if job.status.done:
+                return job
+
+            job.status = schemas.JobStatus.CANCELLED
+            if not await database.update_job(session, job):
+                # The job finished in the meantime.
+                return await database.get_job(session, user=user, id=id)
+
+        # Pending jobs are skipped by the workers, but running ones need to be
+        # interrupted.
+        task = self._running.get(id)
+        if task is not None:
+            task.cancel()
+
+        return job
+
+    async def _work(self) -> None:
+        assert self._queue is not None
+        while True:
+            user, job = await self._queue.get()
+            task = asyncio.create_task(self._run(user, job))
+            self._running[job.id] = task
+            try:
+                # In contrast to awaiting the task directly, this doesn't raise if the
+                # job is cancelled, but only if the worker itself is.
+                await asyncio.wait({task})
+            finally:
+                del self._running[job.id]
+                task.cancel()
+
+    async def _update(self, job: schemas.Job) -> bool:
+        async with self._make_session() as session:
+            return await database.update_job(session, job)
+
+    async def _run(self, user: str, job: schemas.Job) -> None:
+        job.status = schemas.JobStatus.RUNNING
+        job.stage = schemas.JobStage.STORING
+        if not await self._update(job):
+            return
+
+        try:
+            async with self._make_session() as session:
+                chat = await database.get_chat(session, user=user, id=job.chat_id)
+                core_chat = await self._make_core_chat(session, user=user, chat=chat)
+
+            if not chat.prepared:
+                job_documents = {
+                    job_document.document.id: job_document
+                    for job_document in job.documents
+                }
+
+                # The progress is persisted after every stored document.
+                async def on_document_stored(document: ragna.core.Document) -> None:
+                    job_documents[document.id].stored = True
+                    if not await self._update(job):
+                        raise _JobCancelled
+
+                try:
+                    core_welcome = await core_chat.prepare(
+                        stored_document_ids={
+                            id
+                            for id, job_document in job_documents.items()
+                            if job_document.stored
+                        },
+                        on_document_stored=on_document_stored,
+                    )
+                except _JobCancelled:
+                    return
+
+                job.stage = schemas.JobStage.FINALIZING
+                if not await self._update(job):
+                    return
+
+                welcome = schemas.Message.from_core(core_welcome)
+                async with self._make_session() as session:
+                    await database.add_messages(
+                        session,
+                        user=user,
+                        chat_id=chat.id,
+                        messages=[welcome],
+                        prepared=True,
+                    )
+        except Exception as exc:
+            job.status = schemas.JobStatus.FAILED
+            job.error = str(exc) or type(exc).__name__
+        else:
+            job.status = schemas.JobStatus.SUCCEEDED
+            job.stage = schemas.JobStage.DONE
+
+        # Shield the final update so it is not lost if the job is cancelled right now.
+        with contextlib.suppress(asyncio.CancelledError):
+            await asyncio.shield(self._update(job))
@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+from ragna.core import PackageRequirement, RagnaException, SemanticAnswerCache, Span
+
+if TYPE_CHECKING:
+    from prometheus_client.metrics_core import Metric
+    from sqlalchemy.ext.asyncio import AsyncEngine
+    from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+REQUIREMENT = PackageRequirement("prometheus-client")
+
+_TOKEN_BUCKETS = tuple(2.0**exponent for exponent in range(6, 16))
+
+
+class _CacheStatsCollector:
+    # Mirrors the statistics that the caches maintain themselves. They are read when
+    # the metrics are collected.
+
+    def __init__(self, answer_cache: Optional[SemanticAnswerCache]) -> None:
+        self._answer_cache = answer_cache
+
+    def collect(self) -> Iterator[Metric]:
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+        from ragna.assistants._api import response_cache_stats
+        from ragna.source_storages._embedding_cache import embedding_cache_stats
+
+        embedding_cache_requests = CounterMetricFamily(
+            "ragna_embedding_cache_requests",
+            "Number of embedding cache lookups.",
+            labels=["model", "cache", "result"],
+        )
+        embedding_cache_evictions = CounterMetricFamily(
+            "ragna_embedding_cache_evictions",
+            "Number of embeddings evicted from the cache.",
+            labels=["model", "cache"],
+        )
+        embedding_cache_size = GaugeMetricFamily(
+            "ragna_embedding_cache_size",
+            "Number of embeddings in the cache.",
+            labels=["model", "cache"],
+        )
+        for model, caches in embedding_cache_stats().items():
+            for cache, stats in caches.items():
+                for result, key in [("hit", "hits"), ("miss", "misses")]:
+                    embedding_cache_requests.add_metric(
+                        [model, cache, result], stats[key]
+                    )
+                embedding_cache_evictions.add_metric([model, cache], stats["evictions"])
+                embedding_cache_size.add_metric([model, cache], stats["size"])
+        yield embedding_cache_requests
+        yield embedding_cache_evictions
+        yield embedding_cache_size
+
+        stats = response_cache_stats()
+        assistant_response_cache_requests = CounterMetricFamily(
+            "ragna_assistant_response_cache_requests",
+            "Number of assistant response cache lookups.",
+            labels=["result"],
+        )
+        assistant_response_cache_requests.add_metric(["hit"], stats["hits"])
+        assistant_response_cache_requests.add_metric(["miss"], stats["misses"])
+        yield assistant_response_cache_requests
+        yield CounterMetricFamily(
+            "ragna_assistant_response_cache_evictions",
+            "Number of assistant responses evicted from the cache.",
+            value=stats["evictions"],
+        )
+        yield GaugeMetricFamily(
+            "ragna_assistant_response_cache_size",
+            "Number of assistant responses in the cache.",
+            value=stats["size"],
+        )
+
+        if self._answer_cache is None:
+            return
+
+        stats = self._answer_cache.stats()
+        answer_cache_requests = CounterMetricFamily(
+            "ragna_answer_cache_requests",
+            "Number of answer cache lookups.",
+            labels=["result"],
+        )
+        answer_cache_requests.add_metric(["hit"], stats["hits"])
+        answer_cache_requests.add_metric(["miss"], stats["misses"])
+        yield answer_cache_requests
+        yield GaugeMetricFamily(
+            "ragna_answer_cache_size",
+            "Number of answers in the cache.",
+            value=stats["size"],
+        )
+
+
+class ApiMetrics:
+    """Metrics of the REST API in the Prometheus format.
+
+    The metrics are fed by
+
+    - the `middleware` for the HTTP requests,
+    - `observe_spans` as timing sink of `ragna.core.Rag` for the components and the
+      individual stages of the RAG pipeline,
+    - SQLAlchemy events for the database queries, see `instrument_engine`, and
+    - the embedding, assistant response, and answer cache statistics, which are
+      read when the metrics are exposed.
+
+    !!! info "Required packages"
+
+        - `prometheus-client`
+
+    Args:
+        answer_cache: Answer cache used by the API, if any.
+    """
+
+    def __init__(self, *, answer_cache: Optional[SemanticAnswerCache] = None) -> None:
+        if not REQUIREMENT.is_available():
+            raise RagnaException(
+                "Exposing metrics requires the prometheus-client package",
+                requirement=str(REQUIREMENT),
+            )
+
+        from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+
+        # Every instance has its own registry rather than using the global one of
+        # prometheus_client. Thus, multiple apps can live in the same process.
+        self.registry = registry = CollectorRegistry(auto_describe=True)
+
+        self.http_request_duration = Histogram(
+            "ragna_http_request_duration_seconds",
+            "Duration of HTTP requests including streaming the response.",
+            ["method", "route", "status"],
+            registry=registry,
+        )
+        self.http_requests_in_progress = Gauge(
+            "ragna_http_requests_in_progress",
+            "Number of HTTP requests that are currently handled.",
+            ["method"],
+            registry=registry,
+        )
+        self.component_duration = Histogram(
+            "ragna_component_duration_seconds",
+            "Duration of the calls to the components.",
+            ["component", "method"],
+            registry=registry,
+        )
+        self.stage_duration = Histogram(
+            "ragna_stage_duration_seconds",
+            "Duration of the stages of the RAG pipeline inside the components.",
+            ["stage"],
+            registry=registry,
+        )
+        self.time_to_first_chunk = Histogram(
+            "ragna_answer_time_to_first_chunk_seconds",
+            "Time until the assistant produced the first chunk of the answer.",
+            ["component"],
+            registry=registry,
+        )
+        self.retrieved_source_tokens = Histogram(
+            "ragna_retrieved_source_tokens",
+            "Number of tokens of the sources that are passed to the assistant.",
+            buckets=_TOKEN_BUCKETS,
+            registry=registry,
+        )
+        self.database_queries = Counter(
+            "ragna_database_queries",
+            "Number of executed database queries.",
+            ["statement"],
+            registry=registry,
+        )
+        registry.register(_CacheStatsCollector(answer_cache))
+
+    @property
+    def content_type(self) -> str:
+        from prometheus_client import CONTENT_TYPE_LATEST
+
+        return CONTENT_TYPE_LATEST
+
+    def expose(self) -> bytes:
+        from prometheus_client import generate_latest
+
+        return generate_latest(self.registry)
+
+    def observe_spans(self, spans: list[Span]) -> None:
+        for span in spans:
+            component = span.attributes.get("component")
+            if component is None:
+                self.stage_duration.labels(stage=span.name).observe(span.duration)
+                continue
+
+            self.component_duration.labels(
+                component=component, method=span.name
+            ).observe(span.duration)
+            if span.name != "answer":
+                continue
+
+            time_to_first_chunk = span.attributes.get("time_to_first_chunk")
+            if time_to_first_chunk is not None:
+                self.time_to_first_chunk.labels(component=component).observe(
+                    time_to_first_chunk
+                )
+            num_source_tokens = span.attributes.get("num_source_tokens")
+            if num_source_tokens is not None:
+                self.retrieved_source_tokens.observe(num_source_tokens)
+
+    def instrument_engine(self, engine: AsyncEngine) -> None:
+        from sqlalchemy import event
+
+        def count_query(
+            conn: Any,
+            cursor: Any,
+            statement: str,
+            parameters: Any,
+            context: Any,
+            executemany: bool,
+        ) -> None:
+            self.database_queries.labels(
+                statement=statement.lstrip().split(None, 1)[0].upper()
+            ).inc()
+
+        event.listen(engine.sync_engine, "before_cursor_execute", count_query)
+
+    def middleware(self, app: ASGIApp) -> ASGIApp:
+        """Wraps an ASGI app to record its HTTP requests.
+
+        Pass this to `app.add_middleware`.
+        """
+        return MetricsMiddleware(app, metrics=self)
+
+
+class MetricsMiddleware:
+    """ASGI middleware that records the HTTP requests.
+
+    In contrast to a `BaseHTTPMiddleware`, this doesn't buffer streaming responses.
+    Thus, their duration includes streaming the full response.
+
+    Args:
+        app: ASGI app to wrap.
+        metrics: Metrics to record the requests in.
+    """
+
+    def __init__(self, app: ASGIApp, *, metrics: ApiMetrics) -> None:
+        self._app = app
+        self._metrics = metrics
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self._app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_progress = self._metrics.http_requests_in_progress.labels(method=method)
+        in_progress.inc()
+        start = time.perf_counter()
+        try:
+            await self._app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope. Labeling by its path
+            # template rather than the actual path keeps the number of label values
+            # bounded.
+            route = scope.get("route")
+            self._metrics.http_request_duration.labels(
+                method=method,
+                route=getattr(route, "path", "<unmatched>"),
+                status=str(status),
+            ).observe(time.perf_counter() - start)
+            in_progress.dec()
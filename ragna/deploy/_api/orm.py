@@ -1,8 +1,10 @@
-from sqlalchemy import Column, ForeignKey, Table, types
+from sqlalchemy import Column, ForeignKey, Index, Table, types
 from sqlalchemy.orm import DeclarativeBase, relationship  # type: ignore[attr-defined]
 
 from ragna.core import MessageRole
 
+from .schemas import JobStage, JobStatus
+
 
 class Base(DeclarativeBase):
     pass
@@ -62,6 +64,7 @@ class Chat(Base):
     params = Column(types.JSON)
     messages = relationship("Message", cascade="all, delete")
     prepared = Column(types.Boolean)
+    jobs = relationship("Job", back_populates="chat", cascade="all, delete")
 
 
 source_message_association_table = Table(
@@ -105,3 +108,30 @@ class Message(Base):
         back_populates="messages",
     )
     timestamp = Column(types.DateTime)
+
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(types.Uuid, primary_key=True)  # type: ignore[attr-defined]
+    chat_id = Column(ForeignKey("chats.id"))
+    chat = relationship("Chat", back_populates="jobs")
+    status = Column(types.Enum(JobStatus))
+    stage = Column(types.Enum(JobStage))
+    # Storing is resumed from here in case the job was interrupted.
+    stored_document_ids = Column(types.JSON)
+    error = Column(types.String)
+
+
+# A chat can only have a single unfinished job. Enforcing this in the database makes
+# concurrent requests to prepare the same chat safe.
+_unfinished_job = Job.status.in_(  # type: ignore[attr-defined]
+    [JobStatus.PENDING, JobStatus.RUNNING]
+)
+Index(
+    "ix_jobs_unfinished_chat_id",
+    Job.chat_id,
+    unique=True,
+    sqlite_where=_unfinished_job,
+    postgresql_where=_unfinished_job,
+)
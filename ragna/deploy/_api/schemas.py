@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import datetime
+import enum
 import uuid
-from typing import Any
+from typing import Any, Optional
 
 from pydantic import BaseModel, Field
 
@@ -56,6 +57,7 @@ class Message(BaseModel):
     timestamp: datetime.datetime = Field(
         default_factory=lambda: datetime.datetime.utcnow()
     )
+    timings: list[ragna.core.Span] = Field(default_factory=list)
 
     @classmethod
     def from_core(cls, message: ragna.core.Message) -> Message:
@@ -63,6 +65,7 @@ class Message(BaseModel):
             content=message.content,
             role=message.role,
             sources=[Source.from_core(source) for source in message.sources],
+            timings=message.timings,
         )
 
 
@@ -84,3 +87,36 @@ class Chat(BaseModel):
 class MessageOutput(BaseModel):
     message: Message
     chat: Chat
+
+
+class JobStatus(enum.Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    @property
+    def done(self) -> bool:
+        return self not in {JobStatus.PENDING, JobStatus.RUNNING}
+
+
+class JobStage(enum.Enum):
+    QUEUED = "queued"
+    STORING = "storing"
+    FINALIZING = "finalizing"
+    DONE = "done"
+
+
+class JobDocument(BaseModel):
+    document: Document
+    stored: bool = False
+
+
+class Job(BaseModel):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4)
+    chat_id: uuid.UUID
+    status: JobStatus = JobStatus.PENDING
+    stage: JobStage = JobStage.QUEUED
+    documents: list[JobDocument]
+    error: Optional[str] = None
@@ -143,3 +143,53 @@ def ui(
         if process is not None:
             process.kill()
             process.communicate()
+
+
+@app.command(
+    help=(
+        "Start an embedding service that batches the embedding calls of the source "
+        "storages of multiple processes, e.g. API workers. "
+        "Set RAGNA_EMBEDDING_SERVICE_ADDRESS in the environment of these processes to "
+        "use it."
+    )
+)
+def embedding_service(
+    *,
+    address: Annotated[
+        Optional[str],
+        typer.Option(
+            help=(
+                "Address to listen on. Either <HOST>:<PORT> or the path of a Unix "
+                "domain socket."
+            ),
+            envvar="RAGNA_EMBEDDING_SERVICE_ADDRESS",
+            show_default="<LOCAL_ROOT>/embedding-service.sock",
+        ),
+    ] = None,
+    max_batch_size: Annotated[
+        int, typer.Option(help="Maximum number of texts per batch.")
+    ] = 64,
+    max_wait: Annotated[
+        float,
+        typer.Option(
+            help="Maximum time in seconds to wait for more calls to fill a batch."
+        ),
+    ] = 0.005,
+) -> None:
+    from ragna.source_storages._embedding_cache import load_default_embedding_function
+    from ragna.source_storages._embedding_service import (
+        EmbeddingServer,
+        default_address,
+    )
+
+    server = EmbeddingServer(
+        load_default_embedding_function(),
+        address=address or default_address(),
+        max_batch_size=max_batch_size,
+        max_wait=max_wait,
+    )
+    rich.print(f"Embedding service listening on {server.address}")
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
@@ -4,7 +4,7 @@ from pathlib import Path
 from typing import Type, Union
 
 import tomlkit
-from pydantic import Field, ImportString, field_validator
+from pydantic import BaseModel, Field, ImportString, field_validator
 from pydantic_settings import (
     BaseSettings,
     PydanticBaseSettingsSource,
@@ -41,6 +41,11 @@ class ConfigBase(BaseSettings):
         return env_settings, init_settings
 
 
+class ExecutorConfig(BaseModel):
+    max_workers: int = 40
+    processes: bool = False
+
+
 class ComponentsConfig(ConfigBase):
     model_config = SettingsConfigDict(env_prefix="ragna_core_")
 
@@ -50,6 +55,11 @@ class ComponentsConfig(ConfigBase):
     assistants: list[ImportString[type[Assistant]]] = [
         "ragna.assistants.RagnaDemoAssistant"  # type: ignore[list-item]
     ]
+    # Dedicated executors for the synchronous methods of the components keyed by the
+    # display name of the component and the method name, e.g.
+    # [components.executors."Ragna/DemoSourceStorage".store]. See
+    # ragna.core.ComponentExecutor for details.
+    executors: dict[str, dict[str, ExecutorConfig]] = Field(default_factory=dict)
 
 
 class ApiConfig(ConfigBase):
@@ -60,6 +70,33 @@ class ApiConfig(ConfigBase):
     # FIXME: this needs to be dynamic for the UI url
     origins: list[str] = ["http://127.0.0.1:31477"]
     database_url: str = "memory"
+    # Connections are only checked out for short transactions and not while waiting
+    # for the components. Thus, the pool can be a lot smaller than the number of
+    # concurrent requests. These are ignored for the in-memory database.
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 30.0
+    # Number of chats that are prepared concurrently in the background.
+    job_workers: int = 2
+    # If enabled, the timings of the individual stages of the RAG pipeline are
+    # attached to the messages. They are not persisted in the database.
+    record_timings: bool = False
+    # Exposes Prometheus metrics under /metrics to authenticated users. Requires the
+    # prometheus-client package.
+    metrics: bool = False
+    # Answers prompts that are semantically similar to a previous prompt on the same
+    # documents from a cache. See ragna.core.SemanticAnswerCache for details.
+    answer_cache: bool = False
+    answer_cache_similarity_threshold: float = 0.95
+    answer_cache_ttl: float = 3600.0
+    # Connection pool shared by all components that talk to remote APIs, e.g. the
+    # assistants. See ragna.core.HttpClientPool for details.
+    http_max_connections: int = 100
+    http_max_keepalive_connections: int = 20
+    http_keepalive_expiry: float = 30.0
+    http2: bool = False
+    http_connect_timeout: float = 10.0
+    http_read_timeout: float = 60.0
 
 
 class UiConfig(ConfigBase):
@@ -1,3 +1,5 @@
+import asyncio
+import json
 import re
 from datetime import datetime
 
@@ -63,24 +65,16 @@ class ApiWrapper(param.Parameterized):
         return json_data
 
     async def answer(self, chat_id, prompt):
-        json_data = (
-            (
-                await self.client.post(
-                    f"/chats/{chat_id}/answer",
-                    params={"prompt": prompt},
-                    timeout=None,
-                )
-            )
-            .raise_for_status()
-            .json()
-        )
-
-        json_data["message"] = self.improve_message(json_data["message"])
-        json_data["chat"]["messages"] = [
-            self.improve_message(msg) for msg in json_data["chat"]["messages"]
-        ]
-
-        return json_data
+        async with self.client.stream(
+            "POST",
+            f"/chats/{chat_id}/answer",
+            params={"prompt": prompt, "stream": True},
+            timeout=None,
+        ) as response:
+            response.raise_for_status()
+            async for data in response.aiter_lines():
+                if data:
+                    yield json.loads(data)
 
     async def get_components(self):
         return (await self.client.get("/components")).raise_for_status().json()
@@ -114,9 +108,19 @@ class ApiWrapper(param.Parameterized):
     ):
         chat = await self.start_chat(name, documents, source_storage, assistant, params)
 
-        (
-            await self.client.post(f"/chats/{chat['id']}/prepare", timeout=None)
-        ).raise_for_status()
+        job = (
+            (await self.client.post(f"/chats/{chat['id']}/prepare"))
+            .raise_for_status()
+            .json()
+        )
+        while job["status"] in {"pending", "running"}:
+            await asyncio.sleep(0.5)
+            job = (
+                (await self.client.get(f"/jobs/{job['id']}")).raise_for_status().json()
+            )
+
+        if job["status"] != "succeeded":
+            raise RuntimeError(f"Preparing the chat {job['status']}: {job['error']}")
 
         return chat["id"]
 
@@ -358,15 +358,26 @@ class CentralView(pn.viewable.Viewer):
         self.current_chat["messages"].append({"role": "user", "content": contents})
 
         try:
-            answer = await self.api_wrapper.answer(self.current_chat["id"], contents)
-
-            self.current_chat["messages"].append(answer["message"])
+            answer = None
+            async for answer_chunk in self.api_wrapper.answer(
+                self.current_chat["id"], contents
+            ):
+                if answer is None:
+                    answer = answer_chunk
+                else:
+                    answer["content"] += answer_chunk["content"]
+
+                yield {
+                    "user": "Ragna",
+                    "avatar": "🤖",
+                    "value": self.api_wrapper.replace_emoji_shortcodes_with_emoji(
+                        answer["content"]
+                    ),
+                }
 
-            yield {
-                "user": "Ragna",
-                "avatar": "🤖",
-                "value": answer["message"]["content"],
-            }
+            self.current_chat["messages"].append(
+                self.api_wrapper.improve_message(answer)
+            )
         except Exception as e:
             print(e)
 
@@ -1,12 +1,18 @@
 __all__ = [
     "Chroma",
+    "FlatIndex",
+    "IvfPqIndex",
     "LanceDB",
+    "QuantizedFlatIndex",
     "RagnaDemoSourceStorage",
 ]
 
 from ._chroma import Chroma
 from ._demo import RagnaDemoSourceStorage
+from ._flat_index import FlatIndex
+from ._ivf_pq import IvfPqIndex
 from ._lancedb import LanceDB
+from ._quantized_index import QuantizedFlatIndex
 
 # isort: split
 
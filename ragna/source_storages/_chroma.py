@@ -1,17 +1,36 @@
+import functools
+import inspect
+import os
 import uuid
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, TypeVar, Union
+from urllib.parse import urlsplit
+
+import anyio
 
 import ragna
 from ragna.core import (
     Document,
     Source,
+    span,
 )
 
-from ._vector_database import VectorDatabaseSourceStorage
+from ._vector_database import Hit, VectorDatabaseSourceStorage
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+T = TypeVar("T")
 
 
 class Chroma(VectorDatabaseSourceStorage):
     """[Chroma vector database](https://www.trychroma.com/)
 
+    By default, the database is stored locally. Set the `RAGNA_CHROMA_URL`
+    environment variable, e.g. to `http://localhost:8000`, to connect to a Chroma
+    server instead. With `chromadb>=0.5` the server is accessed through the async
+    HTTP client, such that retrieving sources doesn't need any worker threads.
+
     !!! info "Required packages"
 
         - `chromadb>=0.4.13`
@@ -25,88 +44,261 @@ class Chroma(VectorDatabaseSourceStorage):
 
         import chromadb
 
-        self._client = chromadb.Client(
-            chromadb.config.Settings(
-                is_persistent=True,
-                persist_directory=str(ragna.local_root() / "chroma"),
-                anonymized_telemetry=False,
+        self._client: Any = None
+        url = os.environ.get("RAGNA_CHROMA_URL")
+        if url is None:
+            self._client = chromadb.Client(
+                chromadb.config.Settings(
+                    is_persistent=True,
+                    persist_directory=str(ragna.local_root() / "chroma"),
+                    anonymized_telemetry=False,
+                )
             )
+            return
+
+        components = urlsplit(url)
+        ssl = components.scheme == "https"
+        self._http_params: dict[str, Any] = dict(
+            host=components.hostname or "localhost",
+            port=components.port or (443 if ssl else 8000),
+            ssl=ssl,
+            settings=chromadb.config.Settings(anonymized_telemetry=False),
+        )
+        if not hasattr(chromadb, "AsyncHttpClient"):
+            # The async client is only available for chromadb>=0.5.
+            self._client = chromadb.HttpClient(**self._http_params)
+
+    async def _get_client(self) -> Any:
+        if self._client is None:
+            import chromadb
+
+            # The async client can only be created inside an event loop.
+            self._client = await chromadb.AsyncHttpClient(  # type: ignore[attr-defined]
+                **self._http_params
+            )
+        return self._client
+
+    async def _call(
+        self, fn: Callable[..., Union[T, Awaitable[T]]], *args: Any, **kwargs: Any
+    ) -> T:
+        # Methods of the async HTTP client are awaited directly. Methods of the
+        # synchronous clients are run in a worker thread to not block the event loop.
+        if inspect.iscoroutinefunction(fn):
+            return await fn(*args, **kwargs)  # type: ignore[no-any-return]
+        return await anyio.to_thread.run_sync(
+            functools.partial(fn, *args, **kwargs)  # type: ignore[arg-type]
         )
 
-    def store(
+    async def store(
         self,
         documents: list[Document],
         *,
         chat_id: uuid.UUID,
         chunk_size: int = 500,
         chunk_overlap: int = 250,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
     ) -> None:
-        collection = self._client.create_collection(
-            str(chat_id), embedding_function=self._embedding_function
+        collection_name = (
+            self._shared_collection_name(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            if shared_index
+            else str(chat_id)
+        )
+        client = await self._get_client()
+        collection = await self._call(
+            client.get_or_create_collection,
+            collection_name,
+            embedding_function=self._embedding_function,
+        )
+        if shared_index:
+            # Documents that are already part of the shared collection, e.g. because
+            # they were used in a previous chat, don't need to be indexed again.
+            keyword_index = (
+                self._keyword_index(collection_name) if hybrid_search else None
+            )
+            documents = [
+                document
+                for document in documents
+                if not await self._is_stored(collection, document)
+                or (keyword_index is not None and str(document.id) not in keyword_index)
+            ]
+        else:
+            # Storing a document again replaces its previous chunks.
+            for document in documents:
+                await self._call(
+                    collection.delete, where={"document_id": str(document.id)}
+                )
+
+        # Chunking and embedding is CPU bound and thus run in a worker thread.
+        (
+            ids,
+            texts,
+            embeddings,
+            metadatas,
+            keyword_chunks,
+        ) = await anyio.to_thread.run_sync(
+            functools.partial(
+                self._chunk_documents,
+                documents,
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+            )
+        )
+
+        if ids:
+            # Upserting makes concurrent stores of the same document into a shared
+            # collection idempotent.
+            await self._call(
+                collection.upsert,
+                ids=ids,
+                embeddings=embeddings,
+                documents=texts,
+                metadatas=metadatas,
+            )
+            if shared_index:
+                # The first chunk of every document is only marked as stored after
+                # all of its chunks were written. Thus, a document whose store was
+                # interrupted is stored again by the next chat.
+                first_chunks: dict[str, tuple[str, dict[str, Any]]] = {}
+                for id, metadata in zip(ids, metadatas):
+                    first_chunks.setdefault(metadata["document_id"], (id, metadata))
+                await self._call(
+                    collection.update,
+                    ids=[id for id, _ in first_chunks.values()],
+                    metadatas=[
+                        dict(metadata, stored=True)
+                        for _, metadata in first_chunks.values()
+                    ],
+                )
+
+        if hybrid_search and keyword_chunks:
+            await anyio.to_thread.run_sync(
+                functools.partial(
+                    self._index_keywords, collection_name, keyword_chunks, replace=True
+                )
+            )
+
+    async def _is_stored(self, collection: Any, document: Document) -> bool:
+        result = await self._call(
+            collection.get,
+            where={"$and": [{"document_id": str(document.id)}, {"stored": True}]},
+            limit=1,
+            include=[],
         )
+        return bool(result["ids"])
 
+    def _chunk_documents(
+        self, documents: list[Document], *, chunk_size: int, chunk_overlap: int
+    ) -> tuple[
+        list[str],
+        list[str],
+        list[list[float]],
+        list[dict[str, Any]],
+        dict[str, tuple[list[str], list["npt.NDArray[np.uint32]"]]],
+    ]:
         ids = []
         texts = []
         metadatas = []
+        keyword_chunks: dict[str, tuple[list[str], list["npt.NDArray[np.uint32]"]]] = {}
         for document in documents:
-            for chunk in self._chunk_pages(
-                document.extract_pages(),
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
+            chunk_ids: list[str] = []
+            chunk_tokens: list["npt.NDArray[np.uint32]"] = []
+            keyword_chunks[str(document.id)] = (chunk_ids, chunk_tokens)
+            for idx, chunk in enumerate(
+                self._chunk_pages(
+                    document.extract_pages(),
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                )
             ):
-                ids.append(str(uuid.uuid4()))
+                id = self._chunk_id(
+                    document.id,
+                    idx,
+                    chunk_size=chunk_size,
+                    chunk_overlap=chunk_overlap,
+                )
+                ids.append(id)
+                chunk_ids.append(id)
+                chunk_tokens.append(chunk.tokens)
                 texts.append(chunk.text)
                 metadatas.append(
                     {
                         "document_id": str(document.id),
                         "page_numbers": self._page_numbers_to_str(chunk.page_numbers),
                         "num_tokens": chunk.num_tokens,
+                        "start": chunk.start,
+                        "stop": chunk.stop,
                     }
                 )
 
-        collection.add(
-            ids=ids,
-            documents=texts,
-            metadatas=metadatas,  # type: ignore[arg-type]
-        )
+        embeddings = self._embed(texts).tolist() if texts else []
+        return ids, texts, embeddings, metadatas, keyword_chunks
 
-    def retrieve(
+    async def retrieve(
         self,
         documents: list[Document],
         prompt: str,
         *,
         chat_id: uuid.UUID,
         chunk_size: int = 500,
+        chunk_overlap: int = 250,
         num_tokens: int = 1024,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
     ) -> list[Source]:
-        collection = self._client.get_collection(
-            str(chat_id), embedding_function=self._embedding_function
+        if shared_index:
+            collection_name = self._shared_collection_name(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            document_ids: Optional[list[str]] = [
+                str(document.id) for document in documents
+            ]
+            where = {"document_id": {"$in": document_ids}}
+        else:
+            collection_name = str(chat_id)
+            document_ids = None
+            where = None
+        client = await self._get_client()
+        collection = await self._call(
+            client.get_collection,
+            collection_name,
+            embedding_function=self._embedding_function,
         )
 
-        result = collection.query(
-            query_texts=prompt,
-            n_results=min(
-                # We cannot retrieve source by a maximum number of tokens. Thus, we
-                # estimate how many sources we have to query. We overestimate by a
-                # factor of two to avoid retrieving to few sources and needed to query
-                # again.
-                # ---
-                # FIXME: querying only a low number of documents can lead to not finding
-                #  the most relevant one.
-                #  See https://github.com/chroma-core/chroma/issues/1205 for details.
-                #  Instead of just querying more documents here, we should use the
-                #  appropriate index parameters when creating the collection. However,
-                #  they are undocumented for now.
-                max(int(num_tokens * 2 / chunk_size), 100),
-                collection.count(),
-            ),
-            include=["distances", "metadatas", "documents"],
+        n_results = min(
+            # We cannot retrieve source by a maximum number of tokens. Thus, we
+            # estimate how many sources we have to query. We overestimate by a
+            # factor of two to avoid retrieving to few sources and needed to query
+            # again.
+            # ---
+            # FIXME: querying only a low number of documents can lead to not finding
+            #  the most relevant one.
+            #  See https://github.com/chroma-core/chroma/issues/1205 for details.
+            #  Instead of just querying more documents here, we should use the
+            #  appropriate index parameters when creating the collection. However,
+            #  they are undocumented for now.
+            max(int(num_tokens * 2 / chunk_size), 100),
+            # If the shared collection holds fewer chunks of the chat's documents,
+            # Chroma only returns the ones that match the filter.
+            await self._call(collection.count),
         )
+        query_embedding = await self._aembed_query(prompt)
+        with span("search") as search_span:
+            query_result = await self._call(
+                collection.query,
+                query_embeddings=query_embedding.tolist(),
+                n_results=n_results,
+                where=where,
+                include=["distances", "metadatas", "documents"],
+            )
+            num_results = len(query_result["ids"][0])
+            search_span.set(num_results=num_results)
 
-        num_results = len(result["ids"][0])
         result = {
-            key: [None] * num_results if value is None else value[0]  # type: ignore[index]
-            for key, value in result.items()
+            key: [None] * num_results if value is None else value[0]
+            for key, value in query_result.items()
         }
         # dict of lists -> list of dicts
         results = [
@@ -124,16 +316,45 @@ class Chroma(VectorDatabaseSourceStorage):
         #  Thus, we likely need to have a callable parameter for this class
 
         document_map = {str(document.id): document for document in documents}
-        return self._take_sources_up_to_max_tokens(
-            (
-                Source(
-                    id=result["id"],
-                    document=document_map[result["metadata"]["document_id"]],
-                    location=result["metadata"]["page_numbers"],
-                    content=result["document"],
-                    num_tokens=result["metadata"]["num_tokens"],
+        hits = [self._hit(result, document_map) for result in results]
+        if hybrid_search:
+
+            async def get_hits(ids: list[str]) -> list[Hit]:
+                get_result = await self._call(
+                    collection.get, ids=ids, include=["metadatas", "documents"]
                 )
-                for result in results
+                return [
+                    self._hit(
+                        dict(id=id, metadata=metadata, document=document),
+                        document_map,
+                    )
+                    for id, metadata, document in zip(
+                        get_result["ids"],
+                        get_result["metadatas"],
+                        get_result["documents"],
+                    )
+                ]
+
+            hits = await self._ahybrid_hits(
+                collection_name,
+                prompt,
+                hits,
+                limit=n_results,
+                document_ids=document_ids,
+                get_hits=get_hits,
+            )
+
+        return self._take_sources_up_to_max_tokens(hits, max_tokens=num_tokens)
+
+    def _hit(self, result: dict[str, Any], document_map: dict[str, Document]) -> Hit:
+        return Hit(
+            Source(
+                id=result["id"],
+                document=document_map[result["metadata"]["document_id"]],
+                location=result["metadata"]["page_numbers"],
+                content=result["document"],
+                num_tokens=result["metadata"]["num_tokens"],
             ),
-            max_tokens=num_tokens,
+            start=result["metadata"].get("start"),
+            stop=result["metadata"].get("stop"),
         )
@@ -22,8 +22,14 @@ class RagnaDemoSourceStorage(SourceStorage):
     def __init__(self) -> None:
         self._storage: dict[uuid.UUID, list[Source]] = {}
 
-    def store(self, documents: list[Document], *, chat_id: uuid.UUID) -> None:
+    async def store(self, documents: list[Document], *, chat_id: uuid.UUID) -> None:
+        document_ids = {document.id for document in documents}
         self._storage[chat_id] = [
+            source
+            for source in self._storage.get(chat_id, [])
+            if source.document.id not in document_ids
+        ]
+        self._storage[chat_id].extend(
             Source(
                 id=str(uuid.uuid4()),
                 document=document,
@@ -34,9 +40,9 @@ class RagnaDemoSourceStorage(SourceStorage):
                 num_tokens=len(content.split()),
             )
             for document in documents
-        ]
+        )
 
-    def retrieve(
+    async def retrieve(
         self, documents: list[Document], prompt: str, *, chat_id: uuid.UUID
     ) -> list[Source]:
         return self._storage[chat_id]
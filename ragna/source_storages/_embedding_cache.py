@@ -0,0 +1,482 @@
+from __future__ import annotations
+
+import collections
+import contextlib
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Generic,
+    Hashable,
+    Iterator,
+    Optional,
+    TypeVar,
+    cast,
+)
+
+import anyio
+
+import ragna
+from ragna.core import RagnaException, span
+
+from ._embedding_service import EmbeddingFunction, get_embedding_function
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LruCache(Generic[K, V]):
+    """Thread-safe in-memory LRU cache with hit / miss counters."""
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._data: collections.OrderedDict[K, V] = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: K) -> Optional[V]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key: K, value: V) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self),
+        )
+
+
+class EmbeddingCache:
+    """Persistent cache for embeddings keyed by the hash of the embedded text.
+
+    The embeddings are stored in a memory-mapped float32 matrix, while an SQLite index
+    maps the text hashes to the rows of the matrix and tracks their last usage. If the
+    cache is full, the least recently used embeddings are evicted.
+
+    Args:
+        root: Directory to store the cache in. Should be unique per embedding model.
+        dimensions: Number of dimensions of the embeddings.
+        max_size: Maximum number of embeddings to keep.
+    """
+
+    def __init__(self, root: Path, *, dimensions: int, max_size: int) -> None:
+        root.mkdir(parents=True, exist_ok=True)
+        self._dimensions = dimensions
+        self._max_size = max_size
+        self._lock = threading.Lock()
+
+        # We handle the transactions manually to be able to write the embeddings
+        # before they are visible to other processes through the index.
+        self._index = sqlite3.connect(
+            root / "index.sqlite", check_same_thread=False, isolation_level=None
+        )
+        self._index.execute("PRAGMA journal_mode=WAL")
+        self._index.execute("PRAGMA synchronous=NORMAL")
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key BLOB PRIMARY KEY, slot INTEGER NOT NULL UNIQUE, last_used REAL NOT NULL"
+            ")"
+        )
+        self._index.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+
+        self._vectors_path = root / "vectors.f32"
+        self._vectors_path.touch()
+        self._vectors = self._open_vectors()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    _ITEM_SIZE = 4
+
+    def _open_vectors(self) -> Optional[np.memmap]:
+        import numpy as np
+
+        num_rows = self._vectors_path.stat().st_size // (
+            self._ITEM_SIZE * self._dimensions
+        )
+        if num_rows == 0:
+            return None
+
+        return np.memmap(
+            self._vectors_path,
+            dtype=np.float32,
+            mode="r+",
+            shape=(num_rows, self._dimensions),
+        )
+
+    def _ensure_capacity(self, num_rows: int) -> np.memmap:
+        vectors = self._vectors
+        if vectors is None or vectors.shape[0] < num_rows:
+            capacity = 0 if vectors is None else vectors.shape[0]
+            # Grow geometrically to avoid resizing the file on every insert.
+            capacity = min(max(num_rows, 2 * capacity, 1024), self._max_size)
+            with open(self._vectors_path, "r+b") as file:
+                file.truncate(capacity * self._ITEM_SIZE * self._dimensions)
+            vectors = self._vectors = self._open_vectors()
+
+        return vectors  # type: ignore[return-value]
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.sha256(text.encode()).digest()
+
+    _MAX_SQL_VARIABLES = 500
+
+    def get_many(self, keys: list[bytes]) -> dict[bytes, npt.NDArray[np.float32]]:
+        import numpy as np
+
+        # The lookup, the usage update, and the copy of the vectors happen in a single
+        # transaction. Otherwise, another process could evict an embedding and reuse
+        # its slot before we read it.
+        with self._lock, self._transaction():
+            slots: dict[bytes, int] = {}
+            for idx in range(0, len(keys), self._MAX_SQL_VARIABLES):
+                batch = keys[idx : idx + self._MAX_SQL_VARIABLES]
+                slots.update(
+                    self._index.execute(
+                        "SELECT key, slot FROM embeddings "
+                        f"WHERE key IN ({', '.join('?' * len(batch))})",
+                        batch,
+                    ).fetchall()
+                )
+
+            if slots:
+                now = time.time()
+                self._index.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(now, key) for key in slots],
+                )
+
+            self.hits += len(slots)
+            self.misses += len(set(keys)) - len(slots)
+
+            if self._vectors is None or (
+                slots and max(slots.values()) >= self._vectors.shape[0]
+            ):
+                # Another process might have grown the file in the meantime.
+                self._vectors = self._open_vectors()
+
+            return {
+                key: np.array(self._vectors[slot])  # type: ignore[index]
+                for key, slot in slots.items()
+            }
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[None]:
+        self._index.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            self._index.execute("ROLLBACK")
+            raise
+        else:
+            self._index.execute("COMMIT")
+
+    def put_many(self, embeddings: dict[bytes, npt.NDArray[np.float32]]) -> None:
+        with self._lock, self._transaction():
+            self._put_many(embeddings)
+
+    def _put_many(self, embeddings: dict[bytes, npt.NDArray[np.float32]]) -> None:
+        keys = list(embeddings.keys())
+        existing: set[bytes] = set()
+        for idx in range(0, len(keys), self._MAX_SQL_VARIABLES):
+            batch = keys[idx : idx + self._MAX_SQL_VARIABLES]
+            existing.update(
+                key
+                for (key,) in self._index.execute(
+                    "SELECT key FROM embeddings "
+                    f"WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        keys = [key for key in keys if key not in existing][-self._max_size :]
+        if not keys:
+            return
+
+        (num_rows,) = self._index.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        # Slots are always densely packed, since we only free them by evicting
+        # embeddings and immediately reuse them afterwards.
+        slots = list(range(num_rows, min(num_rows + len(keys), self._max_size)))
+        num_evictions = len(keys) - len(slots)
+        if num_evictions > 0:
+            evicted = self._index.execute(
+                "SELECT key, slot FROM embeddings ORDER BY last_used LIMIT ?",
+                (num_evictions,),
+            ).fetchall()
+            self._index.executemany(
+                "DELETE FROM embeddings WHERE key = ?", [(key,) for key, _ in evicted]
+            )
+            slots.extend(slot for _, slot in evicted)
+            self.evictions += len(evicted)
+
+        vectors = self._ensure_capacity(max(slots) + 1)
+        for key, slot in zip(keys, slots):
+            vectors[slot] = embeddings[key]
+        vectors.flush()
+
+        now = time.time()
+        self._index.executemany(
+            "INSERT INTO embeddings (key, slot, last_used) VALUES (?, ?, ?)",
+            [(key, slot, now) for key, slot in zip(keys, slots)],
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            (size,) = self._index.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return int(size)
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self),
+        )
+
+
+# At 384 dimensions, this amounts to roughly 75 MB on disk.
+DEFAULT_EMBEDDING_CACHE_SIZE = 50_000
+
+
+class CachedEmbedder:
+    """Embeds texts and caches the results.
+
+    Embeddings of stored texts are cached persistently, while embeddings of queries
+    are only cached in memory.
+
+    Args:
+        embedding_function: Embeds a batch of texts.
+        model: Name of the embedding model. Used to separate the caches of different
+            models.
+        dimensions: Number of dimensions of the embeddings.
+        cache_root: Root directory of the persistent caches.
+        max_size: Maximum number of embeddings to keep in the persistent cache. Use `0`
+            to disable it.
+        max_query_size: Maximum number of query embeddings to keep in memory.
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        *,
+        model: str,
+        dimensions: int,
+        cache_root: Path,
+        max_size: int = DEFAULT_EMBEDDING_CACHE_SIZE,
+        max_query_size: int = 4_096,
+    ) -> None:
+        self._embedding_function = embedding_function
+        self._dimensions = dimensions
+        self._cache = (
+            EmbeddingCache(cache_root / model, dimensions=dimensions, max_size=max_size)
+            if max_size > 0
+            else None
+        )
+        self._query_cache: LruCache[str, npt.NDArray[np.float32]] = LruCache(
+            max_query_size
+        )
+
+    def embed(self, texts: list[str]) -> npt.NDArray[np.float32]:
+        import numpy as np
+
+        with span("embed", num_texts=len(texts)) as embed_span:
+            keys = [EmbeddingCache.key(text) for text in texts]
+            embeddings = self._cache.get_many(keys) if self._cache is not None else {}
+
+            missing = {
+                key: text for key, text in zip(keys, texts) if key not in embeddings
+            }
+            if missing:
+                new_embeddings = dict(
+                    zip(
+                        missing.keys(),
+                        np.asarray(
+                            self._embedding_function(list(missing.values())),
+                            dtype=np.float32,
+                        ),
+                    )
+                )
+                if self._cache is not None:
+                    self._cache.put_many(new_embeddings)
+                embeddings.update(new_embeddings)
+            embed_span.set(num_cached=len(texts) - len(missing))
+
+        if not texts:
+            return np.empty((0, self._dimensions), dtype=np.float32)
+
+        return np.stack([embeddings[key] for key in keys])
+
+    def embed_query(self, query: str) -> npt.NDArray[np.float32]:
+        import numpy as np
+
+        with span("embed_query") as embed_span:
+            embedding = self._query_cache.get(query)
+            embed_span.set(cached=embedding is not None)
+            if embedding is None:
+                embedding = np.asarray(
+                    self._embedding_function([query])[0], dtype=np.float32
+                )
+                self._query_cache.put(query, embedding)
+        return embedding
+
+    async def aembed_query(self, query: str) -> npt.NDArray[np.float32]:
+        # Same as embed_query(), but without blocking the event loop. If the embedding
+        # function supports it, e.g. BatchingEmbeddingFunction, the embedding is
+        # awaited directly. Otherwise, it is computed in a worker thread.
+        import numpy as np
+
+        with span("embed_query") as embed_span:
+            embedding = self._query_cache.get(query)
+            embed_span.set(cached=embedding is not None)
+            if embedding is None:
+                aembed = getattr(self._embedding_function, "aembed", None)
+                embeddings = (
+                    await aembed([query])
+                    if aembed is not None
+                    else await anyio.to_thread.run_sync(
+                        functools.partial(self._embedding_function, [query])
+                    )
+                )
+                embedding = np.asarray(embeddings[0], dtype=np.float32)
+                self._query_cache.put(query, embedding)
+        return embedding
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        return dict(
+            documents=(
+                self._cache.stats()
+                if self._cache is not None
+                else dict(hits=0, misses=0, evictions=0, size=0)
+            ),
+            queries=self._query_cache.stats(),
+        )
+
+
+def embedding_cache_size() -> int:
+    """Returns the maximum number of embeddings to keep in the persistent cache.
+
+    It is set through the `RAGNA_EMBEDDING_CACHE_SIZE` environment variable and
+    defaults to `50_000`. A size of `0` disables the persistent cache.
+    """
+    value = os.environ.get("RAGNA_EMBEDDING_CACHE_SIZE")
+    if value is None:
+        return DEFAULT_EMBEDDING_CACHE_SIZE
+
+    try:
+        size = int(value)
+    except ValueError:
+        size = -1
+    if size < 0:
+        raise RagnaException(
+            "RAGNA_EMBEDDING_CACHE_SIZE has to be a non-negative integer",
+            value=value,
+        )
+    return size
+
+
+_EMBEDDERS: dict[tuple[Path, str], CachedEmbedder] = {}
+_EMBEDDERS_LOCK = threading.Lock()
+
+
+def get_cached_embedder(
+    embedding_function: EmbeddingFunction,
+    *,
+    model: str,
+    dimensions: int,
+    cache_root: Path,
+    max_size: int = DEFAULT_EMBEDDING_CACHE_SIZE,
+) -> CachedEmbedder:
+    # All source storages using the same embedding model share the caches.
+    with _EMBEDDERS_LOCK:
+        key = (cache_root, model)
+        embedder = _EMBEDDERS.get(key)
+        if embedder is None:
+            embedder = _EMBEDDERS[key] = CachedEmbedder(
+                embedding_function,
+                model=model,
+                dimensions=dimensions,
+                cache_root=cache_root,
+                max_size=max_size,
+            )
+        return embedder
+
+
+# https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2#all-minilm-l6-v2
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+DEFAULT_EMBEDDING_DIMENSIONS = 384
+
+
+def load_default_embedding_function() -> EmbeddingFunction:
+    """Loads the model used by the builtin vector database source storages.
+
+    This requires the `chromadb` package.
+    """
+    import chromadb.api
+    import chromadb.utils.embedding_functions
+
+    return cast(
+        chromadb.api.types.EmbeddingFunction,
+        chromadb.utils.embedding_functions.DefaultEmbeddingFunction(),
+    )
+
+
+def get_default_embedding_function() -> EmbeddingFunction:
+    """Returns the shared embedding function of the default model.
+
+    This requires the `chromadb` package, unless an embedding service is used.
+    """
+    return get_embedding_function(
+        DEFAULT_EMBEDDING_MODEL, load_default_embedding_function
+    )
+
+
+def get_default_embedder() -> CachedEmbedder:
+    """Returns the embedder used by the builtin vector database source storages.
+
+    This requires the `chromadb` package.
+    """
+    return get_cached_embedder(
+        get_default_embedding_function(),
+        model=DEFAULT_EMBEDDING_MODEL,
+        dimensions=DEFAULT_EMBEDDING_DIMENSIONS,
+        cache_root=ragna.local_root() / "embeddings",
+        max_size=embedding_cache_size(),
+    )
+
+
+def embedding_cache_stats() -> dict[str, dict[str, dict[str, int]]]:
+    """Returns hit, miss, and eviction counters of all embedding caches by model."""
+    with _EMBEDDERS_LOCK:
+        return {model: embedder.stats() for (_, model), embedder in _EMBEDDERS.items()}
@@ -0,0 +1,351 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import os
+import queue
+import secrets
+import threading
+import time
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Optional, Sequence, Union, cast
+
+import ragna
+from ragna.core import RagnaException
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+EmbeddingFunction = Callable[[list[str]], Sequence[Any]]
+
+
+class BatchingEmbeddingFunction:
+    """Embedding function that combines concurrent calls into micro-batches.
+
+    Calls from multiple threads are queued and embedded together by a single worker
+    thread. A batch is closed as soon as it holds `max_batch_size` texts or
+    `max_wait` seconds passed since its first call arrived. Thus, the fixed overhead
+    of the model is paid once per batch rather than once per call. Calls with more
+    than `max_batch_size` texts are split to avoid blocking small calls, e.g. the
+    query of a retrieval, behind a large document.
+
+    Args:
+        embedding_function: Embeds a batch of texts.
+        max_batch_size: Maximum number of texts per batch.
+        max_wait: Maximum time in seconds to wait for more calls to fill a batch.
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        *,
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+    ) -> None:
+        self._embedding_function = embedding_function
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._queue: queue.SimpleQueue[
+            tuple[list[str], concurrent.futures.Future[list[npt.NDArray[np.float32]]]]
+        ] = queue.SimpleQueue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+
+    def _ensure_worker(self) -> None:
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name="ragna-embedding-batcher", daemon=True
+                )
+                self._worker.start()
+
+    def __call__(self, input: list[str]) -> list[npt.NDArray[np.float32]]:
+        # The parameter is named input to satisfy the chromadb.EmbeddingFunction
+        # protocol.
+        if not input:
+            return []
+
+        return [
+            embedding for future in self._submit(input) for embedding in future.result()
+        ]
+
+    async def aembed(self, input: list[str]) -> list[npt.NDArray[np.float32]]:
+        """Same as calling the object, but awaits the batch instead of blocking the
+        calling thread.
+        """
+        if not input:
+            return []
+
+        return [
+            embedding
+            for future in self._submit(input)
+            for embedding in await asyncio.wrap_future(future)
+        ]
+
+    def _submit(
+        self, texts: list[str]
+    ) -> list[concurrent.futures.Future[list[npt.NDArray[np.float32]]]]:
+        self._ensure_worker()
+        futures = []
+        for start in range(0, len(texts), self._max_batch_size):
+            future: concurrent.futures.Future[
+                list[npt.NDArray[np.float32]]
+            ] = concurrent.futures.Future()
+            self._queue.put((texts[start : start + self._max_batch_size], future))
+            futures.append(future)
+        return futures
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            num_texts = len(batch[0][0])
+            deadline = time.monotonic() + self._max_wait
+            while num_texts < self._max_batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = (
+                        self._queue.get(timeout=timeout)
+                        if timeout > 0
+                        else self._queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+                batch.append(item)
+                num_texts += len(item[0])
+
+            # Calls that were cancelled while queued, e.g. by cancelling aembed(), are
+            # dropped. Afterwards, the futures are running and can't be cancelled
+            # anymore.
+            batch = [
+                (texts, future)
+                for texts, future in batch
+                if future.set_running_or_notify_cancel()
+            ]
+            if batch:
+                self._embed_batch(batch)
+
+    def _embed_batch(
+        self,
+        batch: list[
+            tuple[list[str], concurrent.futures.Future[list[npt.NDArray[np.float32]]]]
+        ],
+    ) -> None:
+        import numpy as np
+
+        texts = [text for item_texts, _ in batch for text in item_texts]
+        try:
+            embeddings = np.asarray(self._embedding_function(texts), dtype=np.float32)
+        except Exception as error:
+            for _, future in batch:
+                self._deliver(future, exception=error)
+            return
+
+        start = 0
+        for item_texts, future in batch:
+            stop = start + len(item_texts)
+            self._deliver(future, result=list(embeddings[start:stop]))
+            start = stop
+
+    @staticmethod
+    def _deliver(
+        future: concurrent.futures.Future[list[npt.NDArray[np.float32]]],
+        *,
+        result: Optional[list[npt.NDArray[np.float32]]] = None,
+        exception: Optional[BaseException] = None,
+    ) -> None:
+        # The futures are no longer cancellable once the batch is assembled. Still,
+        # a single future in an unexpected state must never take down the worker and
+        # with it all other calls of the batch.
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(cast(list["npt.NDArray[np.float32]"], result))
+        except concurrent.futures.InvalidStateError:
+            pass
+
+
+Address = Union[str, tuple[str, int]]
+
+
+def parse_address(address: str) -> Address:
+    """Parses `host:port` into a TCP address. Anything else is used as path of a Unix
+    domain socket or Windows named pipe.
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+def default_address() -> str:
+    return str(ragna.local_root() / "embedding-service.sock")
+
+
+def _authkey() -> bytes:
+    # Clients are only accepted if they know the secret, since the messages are
+    # pickled. Without an explicit secret, all processes of a host that share the
+    # same local root share a random secret that is only readable by the user.
+    secret = os.environ.get("RAGNA_EMBEDDING_SERVICE_SECRET")
+    if secret is not None:
+        return secret.encode()
+
+    path = ragna.local_root() / "embedding-service.key"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # The key is written to a temporary file first and linked afterwards, such
+        # that concurrently starting processes never read a partially written key.
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as file:
+            file.write(secrets.token_bytes(32))
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+    return path.read_bytes()
+
+
+class EmbeddingServer:
+    """Serves an embedding function to other processes, e.g. multiple API workers.
+
+    Calls of all clients are embedded by a single `BatchingEmbeddingFunction`, such
+    that the model is only loaded once and concurrent calls of different processes
+    are batched together.
+
+    Args:
+        embedding_function: Embeds a batch of texts.
+        address: Address to listen on. See `RemoteEmbeddingFunction` for the format.
+        max_batch_size: Maximum number of texts per batch.
+        max_wait: Maximum time in seconds to wait for more calls to fill a batch.
+    """
+
+    def __init__(
+        self,
+        embedding_function: EmbeddingFunction,
+        *,
+        address: str,
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+    ) -> None:
+        self._embedding_function = BatchingEmbeddingFunction(
+            embedding_function, max_batch_size=max_batch_size, max_wait=max_wait
+        )
+        parsed_address = parse_address(address)
+        if isinstance(parsed_address, str) and not parsed_address.startswith("\\\\"):
+            # A stale socket of a previous server prevents binding.
+            Path(parsed_address).unlink(missing_ok=True)
+        self._listener = Listener(parsed_address, backlog=128, authkey=_authkey())
+
+    @property
+    def address(self) -> Address:
+        return cast(Address, self._listener.address)
+
+    def serve_forever(self) -> None:
+        while True:
+            try:
+                connection = self._listener.accept()
+            except OSError:
+                # The listener was closed.
+                return
+            except Exception:
+                # For example, a client with a wrong secret.
+                continue
+            threading.Thread(
+                target=self._handle, args=(connection,), daemon=True
+            ).start()
+
+    def _handle(self, connection: Connection) -> None:
+        with connection:
+            while True:
+                try:
+                    texts = connection.recv()
+                except (EOFError, OSError):
+                    return
+
+                response: tuple[bool, Any]
+                try:
+                    response = (True, self._embedding_function(texts))
+                except Exception as error:
+                    response = (False, f"{type(error).__name__}: {error}")
+                connection.send(response)
+
+    def close(self) -> None:
+        self._listener.close()
+
+
+class RemoteEmbeddingFunction:
+    """Embedding function that forwards the calls to an `EmbeddingServer` running in
+    another process.
+
+    Args:
+        address: Address of the server. Either `host:port` for TCP or the path of a
+            Unix domain socket or Windows named pipe.
+    """
+
+    def __init__(self, address: str) -> None:
+        self._address = parse_address(address)
+        self._local = threading.local()
+
+    def _connection(self) -> Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            try:
+                connection = Client(self._address, authkey=_authkey())
+            except OSError as error:
+                raise RagnaException(
+                    "Unable to connect to the embedding service",
+                    address=self._address,
+                    error=str(error),
+                ) from error
+            self._local.connection = connection
+        return cast(Connection, connection)
+
+    def __call__(self, input: list[str]) -> list[npt.NDArray[np.float32]]:
+        if not input:
+            return []
+
+        # Every thread has its own connection. A broken connection, e.g. because the
+        # server was restarted, is re-established once.
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.send(list(input))
+                ok, result = connection.recv()
+                break
+            except (EOFError, OSError):
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+
+        if not ok:
+            raise RagnaException("Embedding service failed", error=result)
+        return cast(list["npt.NDArray[np.float32]"], result)
+
+
+_EMBEDDING_FUNCTIONS: dict[str, EmbeddingFunction] = {}
+_EMBEDDING_FUNCTIONS_LOCK = threading.Lock()
+
+
+def get_embedding_function(
+    model: str, factory: Callable[[], EmbeddingFunction]
+) -> EmbeddingFunction:
+    # The embedding function of a model is shared by all source storages of the
+    # process, such that their calls are batched together. If the
+    # RAGNA_EMBEDDING_SERVICE_ADDRESS environment variable is set, the calls are sent
+    # to an embedding service instead and the model is never loaded in this process.
+    with _EMBEDDING_FUNCTIONS_LOCK:
+        embedding_function = _EMBEDDING_FUNCTIONS.get(model)
+        if embedding_function is None:
+            address = os.environ.get("RAGNA_EMBEDDING_SERVICE_ADDRESS")
+            if address is not None:
+                embedding_function = RemoteEmbeddingFunction(address)
+            else:
+                embedding_function = BatchingEmbeddingFunction(factory())
+            _EMBEDDING_FUNCTIONS[model] = embedding_function
+        return embedding_function
@@ -0,0 +1,448 @@
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, cast
+
+import ragna
+from ragna._utils import file_lock
+from ragna.core import ComponentExecutor, Document, Source, span
+
+from ._vector_database import Hit, VectorDatabaseSourceStorage
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+
+class _Collection:
+    # Immutable snapshot of a stored collection. The embeddings and texts are memory
+    # mapped and thus only paged in when accessed.
+
+    def __init__(self, path: Path) -> None:
+        import numpy as np
+
+        self.path = path
+        self.embeddings: "npt.NDArray[np.float32]" = np.load(
+            path / "embeddings.npy", mmap_mode="r"
+        )
+        with np.load(path / "metadata.npz") as metadata:
+            self.ids: "npt.NDArray[np.str_]" = metadata["ids"]
+            self.document_ids: "npt.NDArray[np.str_]" = metadata["document_ids"]
+            self.page_numbers: "npt.NDArray[np.str_]" = metadata["page_numbers"]
+            self.num_tokens: "npt.NDArray[np.int64]" = metadata["num_tokens"]
+            self.starts: "npt.NDArray[np.int64]" = metadata["starts"]
+            self.stops: "npt.NDArray[np.int64]" = metadata["stops"]
+            self.text_offsets: "npt.NDArray[np.int64]" = metadata["text_offsets"]
+        # np.memmap can't map empty files.
+        self.texts: "npt.NDArray[np.uint8]" = (
+            np.memmap(path / "texts.bin", dtype=np.uint8, mode="r")
+            if self.text_offsets[-1] > 0
+            else np.empty(0, dtype=np.uint8)
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def text_bytes(self, idx: int) -> bytes:
+        return bytes(self.texts[self.text_offsets[idx] : self.text_offsets[idx + 1]])
+
+    def hit(self, idx: int, document_map: dict[str, Document]) -> Hit:
+        return Hit(
+            Source(
+                id=str(self.ids[idx]),
+                document=document_map[str(self.document_ids[idx])],
+                location=str(self.page_numbers[idx]),
+                content=self.text_bytes(idx).decode(),
+                num_tokens=int(self.num_tokens[idx]),
+            ),
+            start=int(self.starts[idx]),
+            stop=int(self.stops[idx]),
+        )
+
+
+class FlatIndex(VectorDatabaseSourceStorage):
+    """Source storage that performs exact search over embeddings kept in NumPy
+    arrays.
+
+    Each collection is stored as a float32 matrix of the normalized embeddings next
+    to a compact metadata file. Both are memory mapped, such that opening a
+    collection is instant and only the accessed pages are read. A search is a single
+    matrix-vector product followed by a partial sort. This is faster than a vector
+    database for small to medium sized chats and has no server or database
+    component.
+
+    !!! info "Required packages"
+
+        - `chromadb>=0.4.13`
+    """
+
+    # Note that this class has no extra requirements, since the chromadb package is
+    # already required for the base class.
+
+    _DIRECTORY_NAME = "flat_index"
+
+    # Storing chunks and embeds whole documents, while retrieving only embeds the
+    # prompt. Thus, stores get their own threads to not delay retrievals.
+    __ragna_executors__ = {"store": ComponentExecutor(max_workers=4)}
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._root = ragna.local_root() / self._DIRECTORY_NAME
+        self._collections: dict[str, _Collection] = {}
+        self._collections_lock = threading.Lock()
+        self._store_locks: dict[str, threading.Lock] = {}
+
+    def _load_collection(self, name: str) -> Optional[_Collection]:
+        # Stores write a new generation of the collection and atomically replace the
+        # pointer to the current one. The previous generation is kept until the next
+        # store. Thus, readers always see a consistent state, even if the store
+        # happened in another process. Only if two stores finish while a reader is
+        # loading, the generation it read is gone already and it has to start over.
+        path = self._root / name
+        for attempt in range(2):
+            try:
+                generation = (path / "CURRENT").read_text()
+            except FileNotFoundError:
+                return None
+
+            with self._collections_lock:
+                collection = self._collections.get(name)
+                if collection is not None and collection.path.name == generation:
+                    return collection
+
+                try:
+                    collection = _Collection(path / generation)
+                except FileNotFoundError:
+                    if attempt:
+                        raise
+                    continue
+
+                self._collections[name] = collection
+                return collection
+
+        raise AssertionError("unreachable")
+
+    def _write_collection(
+        self,
+        name: str,
+        *,
+        embeddings: "npt.NDArray[np.float32]",
+        ids: list[str],
+        document_ids: list[str],
+        page_numbers: list[str],
+        num_tokens: list[int],
+        starts: list[int],
+        stops: list[int],
+        texts: list[bytes],
+        **index_params: Any,
+    ) -> None:
+        import numpy as np
+
+        path = self._root / name
+        generation = uuid.uuid4().hex
+        generation_path = path / generation
+        generation_path.mkdir(parents=True)
+
+        np.save(generation_path / "embeddings.npy", embeddings)
+        text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in texts], out=text_offsets[1:])
+        np.savez(
+            generation_path / "metadata.npz",
+            ids=np.array(ids, dtype=np.str_),
+            document_ids=np.array(document_ids, dtype=np.str_),
+            page_numbers=np.array(page_numbers, dtype=np.str_),
+            num_tokens=np.array(num_tokens, dtype=np.int64),
+            starts=np.array(starts, dtype=np.int64),
+            stops=np.array(stops, dtype=np.int64),
+            text_offsets=text_offsets,
+        )
+        (generation_path / "texts.bin").write_bytes(b"".join(texts))
+        self._write_index(generation_path, embeddings, **index_params)
+
+        try:
+            previous_generation: Optional[str] = (path / "CURRENT").read_text()
+        except FileNotFoundError:
+            previous_generation = None
+        tmp_path = path / f"CURRENT.{generation}"
+        tmp_path.write_text(generation)
+        os.replace(tmp_path, path / "CURRENT")
+
+        # The previous generation is kept for readers that read the pointer right
+        # before it was replaced. Readers that still have an older generation mapped
+        # are not affected on POSIX systems. On Windows the files can't be deleted
+        # while mapped, and we just leave them behind.
+        for old_path in path.iterdir():
+            if old_path.is_dir() and old_path.name not in {
+                generation,
+                previous_generation,
+            }:
+                shutil.rmtree(old_path, ignore_errors=True)
+
+    def _write_index(
+        self, path: Path, embeddings: "npt.NDArray[np.float32]", **index_params: Any
+    ) -> None:
+        # Subclasses can store additional search structures with a generation.
+        pass
+
+    def _normalize(
+        self, embeddings: "npt.NDArray[np.float32]"
+    ) -> "npt.NDArray[np.float32]":
+        import numpy as np
+
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return cast(
+            "npt.NDArray[np.float32]", embeddings / np.where(norms > 0, norms, 1)
+        )
+
+    def store(
+        self,
+        documents: list[Document],
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int = 500,
+        chunk_overlap: int = 250,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
+    ) -> None:
+        self._store(
+            documents,
+            chat_id=chat_id,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            shared_index=shared_index,
+            hybrid_search=hybrid_search,
+        )
+
+    def _store(
+        self,
+        documents: list[Document],
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int,
+        chunk_overlap: int,
+        shared_index: bool,
+        hybrid_search: bool,
+        **index_params: Any,
+    ) -> None:
+        import numpy as np
+
+        name = (
+            self._shared_collection_name(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            if shared_index
+            else str(chat_id)
+        )
+        with self._collections_lock:
+            store_lock = self._store_locks.setdefault(name, threading.Lock())
+
+        # The thread lock serializes the stores of this process, while the file lock
+        # serializes them with the ones of other processes, e.g. other API workers.
+        # Otherwise, concurrent stores into the shared collection would drop each
+        # other's documents.
+        with store_lock, file_lock(self._root / name / "LOCK"):
+            collection = self._load_collection(name)
+            stored_document_ids = (
+                set(collection.document_ids.tolist())
+                if collection is not None
+                else set()
+            )
+            if shared_index:
+                # Documents that are already part of the shared collection, e.g.
+                # because they were used in a previous chat, don't need to be indexed
+                # again.
+                keyword_index = self._keyword_index(name) if hybrid_search else None
+                documents = [
+                    document
+                    for document in documents
+                    if str(document.id) not in stored_document_ids
+                    or (
+                        keyword_index is not None
+                        and str(document.id) not in keyword_index
+                    )
+                ]
+            if not documents:
+                return
+
+            # Storing a document again replaces its previous chunks.
+            replaced_document_ids = [str(document.id) for document in documents]
+            if collection is not None:
+                keep = np.flatnonzero(
+                    ~np.isin(collection.document_ids, replaced_document_ids)
+                )
+                embeddings = [np.asarray(collection.embeddings[keep])]
+                ids = collection.ids[keep].tolist()
+                document_ids = collection.document_ids[keep].tolist()
+                page_numbers = collection.page_numbers[keep].tolist()
+                num_tokens = collection.num_tokens[keep].tolist()
+                starts = collection.starts[keep].tolist()
+                stops = collection.stops[keep].tolist()
+                texts = [collection.text_bytes(idx) for idx in keep.tolist()]
+            else:
+                embeddings = []
+                ids = []
+                document_ids = []
+                page_numbers = []
+                num_tokens = []
+                starts = []
+                stops = []
+                texts = []
+
+            keyword_chunks: dict[
+                str, tuple[list[str], list["npt.NDArray[np.uint32]"]]
+            ] = {}
+            new_texts = []
+            for document in documents:
+                chunk_ids: list[str] = []
+                chunk_tokens: list["npt.NDArray[np.uint32]"] = []
+                keyword_chunks[str(document.id)] = (chunk_ids, chunk_tokens)
+                for idx, chunk in enumerate(
+                    self._chunk_pages(
+                        document.extract_pages(),
+                        chunk_size=chunk_size,
+                        chunk_overlap=chunk_overlap,
+                    )
+                ):
+                    id = self._chunk_id(
+                        document.id,
+                        idx,
+                        chunk_size=chunk_size,
+                        chunk_overlap=chunk_overlap,
+                    )
+                    ids.append(id)
+                    chunk_ids.append(id)
+                    chunk_tokens.append(chunk.tokens)
+                    document_ids.append(str(document.id))
+                    page_numbers.append(self._page_numbers_to_str(chunk.page_numbers))
+                    num_tokens.append(chunk.num_tokens)
+                    starts.append(chunk.start)
+                    stops.append(chunk.stop)
+                    new_texts.append(chunk.text)
+
+            embeddings.append(self._normalize(self._embed(new_texts)))
+            texts.extend(text.encode() for text in new_texts)
+
+            self._write_collection(
+                name,
+                embeddings=np.concatenate(embeddings).astype(np.float32, copy=False),
+                ids=ids,
+                document_ids=document_ids,
+                page_numbers=page_numbers,
+                num_tokens=num_tokens,
+                starts=starts,
+                stops=stops,
+                texts=texts,
+                **index_params,
+            )
+
+            if hybrid_search:
+                self._index_keywords(name, keyword_chunks, replace=True)
+
+    def retrieve(
+        self,
+        documents: list[Document],
+        prompt: str,
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int = 500,
+        chunk_overlap: int = 250,
+        num_tokens: int = 1024,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
+    ) -> list[Source]:
+        return self._retrieve(
+            documents,
+            prompt,
+            chat_id=chat_id,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            num_tokens=num_tokens,
+            shared_index=shared_index,
+            hybrid_search=hybrid_search,
+        )
+
+    def _search(
+        self,
+        collection: _Collection,
+        query_embedding: "npt.NDArray[np.float32]",
+        *,
+        limit: int,
+        document_mask: "Optional[npt.NDArray[np.bool_]]",
+    ) -> "npt.NDArray[np.int64]":
+        import numpy as np
+
+        scores = collection.embeddings @ query_embedding
+        if document_mask is not None:
+            scores[~document_mask] = -np.inf
+        idcs = np.argpartition(-scores, limit - 1)[:limit]
+        idcs = idcs[np.argsort(-scores[idcs], kind="stable")]
+        return cast("npt.NDArray[np.int64]", idcs[np.isfinite(scores[idcs])])
+
+    def _retrieve(
+        self,
+        documents: list[Document],
+        prompt: str,
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int,
+        chunk_overlap: int,
+        num_tokens: int,
+        shared_index: bool,
+        hybrid_search: bool,
+        **search_params: Any,
+    ) -> list[Source]:
+        import numpy as np
+
+        name = (
+            self._shared_collection_name(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            if shared_index
+            else str(chat_id)
+        )
+        collection = self._load_collection(name)
+        if collection is None or not len(collection):
+            return []
+
+        document_ids = (
+            [str(document.id) for document in documents] if shared_index else None
+        )
+        # The cost of the search barely depends on the number of results. Thus, we
+        # can be generous here.
+        limit = min(max(int(num_tokens * 2 / chunk_size), 100), len(collection))
+        query_embedding = self._normalize(self._embed_query(prompt))
+        with span("search") as search_span:
+            idcs = self._search(
+                collection,
+                query_embedding,
+                limit=limit,
+                document_mask=(
+                    np.isin(collection.document_ids, document_ids)
+                    if document_ids is not None
+                    else None
+                ),
+                **search_params,
+            )
+            search_span.set(num_results=len(idcs))
+
+        document_map = {str(document.id): document for document in documents}
+        hits = [collection.hit(idx, document_map) for idx in idcs.tolist()]
+        if hybrid_search:
+            idx_map = {id: idx for idx, id in enumerate(collection.ids.tolist())}
+            hits = self._hybrid_hits(
+                name,
+                prompt,
+                hits,
+                limit=limit,
+                document_ids=document_ids,
+                get_hits=lambda ids: [
+                    collection.hit(idx_map[id], document_map)  # type: ignore[union-attr]
+                    for id in ids
+                    if id in idx_map
+                ],
+            )
+
+        return self._take_sources_up_to_max_tokens(hits, max_tokens=num_tokens)
@@ -0,0 +1,329 @@
+import math
+import threading
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Optional, cast
+
+from ragna.core import Document, Source
+
+from ._flat_index import FlatIndex, _Collection
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+
+def _assign(
+    x: "npt.NDArray[np.float32]",
+    centroids: "npt.NDArray[np.float32]",
+    *,
+    batch_size: int = 16_384,
+) -> "npt.NDArray[np.int64]":
+    # Index of the closest centroid for every vector. Since ||x||^2 is constant for a
+    # vector, minimizing ||c||^2 - 2 * x @ c is sufficient.
+    import numpy as np
+
+    squared_norms = np.einsum("kd,kd->k", centroids, centroids)
+    return np.concatenate(
+        [
+            np.argmin(
+                squared_norms - 2 * x[start : start + batch_size] @ centroids.T, 1
+            )
+            for start in range(0, len(x), batch_size)
+        ]
+        or [np.empty(0, dtype=np.int64)]
+    )
+
+
+def _kmeans(
+    x: "npt.NDArray[np.float32]",
+    k: int,
+    *,
+    rng: "np.random.Generator",
+    num_iterations: int = 20,
+) -> "npt.NDArray[np.float32]":
+    import numpy as np
+
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(num_iterations):
+        assignments = _assign(x, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=k)
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+        centroids[non_empty] = (
+            np.add.reduceat(x[order], starts, axis=0) / counts[non_empty, None]
+        )
+        # Empty clusters are restarted from random vectors.
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return cast("npt.NDArray[np.float32]", centroids)
+
+
+class IvfPq:
+    """Inverted file index with product quantized residuals.
+
+    The vectors are partitioned by a coarse k-means quantizer into `num_lists`
+    inverted lists. The residual of each vector to its list centroid is split into
+    `num_subvectors` subvectors, each of which is replaced by the one byte ID of the
+    closest centroid of a per-subspace codebook. For inner product search, the
+    score of a vector is the score of its list centroid plus the sum of the scores
+    of its subvector codes, which are looked up from a small table computed once per
+    query.
+
+    Args:
+        centroids: Coarse centroids with shape `(num_lists, dimensions)`.
+        codebooks: Codebooks with shape `(num_subvectors, num_codes, subdimensions)`.
+        list_offsets: Offsets of the inverted lists with shape `(num_lists + 1,)`.
+        list_idcs: Indices of the vectors ordered by inverted list.
+        codes: Codes of the vectors ordered by inverted list with shape
+            `(num_vectors, num_subvectors)`.
+    """
+
+    # Training on a sample is sufficient and bounds the training time for large
+    # collections.
+    _MAX_TRAINING_SAMPLES = 65_536
+
+    def __init__(
+        self,
+        *,
+        centroids: "npt.NDArray[np.float32]",
+        codebooks: "npt.NDArray[np.float32]",
+        list_offsets: "npt.NDArray[np.int64]",
+        list_idcs: "npt.NDArray[np.int64]",
+        codes: "npt.NDArray[np.uint8]",
+    ) -> None:
+        self.centroids = centroids
+        self.codebooks = codebooks
+        self.list_offsets = list_offsets
+        self.list_idcs = list_idcs
+        self.codes = codes
+
+    @classmethod
+    def train(
+        cls,
+        x: "npt.NDArray[np.float32]",
+        *,
+        num_lists: Optional[int] = None,
+        num_subvectors: Optional[int] = None,
+        seed: int = 0,
+    ) -> "IvfPq":
+        """Trains the quantizers on the vectors and encodes them.
+
+        Args:
+            x: Vectors with shape `(num_vectors, dimensions)`.
+            num_lists: Number of inverted lists. Defaults to the square root of the
+                number of vectors.
+            num_subvectors: Number of subvectors. Has to divide the number of
+                dimensions. Defaults to one subvector per eight dimensions.
+            seed: Seed for the random initialization of k-means.
+        """
+        import numpy as np
+
+        rng = np.random.default_rng(seed)
+        num_vectors, dimensions = x.shape
+        if num_lists is None:
+            num_lists = max(int(math.sqrt(num_vectors)), 1)
+        num_lists = min(num_lists, num_vectors)
+        if num_subvectors is None:
+            num_subvectors = next(
+                n for n in range(max(dimensions // 8, 1), 0, -1) if dimensions % n == 0
+            )
+        num_codes = min(256, num_vectors)
+
+        sample = (
+            x[rng.choice(num_vectors, cls._MAX_TRAINING_SAMPLES, replace=False)]
+            if num_vectors > cls._MAX_TRAINING_SAMPLES
+            else x
+        )
+        centroids = _kmeans(sample, num_lists, rng=rng)
+        assignments = _assign(x, centroids)
+
+        residuals = (x - centroids[assignments]).reshape(
+            num_vectors, num_subvectors, -1
+        )
+        sample_residuals = (
+            residuals[rng.choice(num_vectors, cls._MAX_TRAINING_SAMPLES, replace=False)]
+            if num_vectors > cls._MAX_TRAINING_SAMPLES
+            else residuals
+        )
+        codebooks = np.stack(
+            [
+                _kmeans(sample_residuals[:, idx], num_codes, rng=rng)
+                for idx in range(num_subvectors)
+            ]
+        )
+        codes = np.stack(
+            [
+                _assign(residuals[:, idx], codebooks[idx])
+                for idx in range(num_subvectors)
+            ],
+            axis=1,
+        ).astype(np.uint8)
+
+        list_idcs = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=num_lists), out=list_offsets[1:])
+        return cls(
+            centroids=centroids,
+            codebooks=codebooks,
+            list_offsets=list_offsets,
+            list_idcs=list_idcs,
+            codes=codes[list_idcs],
+        )
+
+    def save(self, path: Path) -> None:
+        import numpy as np
+
+        np.savez(
+            path,
+            centroids=self.centroids,
+            codebooks=self.codebooks,
+            list_offsets=self.list_offsets,
+            list_idcs=self.list_idcs,
+            codes=self.codes,
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "IvfPq":
+        import numpy as np
+
+        with np.load(path) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def search(
+        self,
+        query: "npt.NDArray[np.float32]",
+        *,
+        limit: int,
+        nprobe: int,
+        mask: "Optional[npt.NDArray[np.bool_]]" = None,
+    ) -> "npt.NDArray[np.int64]":
+        """Returns the indices of the vectors with the highest approximate inner
+        product with the query.
+
+        Args:
+            query: Query vector.
+            limit: Maximum number of indices to return.
+            nprobe: Number of inverted lists to search.
+            mask: If passed, only vectors for which the mask is `True` are returned.
+        """
+        import numpy as np
+
+        num_lists = len(self.centroids)
+        num_subvectors = len(self.codebooks)
+
+        list_scores = self.centroids @ query
+        nprobe = min(nprobe, num_lists)
+        probed = np.argpartition(-list_scores, nprobe - 1)[:nprobe]
+        starts = self.list_offsets[probed]
+        stops = self.list_offsets[probed + 1]
+        positions = np.concatenate(
+            [np.arange(start, stop) for start, stop in zip(starts, stops)]
+        )
+        if not len(positions):
+            return np.empty(0, dtype=np.int64)
+
+        # Scores of every code of every subspace for this query.
+        table = np.einsum(
+            "mkd,md->mk", self.codebooks, query.reshape(num_subvectors, -1)
+        )
+        scores = np.repeat(list_scores[probed], stops - starts) + table[
+            np.arange(num_subvectors), self.codes[positions]
+        ].sum(axis=1)
+        idcs = self.list_idcs[positions]
+        if mask is not None:
+            keep = mask[idcs]
+            scores, idcs = scores[keep], idcs[keep]
+
+        if len(idcs) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            scores, idcs = scores[top], idcs[top]
+        return cast("npt.NDArray[np.int64]", idcs[np.argsort(-scores, kind="stable")])
+
+
+class IvfPqIndex(FlatIndex):
+    """Source storage with an approximate nearest neighbor index for very large
+    chats.
+
+    The embeddings are indexed with an inverted file index with product quantized
+    residuals that is trained at store time. The search only needs about one byte
+    per eight dimensions of each embedding in memory, while the full precision
+    embeddings stay on disk. The search time is sub-linear in the number of chunks,
+    since only `nprobe` of the inverted lists are searched. Increasing `nprobe`
+    improves the recall at the cost of a slower search.
+
+    !!! info "Required packages"
+
+        - `chromadb>=0.4.13`
+    """
+
+    # Note that this class has no extra requirements, since the chromadb package is
+    # already required for the base class.
+
+    _DIRECTORY_NAME = "ivf_pq_index"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._quantizers: dict[Path, IvfPq] = {}
+        self._quantizers_lock = threading.Lock()
+
+    def _write_index(
+        self, path: Path, embeddings: "npt.NDArray[np.float32]", **index_params: Any
+    ) -> None:
+        if len(embeddings):
+            IvfPq.train(embeddings).save(path / "ivf_pq.npz")
+
+    def _quantizer(self, collection: _Collection) -> IvfPq:
+        with self._quantizers_lock:
+            quantizer = self._quantizers.get(collection.path)
+            if quantizer is None:
+                # Quantizers of previous generations are no longer needed.
+                self._quantizers = {
+                    path: quantizer
+                    for path, quantizer in self._quantizers.items()
+                    if path.parent != collection.path.parent
+                }
+                quantizer = self._quantizers[collection.path] = IvfPq.load(
+                    collection.path / "ivf_pq.npz"
+                )
+            return quantizer
+
+    def _search(  # type: ignore[override]
+        self,
+        collection: _Collection,
+        query_embedding: "npt.NDArray[np.float32]",
+        *,
+        limit: int,
+        document_mask: "Optional[npt.NDArray[np.bool_]]",
+        nprobe: int,
+    ) -> "npt.NDArray[np.int64]":
+        return self._quantizer(collection).search(
+            query_embedding, limit=limit, nprobe=nprobe, mask=document_mask
+        )
+
+    def retrieve(
+        self,
+        documents: list[Document],
+        prompt: str,
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int = 500,
+        chunk_overlap: int = 250,
+        num_tokens: int = 1024,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
+        nprobe: int = 8,
+    ) -> list[Source]:
+        return self._retrieve(
+            documents,
+            prompt,
+            chat_id=chat_id,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            num_tokens=num_tokens,
+            shared_index=shared_index,
+            hybrid_search=hybrid_search,
+            nprobe=nprobe,
+        )
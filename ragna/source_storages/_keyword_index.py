@@ -0,0 +1,229 @@
+from __future__ import annotations
+
+import os
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Collection, Optional, Sequence, cast
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+
+class KeywordIndex:
+    """Inverted index for BM25 keyword search over the chunks of a collection.
+
+    The terms are the token IDs of the tokenizer that was used to chunk the
+    documents. The postings are stored in flat arrays sorted by term, such that the
+    postings of a term are a contiguous slice that can be found by binary search.
+
+    Args:
+        path: Path of the `.npz` file the index is persisted to.
+        k1: BM25 term frequency saturation.
+        b: BM25 document length normalization.
+    """
+
+    def __init__(self, path: Path, *, k1: float = 1.2, b: float = 0.75) -> None:
+        import numpy as np
+
+        self._path = path
+        self._k1 = k1
+        self._b = b
+        self._lock = threading.Lock()
+
+        self._chunk_ids: npt.NDArray[np.str_] = np.empty(0, dtype=np.str_)
+        self._document_ids: npt.NDArray[np.str_] = np.empty(0, dtype=np.str_)
+        self._lengths: npt.NDArray[np.int32] = np.empty(0, dtype=np.int32)
+        self._terms: npt.NDArray[np.uint32] = np.empty(0, dtype=np.uint32)
+        self._chunks: npt.NDArray[np.int32] = np.empty(0, dtype=np.int32)
+        self._tfs: npt.NDArray[np.float32] = np.empty(0, dtype=np.float32)
+
+        # The version is determined before loading. Thus, if the file is replaced
+        # while we load it, the index is reported as stale rather than missing the
+        # change.
+        self._loaded_version = self._version()
+        if path.exists():
+            with np.load(path) as data:
+                self._chunk_ids = data["chunk_ids"]
+                self._document_ids = data["document_ids"]
+                self._lengths = data["lengths"]
+                self._terms = data["terms"]
+                self._chunks = data["chunks"]
+                self._tfs = data["tfs"]
+
+    def _version(self) -> Optional[tuple[int, int, int]]:
+        try:
+            stat = self._path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def is_stale(self) -> bool:
+        """Whether the file was changed since the index was loaded or saved, e.g. by
+        another process.
+        """
+        return self._version() != self._loaded_version
+
+    def __len__(self) -> int:
+        return len(self._chunk_ids)
+
+    def __contains__(self, document_id: str) -> bool:
+        import numpy as np
+
+        return bool(np.any(self._document_ids == document_id))
+
+    def add(
+        self,
+        document_id: str,
+        chunk_ids: Sequence[str],
+        chunk_tokens: Sequence[npt.NDArray[np.uint32]],
+    ) -> None:
+        """Adds the chunks of a document."""
+        import numpy as np
+
+        if not chunk_ids:
+            return
+
+        with self._lock:
+            offset = len(self._chunk_ids)
+            terms = []
+            chunks = []
+            tfs = []
+            for idx, tokens in enumerate(chunk_tokens, offset):
+                chunk_terms, counts = np.unique(tokens, return_counts=True)
+                terms.append(chunk_terms.astype(np.uint32))
+                chunks.append(np.full(len(chunk_terms), idx, dtype=np.int32))
+                tfs.append(counts.astype(np.float32))
+
+            all_terms = np.concatenate([self._terms, *terms])
+            order = np.argsort(all_terms, kind="stable")
+            self._terms = all_terms[order]
+            self._chunks = np.concatenate([self._chunks, *chunks])[order]
+            self._tfs = np.concatenate([self._tfs, *tfs])[order]
+            self._chunk_ids = np.concatenate([self._chunk_ids, chunk_ids])
+            self._document_ids = np.concatenate(
+                [self._document_ids, [document_id] * len(chunk_ids)]
+            )
+            self._lengths = np.concatenate(
+                [
+                    self._lengths,
+                    np.fromiter(map(len, chunk_tokens), dtype=np.int32),
+                ]
+            )
+
+    def remove(self, document_ids: Collection[str]) -> None:
+        """Removes all chunks of the given documents."""
+        import numpy as np
+
+        with self._lock:
+            keep = ~np.isin(self._document_ids, list(document_ids))
+            if keep.all():
+                return
+
+            new_idcs = np.cumsum(keep, dtype=np.int32) - 1
+            keep_postings = keep[self._chunks]
+            self._terms = self._terms[keep_postings]
+            self._chunks = new_idcs[self._chunks[keep_postings]]
+            self._tfs = self._tfs[keep_postings]
+            self._chunk_ids = self._chunk_ids[keep]
+            self._document_ids = self._document_ids[keep]
+            self._lengths = self._lengths[keep]
+
+    def save(self) -> None:
+        import numpy as np
+
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        # Writing to a temporary file first makes sure that concurrent readers never
+        # see a partially written index.
+        tmp_path = self._path.with_name(f"{self._path.stem}.{os.getpid()}.tmp.npz")
+        with self._lock:
+            np.savez(
+                tmp_path,
+                chunk_ids=self._chunk_ids,
+                document_ids=self._document_ids,
+                lengths=self._lengths,
+                terms=self._terms,
+                chunks=self._chunks,
+                tfs=self._tfs,
+            )
+        os.replace(tmp_path, self._path)
+        self._loaded_version = self._version()
+
+    def _score(
+        self, tokens: Sequence[int], *, document_ids: Optional[Collection[str]]
+    ) -> Optional[npt.NDArray[np.float64]]:
+        import numpy as np
+
+        num_chunks = len(self._chunk_ids)
+        if num_chunks == 0:
+            return None
+
+        query_terms = np.unique(np.asarray(tokens, dtype=np.uint32))
+        starts = np.searchsorted(self._terms, query_terms, side="left")
+        stops = np.searchsorted(self._terms, query_terms, side="right")
+        dfs = stops - starts
+        found = dfs > 0
+        if not found.any():
+            return None
+        starts, stops, dfs = starts[found], stops[found], dfs[found]
+
+        idfs = np.log1p((num_chunks - dfs + 0.5) / (dfs + 0.5))
+        postings = np.concatenate(
+            [np.arange(start, stop) for start, stop in zip(starts, stops)]
+        )
+        chunks = self._chunks[postings]
+        tfs = self._tfs[postings]
+        length_norms = self._k1 * (
+            1 - self._b + self._b * self._lengths[chunks] / self._lengths.mean()
+        )
+        scores: npt.NDArray[np.float64] = np.bincount(  # type: ignore[assignment]
+            chunks,
+            weights=np.repeat(idfs, dfs) * tfs * (self._k1 + 1) / (tfs + length_norms),
+            minlength=num_chunks,
+        )
+        if document_ids is not None:
+            scores[~np.isin(self._document_ids, list(document_ids))] = 0
+
+        return scores
+
+    def search(
+        self,
+        tokens: Sequence[int],
+        *,
+        limit: int,
+        document_ids: Optional[Collection[str]] = None,
+    ) -> list[str]:
+        """Returns the IDs of the chunks with the highest BM25 score.
+
+        Args:
+            tokens: Tokens of the query.
+            limit: Maximum number of chunk IDs to return.
+            document_ids: If passed, only chunks of these documents are considered.
+        """
+        import numpy as np
+
+        with self._lock:
+            scores = self._score(tokens, document_ids=document_ids)
+            chunk_ids = self._chunk_ids
+        if scores is None or limit <= 0:
+            return []
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > limit:
+            candidates = candidates[
+                np.argpartition(-scores[candidates], limit - 1)[:limit]
+            ]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return cast(list[str], chunk_ids[candidates].tolist())
+
+
+def reciprocal_rank_fusion(*rankings: Sequence[str], k: int = 60) -> list[str]:
+    """Fuses multiple rankings of IDs into one.
+
+    See https://plg.uwaterloo.ca/~gvcormac/cormacksigir09-rrf.pdf
+    """
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, 1):
+            scores[id] = scores.get(id, 0.0) + 1 / (k + rank)
+    return sorted(scores, key=lambda id: scores[id], reverse=True)
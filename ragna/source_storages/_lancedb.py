@@ -1,9 +1,20 @@
+import contextvars
+import functools
 import uuid
+from typing import TYPE_CHECKING, Any, Iterator, Optional
+
+import anyio
 
 import ragna
-from ragna.core import Document, PackageRequirement, Requirement, Source
+from ragna._compat import itertools_batched
+from ragna.core import Document, PackageRequirement, Requirement, Source, span
+
+from ._vector_database import Chunk, Hit, VectorDatabaseSourceStorage
 
-from ._vector_database import VectorDatabaseSourceStorage
+if TYPE_CHECKING:
+    import lancedb
+    import numpy as np
+    import numpy.typing as npt
 
 
 class LanceDB(VectorDatabaseSourceStorage):
@@ -12,7 +23,7 @@ class LanceDB(VectorDatabaseSourceStorage):
     !!! info "Required packages"
 
         - `chromadb>=0.4.13`
-        - `lancedb>=0.2`
+        - `lancedb>=0.6`
         - `pyarrow`
     """
 
@@ -20,7 +31,7 @@ class LanceDB(VectorDatabaseSourceStorage):
     def requirements(cls) -> list[Requirement]:
         return [
             *super().requirements(),
-            PackageRequirement("lancedb>=0.2"),
+            PackageRequirement("lancedb>=0.6"),
             PackageRequirement(
                 "pyarrow",
                 # See https://github.com/apache/arrow/issues/38167
@@ -31,10 +42,11 @@ class LanceDB(VectorDatabaseSourceStorage):
     def __init__(self) -> None:
         super().__init__()
 
-        import lancedb
         import pyarrow as pa
 
-        self._db = lancedb.connect(ragna.local_root() / "lancedb")
+        self._uri = ragna.local_root() / "lancedb"
+        # The connection is opened lazily, since this requires an event loop.
+        self._db: Optional["lancedb.AsyncConnection"] = None
         self._schema = pa.schema(
             [
                 pa.field("id", pa.string()),
@@ -46,82 +58,252 @@ class LanceDB(VectorDatabaseSourceStorage):
                     pa.list_(pa.float32(), self._embedding_dimensions),
                 ),
                 pa.field("num_tokens", pa.int32()),
+                pa.field("start", pa.int64()),
+                pa.field("stop", pa.int64()),
+                pa.field("num_chunks", pa.int32()),
             ]
         )
 
     _VECTOR_COLUMN_NAME = "embedded_text"
 
-    def store(
+    async def _connect(self) -> "lancedb.AsyncConnection":
+        import lancedb
+
+        if self._db is None:
+            self._db = await lancedb.connect_async(self._uri)
+        return self._db
+
+    async def store(
         self,
         documents: list[Document],
         *,
         chat_id: uuid.UUID,
         chunk_size: int = 500,
         chunk_overlap: int = 250,
+        batch_size: int = 256,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
     ) -> None:
-        table = self._db.create_table(name=str(chat_id), schema=self._schema)
-
-        for document in documents:
-            for chunk in self._chunk_pages(
-                document.extract_pages(),
-                chunk_size=chunk_size,
-                chunk_overlap=chunk_overlap,
-            ):
-                table.add(
-                    [
-                        {
-                            "id": str(uuid.uuid4()),
-                            "document_id": str(document.id),
-                            "page_numbers": self._page_numbers_to_str(
-                                chunk.page_numbers
-                            ),
-                            "text": chunk.text,
-                            self._VECTOR_COLUMN_NAME: self._embedding_function(
-                                [chunk.text]
-                            )[0],
-                            "num_tokens": chunk.num_tokens,
-                        }
-                    ]
+        import pyarrow as pa
+
+        table_name = (
+            self._shared_collection_name(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            if shared_index
+            else str(chat_id)
+        )
+        db = await self._connect()
+        table = await db.create_table(table_name, schema=self._schema, exist_ok=True)
+        if shared_index:
+            # Documents that are already part of the shared table, e.g. because they
+            # were used in a previous chat, don't need to be indexed again.
+            keyword_index = self._keyword_index(table_name) if hybrid_search else None
+            documents = [
+                document
+                for document in documents
+                if not await self._is_stored(table, document)
+                or (keyword_index is not None and str(document.id) not in keyword_index)
+            ]
+        elif documents:
+            # Storing a document again replaces its previous chunks.
+            document_ids = ", ".join(f"'{document.id}'" for document in documents)
+            await table.delete(f"document_id IN ({document_ids})")
+
+        if not documents:
+            return
+
+        keyword_chunks: dict[str, tuple[list[str], list["npt.NDArray[np.uint32]"]]] = {
+            str(document.id): ([], []) for document in documents
+        }
+
+        def chunk_documents() -> Iterator[tuple[Document, int, Chunk, int]]:
+            for document in documents:
+                # Every chunk records the number of chunks of its document. Thus, the
+                # document has to be chunked completely before its chunks are batched.
+                chunks = list(
+                    self._chunk_pages(
+                        document.extract_pages(),
+                        chunk_size=chunk_size,
+                        chunk_overlap=chunk_overlap,
+                    )
                 )
+                for idx, chunk in enumerate(chunks):
+                    yield document, idx, chunk, len(chunks)
+
+        def make_batches() -> Iterator[pa.RecordBatch]:
+            for batch in itertools_batched(chunk_documents(), batch_size):
+                texts = [chunk.text for _, _, chunk, _ in batch]
+                ids = [
+                    self._chunk_id(
+                        document.id,
+                        idx,
+                        chunk_size=chunk_size,
+                        chunk_overlap=chunk_overlap,
+                    )
+                    for document, idx, _, _ in batch
+                ]
+                if hybrid_search:
+                    for id, (document, _, chunk, _) in zip(ids, batch):
+                        chunk_ids, chunk_tokens = keyword_chunks[str(document.id)]
+                        chunk_ids.append(id)
+                        chunk_tokens.append(chunk.tokens)
+                yield pa.RecordBatch.from_pydict(
+                    {
+                        "id": ids,
+                        "document_id": [
+                            str(document.id) for document, _, _, _ in batch
+                        ],
+                        "page_numbers": [
+                            self._page_numbers_to_str(chunk.page_numbers)
+                            for _, _, chunk, _ in batch
+                        ],
+                        "text": texts,
+                        self._VECTOR_COLUMN_NAME: pa.FixedSizeListArray.from_arrays(
+                            self._embed(texts).ravel(), self._embedding_dimensions
+                        ),
+                        "num_tokens": [chunk.num_tokens for _, _, chunk, _ in batch],
+                        "start": [chunk.start for _, _, chunk, _ in batch],
+                        "stop": [chunk.stop for _, _, chunk, _ in batch],
+                        "num_chunks": [num_chunks for _, _, _, num_chunks in batch],
+                    },
+                    schema=self._schema,
+                )
+
+        # Passing all batches through a single reader means the documents are written
+        # in one go rather than creating a new fragment and version per insert. The
+        # reader is consumed by a thread of LanceDB. Thus, chunking and embedding don't
+        # block the event loop. The context is carried over to record the timings.
+        context = contextvars.copy_context()
+
+        def read_batches() -> Iterator[pa.RecordBatch]:
+            batches = make_batches()
+            while True:
+                batch = context.run(next, batches, None)  # type: ignore[arg-type]
+                if batch is None:
+                    return
+                yield batch
 
-    def retrieve(
+        reader = pa.RecordBatchReader.from_batches(self._schema, read_batches())
+        if shared_index:
+            # Upserting replaces the chunks left behind by an interrupted store and
+            # makes concurrent stores of the same document into a shared table
+            # idempotent.
+            await (
+                table.merge_insert("id")
+                .when_matched_update_all()
+                .when_not_matched_insert_all()
+                .execute(reader)
+            )
+        else:
+            await table.add(reader)
+
+        if hybrid_search:
+            # Rebuilding the postings is CPU bound and thus run in a worker thread.
+            await anyio.to_thread.run_sync(
+                functools.partial(
+                    self._index_keywords, table_name, keyword_chunks, replace=True
+                )
+            )
+
+    async def _is_stored(self, table: "lancedb.AsyncTable", document: Document) -> bool:
+        # A document whose store was interrupted after only some of its chunks were
+        # written is not mistaken for a stored one.
+        filter = f"document_id = '{document.id}'"
+        num_stored = await table.count_rows(filter)
+        if not num_stored:
+            return False
+        result = (
+            await table.query().where(filter).select(["num_chunks"]).limit(1).to_list()
+        )
+        return bool(num_stored == result[0]["num_chunks"])
+
+    async def retrieve(
         self,
         documents: list[Document],
         prompt: str,
         *,
         chat_id: uuid.UUID,
         chunk_size: int = 500,
+        chunk_overlap: int = 250,
         num_tokens: int = 1024,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
     ) -> list[Source]:
-        table = self._db.open_table(str(chat_id))
+        table_name = (
+            self._shared_collection_name(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            if shared_index
+            else str(chat_id)
+        )
+        db = await self._connect()
+        table = await db.open_table(table_name)
 
         # We cannot retrieve source by a maximum number of tokens. Thus, we estimate how
         # many sources we have to query. We overestimate by a factor of two to avoid
         # retrieving to few sources and needed to query again.
-        limit = int(num_tokens * 2 / chunk_size)
-        results = (
-            table.search(
-                self._embedding_function([prompt])[0],
-                vector_column_name=self._VECTOR_COLUMN_NAME,
-            )
+        limit = max(int(num_tokens * 2 / chunk_size), 1)
+        query_embedding = await self._aembed_query(prompt)
+        query = (
+            table.query()
+            .nearest_to(query_embedding)
+            .column(self._VECTOR_COLUMN_NAME)
             .limit(limit)
-            .to_arrow()
         )
+        if shared_index:
+            # Filters are applied before the vector search by default. This ensures we
+            # get the closest chunks of the chat's documents rather than filtering the
+            # closest chunks of all documents afterwards.
+            document_ids = ", ".join(f"'{document.id}'" for document in documents)
+            query = query.where(f"document_id IN ({document_ids})")
+        with span("search") as search_span:
+            results = await query.to_arrow()
+            search_span.set(num_results=results.num_rows)
 
         document_map = {str(document.id): document for document in documents}
-        return self._take_sources_up_to_max_tokens(
-            (
-                Source(
-                    id=result["id"],
-                    document=document_map[result["document_id"]],
-                    # For some reason adding an empty string during store() results
-                    # in this field being None. Thus, we need to parse it back here.
-                    # TODO: See if there is a configuration option for this
-                    location=result["page_numbers"] or "",
-                    content=result["text"],
-                    num_tokens=result["num_tokens"],
+        hits = [self._hit(result, document_map) for result in results.to_pylist()]
+        if hybrid_search:
+
+            async def get_hits(ids: list[str]) -> list[Hit]:
+                ids_str = ", ".join(f"'{id}'" for id in ids)
+                results = (
+                    await table.query()
+                    .where(f"id IN ({ids_str})")
+                    .limit(len(ids))
+                    .to_arrow()
                 )
-                for result in results.to_pylist()
+                return [
+                    self._hit(result, document_map) for result in results.to_pylist()
+                ]
+
+            hits = await self._ahybrid_hits(
+                table_name,
+                prompt,
+                hits,
+                limit=limit,
+                document_ids=(
+                    [str(document.id) for document in documents]
+                    if shared_index
+                    else None
+                ),
+                get_hits=get_hits,
+            )
+
+        return self._take_sources_up_to_max_tokens(hits, max_tokens=num_tokens)
+
+    def _hit(self, result: dict[str, Any], document_map: dict[str, Document]) -> Hit:
+        return Hit(
+            Source(
+                id=result["id"],
+                document=document_map[result["document_id"]],
+                # For some reason adding an empty string during store() results in
+                # this field being None. Thus, we need to parse it back here.
+                # TODO: See if there is a configuration option for this
+                location=result["page_numbers"] or "",
+                content=result["text"],
+                num_tokens=result["num_tokens"],
             ),
-            max_tokens=num_tokens,
+            start=result.get("start"),
+            stop=result.get("stop"),
         )
@@ -0,0 +1,504 @@
+import threading
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Literal, Optional, cast
+
+from ragna.core import Document, Source, span
+
+from ._flat_index import FlatIndex, _Collection
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
+
+
+# Number of set bits for every byte value
+_POPCOUNT: Optional["npt.NDArray[np.uint8]"] = None
+
+
+def _popcount_table() -> "npt.NDArray[np.uint8]":
+    import numpy as np
+
+    global _POPCOUNT
+    if _POPCOUNT is None:
+        _POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+            axis=1, dtype=np.uint8
+        )
+    return _POPCOUNT
+
+
+class Quantizer:
+    """Compressed copy of embeddings for a fast first-pass search.
+
+    The embeddings are optionally projected onto their `pca_dimensions` principal
+    components and afterwards quantized to either
+
+    - `"int8"`: one byte per dimension with a scale per dimension, or
+    - `"binary"`: one bit per dimension, i.e. the sign of the centered value.
+
+    Args:
+        quantization: Quantization type.
+        codes: Quantized embeddings.
+        mean: Mean of the embeddings that is subtracted before the projection.
+        components: Principal components with shape `(pca_dimensions, dimensions)`
+            or `None` if the dimensions are not reduced.
+        scale: Scale per dimension for `"int8"` quantization.
+        recall: Recall of the quantized search as measured by `recall_check()` or
+            `None` if it was not measured.
+    """
+
+    def __init__(
+        self,
+        *,
+        quantization: Literal["int8", "binary"],
+        codes: "npt.NDArray[np.uint8] | npt.NDArray[np.int8]",
+        mean: "npt.NDArray[np.float32]",
+        components: "Optional[npt.NDArray[np.float32]]",
+        scale: "npt.NDArray[np.float32]",
+        recall: Optional[float] = None,
+    ) -> None:
+        self.quantization = quantization
+        self.codes = codes
+        self.mean = mean
+        self.components = components
+        self.scale = scale
+        self.recall = recall
+
+    @classmethod
+    def train(
+        cls,
+        x: "npt.NDArray[np.float32]",
+        *,
+        quantization: Literal["int8", "binary"],
+        pca_dimensions: Optional[int] = None,
+        seed: int = 0,
+    ) -> "Quantizer":
+        """Fits the projection and quantization to the embeddings and encodes them.
+
+        Args:
+            x: Embeddings with shape `(num_embeddings, dimensions)`.
+            quantization: Quantization type.
+            pca_dimensions: If passed, the number of principal components the
+                embeddings are projected onto.
+            seed: Seed for sampling the embeddings to fit the projection on.
+        """
+        import numpy as np
+
+        mean = x.mean(axis=0)
+        components = None
+        if pca_dimensions is not None and pca_dimensions < x.shape[1]:
+            rng = np.random.default_rng(seed)
+            sample = x[rng.choice(len(x), min(len(x), 65_536), replace=False)]
+            _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+            components = vt[:pca_dimensions].astype(np.float32)
+
+        quantizer = cls(
+            quantization=quantization,
+            codes=np.empty(0, dtype=np.uint8),
+            mean=mean.astype(np.float32),
+            components=components,
+            scale=np.ones(1, dtype=np.float32),
+        )
+        projected = quantizer._project(x)
+        if quantization == "int8":
+            max_abs = np.abs(projected).max(axis=0)
+            quantizer.scale = (np.where(max_abs > 0, max_abs, 1) / 127).astype(
+                np.float32
+            )
+        quantizer.codes = quantizer._encode(projected)
+        return quantizer
+
+    def _project(
+        self, x: "npt.NDArray[np.float32]", *, center: bool = True
+    ) -> "npt.NDArray[np.float32]":
+        if center:
+            x = x - self.mean
+        if self.components is not None:
+            x = x @ self.components.T
+        return x
+
+    def _encode(
+        self, projected: "npt.NDArray[np.float32]"
+    ) -> "npt.NDArray[np.uint8] | npt.NDArray[np.int8]":
+        import numpy as np
+
+        if self.quantization == "int8":
+            codes: "npt.NDArray[np.int8]" = np.clip(
+                np.rint(projected / self.scale), -127, 127
+            ).astype(np.int8)
+            return codes
+        return np.packbits(projected > 0, axis=-1)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the quantized embeddings in bytes."""
+        return int(self.codes.nbytes)
+
+    def scores(self, query: "npt.NDArray[np.float32]") -> "npt.NDArray[np.float32]":
+        """Approximate similarity of the query with every embedding.
+
+        Only the order of the scores is meaningful.
+        """
+        import numpy as np
+
+        if self.quantization == "int8":
+            # The query is not centered: (x - mean) @ q only differs from x @ q by
+            # mean @ q, which is the same for all embeddings and thus keeps the order.
+            projected = self._project(query[None], center=False)[0]
+            return cast(
+                "npt.NDArray[np.float32]",
+                self.codes @ (projected * self.scale).astype(np.float32),
+            )
+
+        query_bits = np.packbits(self._project(query[None])[0] > 0)
+        hamming = _popcount_table()[np.bitwise_xor(self.codes, query_bits)].sum(
+            axis=1, dtype=np.int32
+        )
+        return cast("npt.NDArray[np.float32]", -hamming.astype(np.float32))
+
+    def save(self, path: Path) -> None:
+        import numpy as np
+
+        arrays = dict(codes=self.codes, mean=self.mean, scale=self.scale)
+        if self.components is not None:
+            arrays["components"] = self.components
+        if self.recall is not None:
+            arrays["recall"] = np.array(self.recall)
+        np.savez(path, quantization=np.array(self.quantization), **arrays)
+
+    @classmethod
+    def load(cls, path: Path) -> "Quantizer":
+        import numpy as np
+
+        with np.load(path) as data:
+            return cls(
+                quantization=cast(Any, str(data["quantization"])),
+                codes=data["codes"],
+                mean=data["mean"],
+                components=data["components"] if "components" in data else None,
+                scale=data["scale"],
+                recall=float(data["recall"]) if "recall" in data else None,
+            )
+
+
+def search(
+    quantizer: Quantizer,
+    embeddings: "npt.NDArray[np.float32]",
+    query: "npt.NDArray[np.float32]",
+    *,
+    limit: int,
+    rescore_factor: int,
+    mask: "Optional[npt.NDArray[np.bool_]]" = None,
+) -> "npt.NDArray[np.int64]":
+    """Searches the quantized embeddings and rescores the best candidates exactly.
+
+    Args:
+        quantizer: Quantized embeddings.
+        embeddings: Full precision embeddings. Only the rows of the candidates are
+            accessed, which keeps memory mapped embeddings mostly on disk.
+        query: Normalized query embedding.
+        limit: Maximum number of indices to return.
+        rescore_factor: Number of candidates per result that are rescored.
+        mask: If passed, only embeddings for which the mask is `True` are returned.
+    """
+    import numpy as np
+
+    scores = quantizer.scores(query)
+    if mask is not None:
+        scores[~mask] = -np.inf
+    num_candidates = min(limit * rescore_factor, len(scores))
+    candidates = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+    candidates = np.sort(candidates[np.isfinite(scores[candidates])])
+
+    exact_scores = embeddings[candidates] @ query
+    top = np.argsort(-exact_scores, kind="stable")[:limit]
+    return cast("npt.NDArray[np.int64]", candidates[top])
+
+
+def exact_top_k(
+    embeddings: "npt.NDArray[np.float32]",
+    queries: "npt.NDArray[np.float32]",
+    *,
+    k: int,
+    block_size: int = 16_384,
+) -> "npt.NDArray[np.int64]":
+    """Finds the indices of the exact `k` nearest neighbors of every query.
+
+    The embeddings are processed in blocks of rows, which keeps memory mapped
+    embeddings mostly on disk. The neighbors of a query are not sorted.
+
+    Args:
+        embeddings: Full precision embeddings.
+        queries: Normalized query embeddings.
+        k: Number of neighbors per query.
+        block_size: Number of embeddings that are scored at once.
+    """
+    import numpy as np
+
+    top_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+    top_idcs = np.empty((len(queries), 0), dtype=np.int64)
+    for start in range(0, len(embeddings), block_size):
+        block = np.asarray(embeddings[start : start + block_size])
+        scores = np.concatenate([top_scores, queries @ block.T], axis=1)
+        idcs = np.concatenate(
+            [
+                top_idcs,
+                np.broadcast_to(
+                    np.arange(start, start + len(block)), (len(queries), len(block))
+                ),
+            ],
+            axis=1,
+        )
+        num_top = min(k, scores.shape[1])
+        top = np.argpartition(-scores, num_top - 1, axis=1)[:, :num_top]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        top_idcs = np.take_along_axis(idcs, top, axis=1)
+    return cast("npt.NDArray[np.int64]", top_idcs)
+
+
+def recall_check(
+    quantizer: Quantizer,
+    embeddings: "npt.NDArray[np.float32]",
+    *,
+    k: int = 10,
+    rescore_factor: int = 10,
+    num_queries: int = 100,
+    perturbation: float = 0.5,
+    seed: int = 0,
+) -> float:
+    """Measures the recall of the quantized search with rescoring.
+
+    The queries are perturbed copies of a sample of the embeddings. Using the
+    embeddings themselves would inflate the recall, since every query would be its
+    own nearest neighbor. The recall is the fraction of the exact `k` nearest
+    neighbors that are found.
+
+    Args:
+        quantizer: Quantized embeddings.
+        embeddings: Full precision embeddings.
+        k: Number of neighbors per query.
+        rescore_factor: Number of candidates per result that are rescored.
+        num_queries: Maximum number of queries.
+        perturbation: Norm of the random noise added to the sampled embeddings
+            relative to their norm.
+        seed: Seed for sampling and perturbing the queries.
+    """
+    import numpy as np
+
+    k = min(k, len(embeddings))
+    if k == 0:
+        return 1.0
+
+    rng = np.random.default_rng(seed)
+    samples = np.asarray(
+        embeddings[
+            np.sort(
+                rng.choice(
+                    len(embeddings), min(num_queries, len(embeddings)), replace=False
+                )
+            )
+        ]
+    )
+    noise = rng.normal(size=samples.shape)
+    noise *= (
+        perturbation
+        * np.linalg.norm(samples, axis=1, keepdims=True)
+        / np.linalg.norm(noise, axis=1, keepdims=True)
+    )
+    queries = samples + noise
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(
+        np.float32
+    )
+
+    exact = exact_top_k(embeddings, queries, k=k)
+    hits = sum(
+        len(
+            set(expected.tolist())
+            & set(
+                search(
+                    quantizer,
+                    embeddings,
+                    query,
+                    limit=k,
+                    rescore_factor=rescore_factor,
+                ).tolist()
+            )
+        )
+        for query, expected in zip(queries, exact)
+    )
+    return hits / (k * len(queries))
+
+
+class QuantizedFlatIndex(FlatIndex):
+    """Source storage that keeps only quantized embeddings in memory.
+
+    The first pass of a search runs over int8 or binary quantized and optionally
+    PCA reduced embeddings. Afterwards, the best candidates are rescored exactly
+    with the full precision embeddings that are memory mapped from disk. Compared
+    to [ragna.source_storages.FlatIndex][], this reduces the memory per chunk by a
+    factor of 4 (`"int8"`) to 32 (`"binary"`) or more with PCA.
+
+    With `check_recall=True`, the recall of the quantized search compared to the
+    exact one is measured with perturbed copies of a sample of the stored chunks at
+    store time. It is stored alongside the index and can be read with `recall()`.
+    It is also reported as `recall` attribute of the `recall_check` timing span.
+
+    !!! info "Required packages"
+
+        - `chromadb>=0.4.13`
+    """
+
+    # Note that this class has no extra requirements, since the chromadb package is
+    # already required for the base class.
+
+    _DIRECTORY_NAME = "quantized_flat_index"
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._quantizers: dict[Path, Quantizer] = {}
+        self._quantizers_lock = threading.Lock()
+
+    def _write_index(
+        self,
+        path: Path,
+        embeddings: "npt.NDArray[np.float32]",
+        *,
+        quantization: Literal["int8", "binary"],
+        pca_dimensions: Optional[int],
+        check_recall: bool,
+        **index_params: Any,
+    ) -> None:
+        if not len(embeddings):
+            return
+
+        quantizer = Quantizer.train(
+            embeddings, quantization=quantization, pca_dimensions=pca_dimensions
+        )
+        if check_recall:
+            # The check needs an exact search over all embeddings and thus is only
+            # run on request.
+            with span(
+                "recall_check",
+                quantization=quantization,
+                pca_dimensions=pca_dimensions,
+            ) as recall_span:
+                quantizer.recall = recall_check(quantizer, embeddings)
+                recall_span.set(recall=quantizer.recall)
+        quantizer.save(path / "quantized.npz")
+
+    def recall(
+        self,
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int = 500,
+        chunk_overlap: int = 250,
+        shared_index: bool = False,
+    ) -> Optional[float]:
+        """Returns the recall measured when the index was last stored.
+
+        Args:
+            chat_id: ID of the chat the documents were stored for.
+            chunk_size: Chunk size the documents were stored with.
+            chunk_overlap: Chunk overlap the documents were stored with.
+            shared_index: Whether the documents were stored in the shared index.
+
+        Returns:
+            The recall or `None` if nothing was stored or the documents were stored
+            without `check_recall=True`.
+        """
+        collection = self._load_collection(
+            self._shared_collection_name(
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            if shared_index
+            else str(chat_id)
+        )
+        if collection is None or not (collection.path / "quantized.npz").exists():
+            return None
+        return self._quantizer(collection).recall
+
+    def _quantizer(self, collection: _Collection) -> Quantizer:
+        with self._quantizers_lock:
+            quantizer = self._quantizers.get(collection.path)
+            if quantizer is None:
+                # Quantizers of previous generations are no longer needed.
+                self._quantizers = {
+                    path: quantizer
+                    for path, quantizer in self._quantizers.items()
+                    if path.parent != collection.path.parent
+                }
+                quantizer = self._quantizers[collection.path] = Quantizer.load(
+                    collection.path / "quantized.npz"
+                )
+            return quantizer
+
+    def _search(  # type: ignore[override]
+        self,
+        collection: _Collection,
+        query_embedding: "npt.NDArray[np.float32]",
+        *,
+        limit: int,
+        document_mask: "Optional[npt.NDArray[np.bool_]]",
+        rescore_factor: int,
+    ) -> "npt.NDArray[np.int64]":
+        return search(
+            self._quantizer(collection),
+            collection.embeddings,
+            query_embedding,
+            limit=limit,
+            rescore_factor=rescore_factor,
+            mask=document_mask,
+        )
+
+    def store(
+        self,
+        documents: list[Document],
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int = 500,
+        chunk_overlap: int = 250,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
+        quantization: Literal["int8", "binary"] = "int8",
+        pca_dimensions: Optional[int] = None,
+        check_recall: bool = False,
+    ) -> None:
+        self._store(
+            documents,
+            chat_id=chat_id,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            shared_index=shared_index,
+            hybrid_search=hybrid_search,
+            quantization=quantization,
+            pca_dimensions=pca_dimensions,
+            check_recall=check_recall,
+        )
+
+    def retrieve(
+        self,
+        documents: list[Document],
+        prompt: str,
+        *,
+        chat_id: uuid.UUID,
+        chunk_size: int = 500,
+        chunk_overlap: int = 250,
+        num_tokens: int = 1024,
+        shared_index: bool = False,
+        hybrid_search: bool = False,
+        rescore_factor: int = 10,
+    ) -> list[Source]:
+        return self._retrieve(
+            documents,
+            prompt,
+            chat_id=chat_id,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            num_tokens=num_tokens,
+            shared_index=shared_index,
+            hybrid_search=hybrid_search,
+            rescore_factor=rescore_factor,
+        )
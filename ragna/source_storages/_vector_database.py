@@ -1,51 +1,88 @@
+from __future__ import annotations
+
 import dataclasses
 import itertools
-from collections import deque
+import threading
+import uuid
+from pathlib import Path
 from typing import (
-    Deque,
+    TYPE_CHECKING,
+    Awaitable,
+    Callable,
     Iterable,
     Iterator,
     Optional,
-    TypeVar,
     cast,
 )
 
+import ragna
 from ragna._compat import itertools_pairwise
+from ragna._utils import file_lock
 from ragna.core import (
     PackageRequirement,
     Page,
+    RagnaException,
     Requirement,
     Source,
     SourceStorage,
+    span,
+)
+
+from ._embedding_cache import (
+    DEFAULT_EMBEDDING_DIMENSIONS,
+    DEFAULT_EMBEDDING_MODEL,
+    embedding_cache_size,
+    get_cached_embedder,
+    get_default_embedding_function,
 )
+from ._keyword_index import KeywordIndex, reciprocal_rank_fusion
+
+if TYPE_CHECKING:
+    import numpy as np
+    import numpy.typing as npt
 
-T = TypeVar("T")
 
+def _window_bounds(num_tokens: int, *, size: int, step: int) -> npt.NDArray[np.int64]:
+    # Computes the [start, stop) token indices of windows with the given size that are
+    # step tokens apart. If the last full window doesn't reach the end, a ragged window
+    # with the remaining tokens is added.
+    import numpy as np
 
-# The function is adapted from more_itertools.windowed to allow a ragged last window
-# https://more-itertools.readthedocs.io/en/stable/api.html#more_itertools.windowed
-def _windowed_ragged(
-    iterable: Iterable[T], *, n: int, step: int
-) -> Iterator[tuple[T, ...]]:
-    window: Deque[T] = deque(maxlen=n)
-    i = n
-    for _ in map(window.append, iterable):
-        i -= 1
-        if not i:
-            i = step
-            yield tuple(window)
+    if num_tokens == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    elif num_tokens <= size:
+        return np.array([[0, num_tokens]], dtype=np.int64)
 
-    if len(window) < n:
-        yield tuple(window)
-    elif 0 < i < min(step, n):
-        yield tuple(window)[i:]
+    starts = np.arange(0, num_tokens - size + 1, step, dtype=np.int64)
+    stops = starts + size
+    if stops[-1] < num_tokens:
+        starts = np.append(starts, starts[-1] + step)
+        stops = np.append(stops, num_tokens)
+    return np.stack([starts, stops], axis=1)
 
 
 @dataclasses.dataclass
 class Chunk:
+    __slots__ = ("text", "page_numbers", "num_tokens", "start", "stop", "tokens")
+
     text: str
     page_numbers: Optional[list[int]]
     num_tokens: int
+    # [start, stop) token offsets of the chunk inside the document
+    start: int
+    stop: int
+    tokens: npt.NDArray[np.uint32]
+
+
+@dataclasses.dataclass
+class Hit:
+    __slots__ = ("source", "start", "stop")
+
+    source: Source
+    # Chunks stored before the offsets were recorded don't have them. They are never
+    # merged.
+    start: Optional[int]
+    stop: Optional[int]
 
 
 class VectorDatabaseSourceStorage(SourceStorage):
@@ -65,37 +102,214 @@ class VectorDatabaseSourceStorage(SourceStorage):
 
     def __init__(self) -> None:
         import chromadb.api
-        import chromadb.utils.embedding_functions
         import tiktoken
 
+        # The embedding function is shared by all source storages, such that
+        # concurrent calls are batched together.
         self._embedding_function = cast(
-            chromadb.api.types.EmbeddingFunction,
-            chromadb.utils.embedding_functions.DefaultEmbeddingFunction(),
+            chromadb.api.types.EmbeddingFunction, get_default_embedding_function()
+        )
+        self._embedding_model = DEFAULT_EMBEDDING_MODEL
+        self._embedding_dimensions = DEFAULT_EMBEDDING_DIMENSIONS
+        self._embedder = get_cached_embedder(
+            self._embedding_function,
+            model=self._embedding_model,
+            dimensions=self._embedding_dimensions,
+            cache_root=ragna.local_root() / "embeddings",
+            max_size=embedding_cache_size(),
         )
-        # https://huggingface.co/sentence-transformers/all-MiniLM-L6-v2#all-minilm-l6-v2
-        self._embedding_dimensions = 384
         self._tokenizer = tiktoken.get_encoding("cl100k_base")
+        self._keyword_indices: dict[str, KeywordIndex] = {}
+        self._keyword_indices_lock = threading.Lock()
+
+    def _embed(self, texts: list[str]) -> npt.NDArray[np.float32]:
+        return self._embedder.embed(texts)
+
+    def _embed_query(self, prompt: str) -> npt.NDArray[np.float32]:
+        return self._embedder.embed_query(prompt)
+
+    async def _aembed_query(self, prompt: str) -> npt.NDArray[np.float32]:
+        return await self._embedder.aembed_query(prompt)
 
     def _chunk_pages(
         self, pages: Iterable[Page], *, chunk_size: int, chunk_overlap: int
     ) -> Iterator[Chunk]:
-        for window in _windowed_ragged(
-            (
-                (tokens, page.number)
-                for page in pages
-                for tokens in self._tokenizer.encode(page.text)
-            ),
-            n=chunk_size,
-            step=chunk_size - chunk_overlap,
+        import numpy as np
+
+        if not (0 <= chunk_overlap < chunk_size):
+            raise RagnaException(
+                "chunk_overlap has to be non-negative and smaller than chunk_size",
+                chunk_size=chunk_size,
+                chunk_overlap=chunk_overlap,
+                http_status_code=400,
+                http_detail=RagnaException.MESSAGE,
+            )
+
+        with span("extract_pages") as extract_span:
+            pages = list(pages)
+            extract_span.set(num_pages=len(pages))
+
+        # Decoding the chunks is not included here, since it happens lazily while the
+        # chunks are consumed.
+        with span("chunk", chunk_size=chunk_size) as chunk_span:
+            page_tokens = self._tokenizer.encode_batch([page.text for page in pages])
+
+            # Instead of tracking the page number of every token, we store all tokens of
+            # the document in a flat array and keep the offsets of the page boundaries.
+            page_offsets = np.zeros(len(pages) + 1, dtype=np.int64)
+            np.cumsum([len(tokens) for tokens in page_tokens], out=page_offsets[1:])
+            tokens = np.fromiter(
+                itertools.chain.from_iterable(page_tokens),
+                dtype=np.uint32,
+                count=int(page_offsets[-1]),
+            )
+            del page_tokens
+
+            bounds = _window_bounds(
+                len(tokens), size=chunk_size, step=chunk_size - chunk_overlap
+            )
+            first_page_idcs = (
+                np.searchsorted(page_offsets, bounds[:, 0], side="right") - 1
+            )
+            last_page_idcs = (
+                np.searchsorted(page_offsets, bounds[:, 1] - 1, side="right") - 1
+            )
+            has_tokens = (np.diff(page_offsets) > 0).tolist()
+            chunk_span.set(num_tokens=len(tokens), num_chunks=len(bounds))
+
+        for (start, stop), first_page_idx, last_page_idx in zip(
+            bounds.tolist(), first_page_idcs.tolist(), last_page_idcs.tolist()
         ):
-            tokens, page_numbers = zip(*window)
             yield Chunk(
-                text=self._tokenizer.decode(tokens),  # type: ignore[arg-type]
-                page_numbers=list(filter(lambda n: n is not None, page_numbers))
+                text=self._tokenizer.decode(tokens[start:stop].tolist()),
+                page_numbers=[
+                    cast(int, pages[idx].number)
+                    for idx in range(first_page_idx, last_page_idx + 1)
+                    if has_tokens[idx] and pages[idx].number is not None
+                ]
                 or None,
-                num_tokens=len(tokens),
+                num_tokens=stop - start,
+                start=start,
+                stop=stop,
+                tokens=tokens[start:stop],
             )
 
+    def _keyword_index_path(self, collection_name: str) -> Path:
+        return (
+            ragna.local_root()
+            / "keyword_indices"
+            / type(self).__name__.lower()
+            / f"{collection_name}.npz"
+        )
+
+    def _keyword_index(self, collection_name: str) -> KeywordIndex:
+        with self._keyword_indices_lock:
+            index = self._keyword_indices.get(collection_name)
+            # The index might have been updated by another process in the meantime.
+            if index is None or index.is_stale():
+                index = self._keyword_indices[collection_name] = KeywordIndex(
+                    self._keyword_index_path(collection_name)
+                )
+            return index
+
+    def _index_keywords(
+        self,
+        collection_name: str,
+        chunks: dict[str, tuple[list[str], list[npt.NDArray[np.uint32]]]],
+        *,
+        replace: bool,
+    ) -> None:
+        # chunks maps document IDs to the IDs and tokens of their chunks.
+        # The lock makes sure that we don't overwrite the postings another process
+        # added after we loaded the index.
+        with file_lock(self._keyword_index_path(collection_name).with_suffix(".lock")):
+            index = self._keyword_index(collection_name)
+            if replace:
+                index.remove(list(chunks))
+            for document_id, (chunk_ids, chunk_tokens) in chunks.items():
+                index.add(document_id, chunk_ids, chunk_tokens)
+            index.save()
+
+    def _hybrid_hits(
+        self,
+        collection_name: str,
+        prompt: str,
+        vector_hits: list[Hit],
+        *,
+        limit: int,
+        document_ids: Optional[list[str]],
+        get_hits: Callable[[list[str]], list[Hit]],
+    ) -> list[Hit]:
+        keyword_ids = self._keyword_search(
+            collection_name, prompt, limit=limit, document_ids=document_ids
+        )
+        hits = {hit.source.id: hit for hit in vector_hits}
+        missing_ids = [id for id in keyword_ids if id not in hits]
+        if missing_ids:
+            hits.update((hit.source.id, hit) for hit in get_hits(missing_ids))
+        return self._fuse_hits(vector_hits, keyword_ids, hits)
+
+    async def _ahybrid_hits(
+        self,
+        collection_name: str,
+        prompt: str,
+        vector_hits: list[Hit],
+        *,
+        limit: int,
+        document_ids: Optional[list[str]],
+        get_hits: Callable[[list[str]], Awaitable[list[Hit]]],
+    ) -> list[Hit]:
+        keyword_ids = self._keyword_search(
+            collection_name, prompt, limit=limit, document_ids=document_ids
+        )
+        hits = {hit.source.id: hit for hit in vector_hits}
+        missing_ids = [id for id in keyword_ids if id not in hits]
+        if missing_ids:
+            hits.update((hit.source.id, hit) for hit in await get_hits(missing_ids))
+        return self._fuse_hits(vector_hits, keyword_ids, hits)
+
+    def _keyword_search(
+        self,
+        collection_name: str,
+        prompt: str,
+        *,
+        limit: int,
+        document_ids: Optional[list[str]],
+    ) -> list[str]:
+        with span("keyword_search") as search_span:
+            keyword_ids = self._keyword_index(collection_name).search(
+                self._tokenizer.encode(prompt, disallowed_special=()),
+                limit=limit,
+                document_ids=document_ids,
+            )
+            search_span.set(num_results=len(keyword_ids))
+        return keyword_ids
+
+    def _fuse_hits(
+        self, vector_hits: list[Hit], keyword_ids: list[str], hits: dict[str, Hit]
+    ) -> list[Hit]:
+        # The BM25 and vector rankings are fused with reciprocal rank fusion. Since
+        # it only relies on the ranks, we don't need to calibrate the scores of both
+        # searches against each other.
+        return [
+            hits[id]
+            for id in reciprocal_rank_fusion(
+                [hit.source.id for hit in vector_hits], keyword_ids
+            )
+            if id in hits
+        ]
+
+    def _shared_collection_name(self, *, chunk_size: int, chunk_overlap: int) -> str:
+        # Chunks are only reusable between chats that use the same chunking parameters.
+        return f"ragna-shared-{chunk_size}-{chunk_overlap}"
+
+    def _chunk_id(
+        self, document_id: uuid.UUID, idx: int, *, chunk_size: int, chunk_overlap: int
+    ) -> str:
+        # The IDs are deterministic to make storing a document idempotent and to allow
+        # sources from a shared collection to be used by multiple chats.
+        return str(uuid.uuid5(document_id, f"{chunk_size}-{chunk_overlap}-{idx}"))
+
     def _page_numbers_to_str(self, page_numbers: Optional[Iterable[int]]) -> str:
         if not page_numbers:
             return ""
@@ -122,17 +336,109 @@ class VectorDatabaseSourceStorage(SourceStorage):
 
         return ", ".join(ranges_str)
 
+    def _page_numbers_from_str(self, page_numbers_str: str) -> list[int]:
+        page_numbers: list[int] = []
+        for range_str in filter(None, page_numbers_str.split(", ")):
+            first, _, last = range_str.partition("-")
+            page_numbers.extend(range(int(first), int(last or first) + 1))
+        return page_numbers
+
+    @staticmethod
+    def _is_connected(group: list[Hit], hit: Hit) -> bool:
+        if hit.start is None or hit.stop is None:
+            return False
+        first = group[0]
+        if first.start is None or first.source.document.id != hit.source.document.id:
+            return False
+        start = min(cast(int, h.start) for h in group)
+        stop = max(cast(int, h.stop) for h in group)
+        return hit.start <= stop and start <= hit.stop
+
+    @staticmethod
+    def _group_num_tokens(group: list[Hit]) -> int:
+        if len(group) == 1:
+            return group[0].source.num_tokens
+        return max(cast(int, hit.stop) for hit in group) - min(
+            cast(int, hit.start) for hit in group
+        )
+
+    def _merge_hits(self, group: list[Hit]) -> Source:
+        if len(group) == 1:
+            return group[0].source
+
+        hits = sorted(group, key=lambda hit: cast(int, hit.start))
+        texts = [hits[0].source.content]
+        stop = cast(int, hits[0].stop)
+        for hit in hits[1:]:
+            hit_stop = cast(int, hit.stop)
+            if hit_stop <= stop:
+                continue
+
+            num_overlap = stop - cast(int, hit.start)
+            if num_overlap == 0:
+                texts.append(hit.source.content)
+            else:
+                tokens = self._tokenizer.encode(hit.source.content)
+                overlap = self._tokenizer.decode(tokens[:num_overlap])
+                texts.append(
+                    hit.source.content[len(overlap) :]
+                    if hit.source.content.startswith(overlap)
+                    else self._tokenizer.decode(tokens[num_overlap:])
+                )
+            stop = hit_stop
+
+        return Source(
+            # The ID is deterministic to be able to recognize the same merged source
+            # across multiple messages.
+            id=str(
+                uuid.uuid5(
+                    uuid.NAMESPACE_OID,
+                    ",".join(sorted(hit.source.id for hit in group)),
+                )
+            ),
+            document=hits[0].source.document,
+            location=self._page_numbers_to_str(
+                itertools.chain.from_iterable(
+                    self._page_numbers_from_str(hit.source.location) for hit in hits
+                )
+            ),
+            content="".join(texts),
+            num_tokens=self._group_num_tokens(group),
+        )
+
     def _take_sources_up_to_max_tokens(
-        self, sources: Iterable[Source], *, max_tokens: int
+        self, hits: Iterable[Hit], *, max_tokens: int
     ) -> list[Source]:
-        taken_sources = []
+        # Neighboring chunks share chunk_overlap tokens. Hits of the same document that
+        # overlap or touch are thus merged into a single source before budgeting.
+        # Otherwise, the shared tokens would be sent twice. A merged source takes the
+        # position of its most relevant hit.
+        groups: list[list[Hit]] = []
         total = 0
-        for source in sources:
-            new_total = total + source.num_tokens
+        for hit in hits:
+            connected = [
+                idx
+                for idx, group in enumerate(groups)
+                if self._is_connected(group, hit)
+            ]
+            merged = [
+                *itertools.chain.from_iterable(groups[idx] for idx in connected),
+                hit,
+            ]
+            new_total = (
+                total
+                - sum(self._group_num_tokens(groups[idx]) for idx in connected)
+                + self._group_num_tokens(merged)
+            )
             if new_total > max_tokens:
                 break
 
-            taken_sources.append(source)
+            if connected:
+                groups[connected[0]] = merged
+                for idx in reversed(connected[1:]):
+                    del groups[idx]
+            else:
+                groups.append(merged)
             total = new_total
 
-        return taken_sources
+        return [self._merge_hits(group) for group in groups]
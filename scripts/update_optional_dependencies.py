@@ -17,6 +17,7 @@ def main():
     optional_dependencies = make_optional_dependencies(
         extract_builtin_document_handler_requirements(),
         extract_builtin_component_requirements(),
+        extract_deploy_requirements(),
     )
     update_pyproject_toml(optional_dependencies)
 
@@ -57,6 +58,17 @@ def extract_builtin_component_requirements():
     return dict(requirements)
 
 
+def extract_deploy_requirements():
+    from ragna.deploy._api import metrics
+
+    requirements = defaultdict(list)
+    for requirement in [metrics.REQUIREMENT]:
+        requirement = requirement._requirement
+        requirements[requirement.name].append(requirement.specifier)
+
+    return dict(requirements)
+
+
 def update_pyproject_toml(optional_dependencies):
     with open(PYPROJECT_TOML) as file:
         document = tomlkit.load(file)
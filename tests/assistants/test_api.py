@@ -0,0 +1,444 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import ragna
+from ragna import Rag
+from ragna.assistants import Claude, ClaudeInstant, Mpt7bInstruct, _rate_limit
+from ragna.assistants._api import ResponseCache, _parse_retry_after
+from ragna.assistants._rate_limit import RateLimiter
+from ragna.core import HttpClientPool, LocalDocument, RagnaException, Source
+
+
+def make_assistant(cls, monkeypatch, handler, **kwargs):
+    monkeypatch.setenv(cls._API_KEY_ENV_VAR, "SECRET")
+    assistant = cls(**kwargs)
+    assistant._http_client_pool = HttpClientPool(transport=httpx.MockTransport(handler))
+    return assistant
+
+
+def answer(assistant, prompt="?"):
+    async def main():
+        return [chunk async for chunk in assistant.answer(prompt, [])]
+
+    return asyncio.run(main())
+
+
+def completion_stream(request):
+    return httpx.Response(
+        200,
+        text=(
+            'event: completion\ndata: {"completion": "Hello"}\n\n'
+            'event: completion\ndata: {"completion": " World"}\n\n'
+        ),
+    )
+
+
+def test_shared_http_client(tmp_local_root, monkeypatch):
+    user_agents = []
+
+    def handler(request):
+        user_agents.append(request.headers["User-Agent"])
+        return completion_stream(request)
+
+    monkeypatch.setenv(Claude._API_KEY_ENV_VAR, "SECRET")
+    monkeypatch.setenv(Mpt7bInstruct._API_KEY_ENV_VAR, "SECRET")
+    pool = HttpClientPool(transport=httpx.MockTransport(handler))
+    rag = Rag(http_client_pool=pool)
+    claude = rag._load_component(Claude(response_cache=False))
+    mpt = rag._load_component(Mpt7bInstruct)
+
+    async def main():
+        async with rag:
+            answer = [chunk async for chunk in claude.answer("?", [])]
+            client = pool.client
+            assert mpt._http_client is client
+            return answer, client
+
+    answer, client = asyncio.run(main())
+
+    assert answer == ["Hello", " World"]
+    assert client.is_closed
+    assert user_agents == [f"{ragna.__version__}/{claude}"]
+
+
+def test_stream_cached(tmp_local_root, monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return completion_stream(request)
+
+    assistant = make_assistant(Claude, monkeypatch, handler, response_cache=True)
+
+    assert answer(assistant) == ["Hello", " World"]
+    assert answer(assistant) == ["Hello", " World"]
+    assert len(requests) == 1
+
+    answer(assistant, prompt="!")
+    assert len(requests) == 2
+
+
+def test_stream_not_cached_if_interrupted(tmp_local_root, monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return completion_stream(request)
+
+    assistant = make_assistant(Claude, monkeypatch, handler, response_cache=True)
+
+    async def first_chunk():
+        async for chunk in assistant.answer("?", []):
+            return chunk
+
+    assert asyncio.run(first_chunk()) == "Hello"
+    assert answer(assistant) == ["Hello", " World"]
+    assert len(requests) == 2
+
+
+def test_json_cached(tmp_local_root, monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"outputs": ["Hello World"]})
+
+    assistant = make_assistant(Mpt7bInstruct, monkeypatch, handler, response_cache=True)
+
+    assert answer(assistant) == ["Hello World"]
+    assert answer(assistant) == ["Hello World"]
+    assert len(requests) == 1
+
+
+def test_errors_not_cached(tmp_local_root, monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(400, json={"error": "Bad Request"})
+
+    assistant = make_assistant(Mpt7bInstruct, monkeypatch, handler, response_cache=True)
+
+    for _ in range(2):
+        with pytest.raises(RagnaException):
+            answer(assistant)
+    assert len(requests) == 2
+
+
+def test_retry(tmp_local_root, monkeypatch):
+    responses = [
+        httpx.Response(429, headers={"Retry-After": "0.01"}),
+        httpx.Response(503),
+        httpx.Response(200, json={"outputs": ["Hello World"]}),
+    ]
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return responses[len(requests) - 1]
+
+    assistant = make_assistant(
+        Mpt7bInstruct, monkeypatch, handler, response_cache=False, backoff_base=0.01
+    )
+
+    assert answer(assistant) == ["Hello World"]
+    assert len(requests) == 3
+
+
+def test_retry_exhausted(tmp_local_root, monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        raise httpx.ConnectError("Connection refused")
+
+    assistant = make_assistant(
+        Claude, monkeypatch, handler, max_retries=2, backoff_base=0.01
+    )
+
+    with pytest.raises(RagnaException, match="ConnectError"):
+        answer(assistant)
+    assert len(requests) == 3
+
+
+def test_retry_attempt_timeout(tmp_local_root, monkeypatch):
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        if len(requests) == 1:
+            await asyncio.sleep(1)
+        return completion_stream(request)
+
+    assistant = make_assistant(
+        Claude, monkeypatch, handler, attempt_timeout=0.05, backoff_base=0.01
+    )
+
+    assert answer(assistant) == ["Hello", " World"]
+    assert len(requests) == 2
+
+
+def test_hedge(tmp_local_root, monkeypatch):
+    requests = []
+
+    async def handler(request):
+        requests.append(request)
+        if len(requests) == 1:
+            await asyncio.sleep(1)
+        return completion_stream(request)
+
+    assistant = make_assistant(
+        Claude,
+        monkeypatch,
+        handler,
+        response_cache=False,
+        hedge=True,
+        hedge_min_samples=2,
+    )
+    assistant._latencies.extend([0.01, 0.02])
+
+    start = time.perf_counter()
+    assert answer(assistant) == ["Hello", " World"]
+    assert time.perf_counter() - start < 0.5
+    assert len(requests) == 2
+
+
+def test_retry_after():
+    assert _parse_retry_after(None) is None
+    assert _parse_retry_after("1.5") == 1.5
+    assert _parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert _parse_retry_after("soon") is None
+
+
+def test_disabled(tmp_local_root, monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return completion_stream(request)
+
+    assistant = make_assistant(Claude, monkeypatch, handler, response_cache=False)
+
+    answer(assistant)
+    answer(assistant)
+    assert len(requests) == 2
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.sqlite", max_size=10)
+
+    cache.put(b"a", "aaa")
+    time.sleep(0.01)
+    cache.put(b"b", "bbb")
+    time.sleep(0.01)
+    assert cache.get(b"a") == "aaa"
+    time.sleep(0.01)
+    cache.put(b"c", "ccc")
+
+    assert cache.get(b"b") is None
+    assert cache.get(b"a") == "aaa"
+    assert cache.get(b"c") == "ccc"
+    assert cache.stats() == dict(hits=3, misses=1, evictions=1, size=2)
+
+
+@pytest.fixture
+def rate_limiters(monkeypatch):
+    monkeypatch.setattr(_rate_limit, "_RATE_LIMITERS", {})
+
+
+def test_rate_limiter_fifo():
+    limiter = RateLimiter(tokens_per_minute=60_000)
+    order = []
+
+    async def call(idx, num_tokens):
+        async with limiter.limit(num_tokens):
+            order.append(idx)
+
+    async def main():
+        # Drain the bucket. Afterwards, it refills with 1000 tokens per second.
+        await call(-1, 60_000)
+        start = time.monotonic()
+        await asyncio.gather(call(0, 200), call(1, 50), call(2, 100))
+        return time.monotonic() - start
+
+    duration = asyncio.run(main())
+
+    assert order == [-1, 0, 1, 2]
+    assert duration == pytest.approx(0.35, abs=0.1)
+
+
+def test_rate_limiter_concurrency():
+    limiter = RateLimiter(max_concurrent_requests=2)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def call():
+        nonlocal in_flight, max_in_flight
+        async with limiter.limit():
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    async def main():
+        await asyncio.gather(*[call() for _ in range(6)])
+
+    asyncio.run(main())
+
+    assert max_in_flight == 2
+
+
+def test_rate_limit(tmp_local_root, monkeypatch, rate_limiters):
+    assistant = make_assistant(
+        Claude,
+        monkeypatch,
+        completion_stream,
+        response_cache=True,
+        tokens_per_minute=10_000,
+    )
+    other = make_assistant(ClaudeInstant, monkeypatch, completion_stream)
+    assert other._rate_limiter is assistant._rate_limiter
+
+    sources = [
+        Source(
+            id="id",
+            document=LocalDocument(name="document.txt", metadata={}),
+            location="",
+            content="",
+            num_tokens=1_000,
+        )
+    ]
+
+    async def main():
+        return [
+            chunk
+            async for chunk in assistant.answer("?" * 40, sources, max_new_tokens=100)
+        ]
+
+    tokens = assistant._rate_limiter._tokens
+    assert asyncio.run(main()) == ["Hello", " World"]
+    assert tokens._level == pytest.approx(10_000 - 1_110, abs=5)
+
+    # Cached responses don't count against the limit.
+    assert asyncio.run(main()) == ["Hello", " World"]
+    assert tokens._level == pytest.approx(10_000 - 1_110, abs=10)
+
+
+def test_rate_limit_conflict(tmp_local_root, monkeypatch, rate_limiters):
+    make_assistant(Claude, monkeypatch, completion_stream, tokens_per_minute=10_000)
+    make_assistant(
+        ClaudeInstant, monkeypatch, completion_stream, tokens_per_minute=10_000
+    )
+
+    with pytest.raises(RagnaException, match="conflict"):
+        make_assistant(
+            ClaudeInstant, monkeypatch, completion_stream, tokens_per_minute=20_000
+        )
+
+
+def test_rate_limit_retries(tmp_local_root, monkeypatch, rate_limiters):
+    responses = [
+        httpx.Response(503),
+        httpx.Response(503),
+        httpx.Response(200, json={"outputs": ["Hello World"]}),
+    ]
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return responses[len(requests) - 1]
+
+    assistant = make_assistant(
+        Mpt7bInstruct,
+        monkeypatch,
+        handler,
+        response_cache=False,
+        backoff_base=0.01,
+        requests_per_minute=60,
+    )
+
+    assert answer(assistant) == ["Hello World"]
+    assert len(requests) == 3
+    # Every attempt counts against the limit rather than just the first one.
+    assert assistant._rate_limiter._requests._level == pytest.approx(60 - 3, abs=0.1)
+
+
+def make_source(content):
+    return Source(
+        id=content,
+        document=LocalDocument(name="document.txt", metadata={}),
+        location="",
+        content=content,
+        num_tokens=0,
+    )
+
+
+class TestPackSources:
+    @pytest.fixture
+    def assistant(self, tmp_local_root, monkeypatch):
+        class TinyClaude(Claude):
+            _CONTEXT_SIZE = 200
+
+        return make_assistant(TinyClaude, monkeypatch, completion_stream)
+
+    def test_relevance_order(self, assistant):
+        large = make_source("large " * 150)
+        small = make_source("small " * 20)
+        smaller = make_source("smaller " * 10)
+
+        packed = assistant._pack_sources(
+            "?", [small, large, smaller], max_new_tokens=50
+        )
+
+        assert packed == [small, smaller]
+        assert assistant._count_prompt_tokens("?", packed) <= 150
+
+    def test_prompt_too_large(self, assistant):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return completion_stream(request)
+
+        assistant._http_client_pool = HttpClientPool(
+            transport=httpx.MockTransport(handler)
+        )
+
+        with pytest.raises(RagnaException, match="context window") as info:
+            answer(assistant, prompt="prompt " * 200)
+
+        assert info.value.http_status_code == 400
+        assert not requests
+
+    def test_answer(self, tmp_local_root, assistant):
+        prompts = []
+
+        def handler(request):
+            prompts.append(json.loads(request.content)["prompt"])
+            return completion_stream(request)
+
+        assistant._http_client_pool = HttpClientPool(
+            transport=httpx.MockTransport(handler)
+        )
+        sources = [make_source("first"), make_source("second " * 500)]
+
+        async def main():
+            return [chunk async for chunk in assistant.answer("?", sources)]
+
+        with pytest.raises(RagnaException, match="context window"):
+            asyncio.run(main())
+
+        async def main():
+            return [
+                chunk
+                async for chunk in assistant.answer("?", sources, max_new_tokens=100)
+            ]
+
+        assert asyncio.run(main()) == ["Hello", " World"]
+        (prompt,) = prompts
+        assert "first" in prompt
+        assert "second" not in prompt
@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+import pytest
+
+from ragna.core import SemanticAnswerCache
+
+
+def embedding_function(texts):
+    # Bag of letters, which makes prompts that only differ in punctuation or case
+    # identical.
+    embeddings = np.zeros((len(texts), 26), dtype=np.float32)
+    for idx, text in enumerate(texts):
+        for char in text.lower():
+            if "a" <= char <= "z":
+                embeddings[idx, ord(char) - ord("a")] += 1
+    return embeddings
+
+
+@pytest.fixture
+def cache():
+    return SemanticAnswerCache(embedding_function, similarity_threshold=0.99)
+
+
+def test_hit(cache):
+    cache.put("key", cache.embed("What is Ragna?"), "An OSS RAG framework", [])
+
+    assert cache.get("key", cache.embed("what is ragna")) == (
+        "An OSS RAG framework",
+        [],
+    )
+    assert cache.stats()["hits"] == 1
+
+
+def test_miss_dissimilar(cache):
+    cache.put("key", cache.embed("What is Ragna?"), "An OSS RAG framework", [])
+
+    assert cache.get("key", cache.embed("Who maintains it?")) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_miss_other_key(cache):
+    cache.put("key", cache.embed("What is Ragna?"), "An OSS RAG framework", [])
+
+    assert cache.get("other_key", cache.embed("What is Ragna?")) is None
+
+
+def test_ttl():
+    cache = SemanticAnswerCache(embedding_function, ttl=0.05)
+    embedding = cache.embed("What is Ragna?")
+    cache.put("key", embedding, "An OSS RAG framework", [])
+
+    time.sleep(0.1)
+
+    assert cache.get("key", embedding) is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = SemanticAnswerCache(embedding_function, max_size=2)
+    prompts = ["aaa", "bbb", "ccc"]
+    embeddings = {prompt: cache.embed(prompt) for prompt in prompts}
+
+    cache.put("key", embeddings["aaa"], "a", [])
+    time.sleep(0.01)
+    cache.put("key", embeddings["bbb"], "b", [])
+    time.sleep(0.01)
+    assert cache.get("key", embeddings["aaa"]) is not None
+    cache.put("key", embeddings["ccc"], "c", [])
+
+    assert cache.get("key", embeddings["bbb"]) is None
+    assert cache.get("key", embeddings["aaa"]) == ("a", [])
+    assert cache.get("key", embeddings["ccc"]) == ("c", [])
+    assert cache.stats()["evictions"] == 1
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+from ragna import Rag, assistants
+from ragna.core import (
+    ComponentExecutor,
+    Document,
+    LocalDocument,
+    RagnaException,
+    Source,
+    SourceStorage,
+)
+
+
+class ConcurrencyTracker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.max = 0
+        self.threads = set()
+
+    def __call__(self, delay=0.02):
+        with self._lock:
+            self.current += 1
+            self.max = max(self.max, self.current)
+            self.threads.add(threading.current_thread().name)
+        time.sleep(delay)
+        with self._lock:
+            self.current -= 1
+
+
+class SyncSourceStorage(SourceStorage):
+    def __init__(self):
+        self.store_tracker = ConcurrencyTracker()
+        self.retrieve_tracker = ConcurrencyTracker()
+
+    def store(self, documents: list[Document], *, chat_id: uuid.UUID) -> None:
+        self.store_tracker()
+
+    def retrieve(
+        self, documents: list[Document], prompt: str, *, chat_id: uuid.UUID
+    ) -> list[Source]:
+        self.retrieve_tracker()
+        return []
+
+
+@pytest.fixture()
+def demo_document(tmp_path):
+    path = tmp_path / "demo_document.txt"
+    path.write_text("demo\n")
+    return LocalDocument.from_path(path)
+
+
+def test_max_workers():
+    executor = ComponentExecutor(max_workers=2)
+    tracker = ConcurrencyTracker()
+
+    async def main():
+        await asyncio.gather(*[executor.run(tracker) for _ in range(6)])
+
+    asyncio.run(main())
+    # The limiter is recreated for a new event loop.
+    asyncio.run(main())
+
+    assert tracker.max == 2
+
+
+def test_invalid_max_workers():
+    with pytest.raises(RagnaException, match="max_workers"):
+        ComponentExecutor(max_workers=0)
+
+
+def test_processes():
+    executor = ComponentExecutor(max_workers=1, processes=True)
+    try:
+        pid = asyncio.run(executor.run(os.getpid))
+    finally:
+        executor.shutdown()
+
+    assert pid != os.getpid()
+
+
+def test_rag_executors(demo_document):
+    source_storage = SyncSourceStorage()
+    rag = Rag(
+        executors={"SyncSourceStorage": {"store": ComponentExecutor(max_workers=1)}}
+    )
+
+    async def main():
+        chats = [
+            rag.chat(
+                documents=[demo_document],
+                source_storage=source_storage,
+                assistant=assistants.RagnaDemoAssistant,
+            )
+            for _ in range(4)
+        ]
+        await asyncio.gather(*[chat.prepare() for chat in chats])
+        await asyncio.gather(*[chat.answer("?") for chat in chats])
+
+    asyncio.run(main())
+
+    assert source_storage.store_tracker.max == 1
+    assert source_storage.retrieve_tracker.max > 1
+
+
+def test_declared_executors(demo_document):
+    class DeclaredSourceStorage(SyncSourceStorage):
+        __ragna_executors__ = {"retrieve": ComponentExecutor(max_workers=1)}
+
+    source_storage = DeclaredSourceStorage()
+
+    async def main():
+        chats = [
+            Rag().chat(
+                documents=[demo_document],
+                source_storage=source_storage,
+                assistant=assistants.RagnaDemoAssistant,
+            )
+            for _ in range(4)
+        ]
+        await asyncio.gather(*[chat.prepare() for chat in chats])
+        await asyncio.gather(*[chat.answer("?") for chat in chats])
+
+    asyncio.run(main())
+
+    assert source_storage.retrieve_tracker.max == 1
+    assert source_storage.store_tracker.max > 1
+
+
+def test_unknown_method(demo_document):
+    rag = Rag(executors={"SyncSourceStorage": {"prepare": ComponentExecutor()}})
+
+    with pytest.raises(RagnaException, match="protocol methods"):
+        rag.chat(
+            documents=[demo_document],
+            source_storage=SyncSourceStorage(),
+            assistant=assistants.RagnaDemoAssistant,
+        )
@@ -1,8 +1,17 @@
+import asyncio
+import uuid
+
 import pydantic
 import pytest
 
 from ragna import Rag, assistants, source_storages
-from ragna.core import LocalDocument
+from ragna.core import (
+    Document,
+    LocalDocument,
+    SemanticAnswerCache,
+    Source,
+    span,
+)
 
 
 @pytest.fixture()
@@ -37,3 +46,138 @@ class TestChat:
         assert isinstance(document, LocalDocument)
         assert document.path == demo_document.path
         assert document.name == demo_document.name
+
+    def test_answer_stream(self, demo_document):
+        async def main():
+            async with self.chat(documents=[demo_document]) as chat:
+                answer = await chat.answer("?", stream=True)
+                chunks = [chunk async for chunk in answer]
+                return answer, chunks
+
+        answer, chunks = asyncio.run(main())
+
+        assert len(chunks) > 1
+        assert answer.content == "".join(chunks)
+        assert str(demo_document.name) in answer.content
+
+    def test_timings(self, demo_document):
+        sunk = []
+
+        async def main():
+            rag = Rag(record_timings=True, timing_sink=sunk.append)
+            async with rag.chat(
+                documents=[demo_document],
+                source_storage=source_storages.RagnaDemoSourceStorage,
+                assistant=assistants.RagnaDemoAssistant,
+            ) as chat:
+                answer = await chat.answer("?", stream=True)
+                answer_spans_before_stream = {span.name for span in answer.timings}
+                _ = [chunk async for chunk in answer]
+                return chat, answer, answer_spans_before_stream
+
+        chat, answer, answer_spans_before_stream = asyncio.run(main())
+
+        welcome = chat._messages[0]
+        assert [span.name for span in welcome.timings] == ["store"]
+
+        assert answer_spans_before_stream == {"retrieve"}
+        assert [span.name for span in answer.timings] == ["retrieve", "answer"]
+        answer_span = answer.timings[1]
+        assert answer_span.attributes["component"] == "Ragna/DemoAssistant"
+        assert answer_span.attributes["num_chunks"] > 1
+        assert 0 <= answer_span.attributes["time_to_first_chunk"]
+        assert answer_span.attributes["time_to_first_chunk"] <= answer_span.duration
+
+        assert sunk == [welcome.timings, answer.timings]
+
+    def test_timings_failed_answer(self, demo_document):
+        class FailingAssistant(assistants.RagnaDemoAssistant):
+            async def answer(self, prompt, sources):
+                with span("generate"):
+                    yield "Hello"
+                raise RuntimeError("failed")
+
+        sunk = []
+
+        async def main():
+            async with Rag(timing_sink=sunk.append).chat(
+                documents=[demo_document],
+                source_storage=source_storages.RagnaDemoSourceStorage,
+                assistant=FailingAssistant,
+            ) as chat:
+                await chat.answer("?")
+
+        with pytest.raises(RuntimeError, match="failed"):
+            asyncio.run(main())
+
+        assert [[span.name for span in spans] for spans in sunk] == [
+            ["store"],
+            ["retrieve", "generate", "answer"],
+        ]
+        assert sunk[-1][-1].attributes["num_chunks"] == 1
+
+    def test_timings_disabled(self, demo_document):
+        async def main():
+            async with self.chat(documents=[demo_document]) as chat:
+                return await chat.answer("?")
+
+        answer = asyncio.run(main())
+
+        assert answer.timings == []
+
+    def test_timings_sink_only(self, demo_document):
+        sunk = []
+
+        async def main():
+            async with Rag(timing_sink=sunk.append).chat(
+                documents=[demo_document],
+                source_storage=source_storages.RagnaDemoSourceStorage,
+                assistant=assistants.RagnaDemoAssistant,
+            ) as chat:
+                return await chat.answer("?")
+
+        answer = asyncio.run(main())
+
+        assert answer.timings == []
+        assert [[span.name for span in spans] for spans in sunk] == [
+            ["store"],
+            ["retrieve", "answer"],
+        ]
+
+    def test_answer_cache(self, demo_document):
+        # Every prompt is considered similar.
+        cache = SemanticAnswerCache(lambda texts: [[1.0] for _ in texts])
+        rag = Rag(answer_cache=cache)
+
+        class CountingSourceStorage(source_storages.RagnaDemoSourceStorage):
+            num_retrieve_calls = 0
+
+            async def retrieve(
+                self, documents: list[Document], prompt: str, *, chat_id: uuid.UUID
+            ) -> list[Source]:
+                type(self).num_retrieve_calls += 1
+                return await super().retrieve(documents, prompt, chat_id=chat_id)
+
+        async def answer(documents, prompt, *, stream=False):
+            async with rag.chat(
+                documents=documents,
+                source_storage=CountingSourceStorage,
+                assistant=assistants.RagnaDemoAssistant,
+            ) as chat:
+                return await chat.answer(prompt, stream=stream)
+
+        async def main():
+            first = await answer([demo_document], "?")
+            second = await answer([demo_document], "!", stream=True)
+            await second.read()
+            other_documents = await answer([demo_document, demo_document], "?")
+            return first, second, other_documents
+
+        first, second, other_documents = asyncio.run(main())
+
+        assert second.content == first.content
+        assert [source.id for source in second.sources] == [
+            source.id for source in first.sources
+        ]
+        assert CountingSourceStorage.num_retrieve_calls == 2
+        assert cache.stats()["hits"] == 1
@@ -0,0 +1,70 @@
+import asyncio
+
+from ragna.core import MessageRole
+from ragna.deploy._api import database, schemas
+
+
+async def add_messages(user, source_id):
+    engine = database.create_engine("sqlite://")
+    await database.create_tables(engine)
+    make_session = database.get_sessionmaker(engine)
+
+    try:
+        async with make_session() as session:
+            document = schemas.Document(name="document.txt")
+            await database.add_document(
+                session, user=user, document=document, metadata={}
+            )
+            chat = schemas.Chat(
+                metadata=schemas.ChatMetadata(
+                    name="chat",
+                    documents=[document],
+                    source_storage="source_storage",
+                    assistant="assistant",
+                    params={},
+                )
+            )
+            await database.add_chat(session, user=user, chat=chat)
+
+            source = schemas.Source(id=source_id, document=document, location="1")
+            welcome = schemas.Message(content="welcome", role=MessageRole.SYSTEM)
+            await database.add_messages(
+                session, user=user, chat_id=chat.id, messages=[welcome], prepared=True
+            )
+            for idx in range(2):
+                # Sources that are already stored are reused rather than inserted again.
+                await database.add_messages(
+                    session,
+                    user=user,
+                    chat_id=chat.id,
+                    messages=[
+                        schemas.Message(content=f"prompt {idx}", role=MessageRole.USER),
+                        schemas.Message(
+                            content=f"answer {idx}",
+                            role=MessageRole.ASSISTANT,
+                            sources=[source],
+                        ),
+                    ],
+                )
+
+            return await database.get_chat(session, user=user, id=chat.id)
+    finally:
+        await engine.dispose()
+
+
+def test_add_messages():
+    source_id = "source"
+
+    chat = asyncio.run(add_messages("user", source_id))
+
+    assert chat.prepared
+    assert [message.content for message in chat.messages] == [
+        "welcome",
+        "prompt 0",
+        "answer 0",
+        "prompt 1",
+        "answer 1",
+    ]
+    assert [
+        [source.id for source in message.sources] for message in chat.messages[2::2]
+    ] == [[source_id], [source_id]]
@@ -1,4 +1,6 @@
+import json
 import os
+import time
 
 import httpx
 import pytest
@@ -17,11 +19,16 @@ def test_e2e(tmp_local_root, database):
         database_url = f"sqlite:///{tmp_local_root / 'ragna.db'}"
 
     config = Config(
-        local_cache_root=tmp_local_root, api=dict(database_url=database_url)
+        local_cache_root=tmp_local_root,
+        api=dict(database_url=database_url, metrics=True),
     )
     check_api(config)
 
 
+def parse_jsonl(lines):
+    return [json.loads(line) for line in lines if line]
+
+
 @timeout_after()
 def check_api(config):
     document_root = config.local_cache_root / "documents"
@@ -97,13 +104,27 @@ def check_api(config):
         assert client.get("/chats").raise_for_status().json() == [chat]
         assert client.get(f"/chats/{chat['id']}").raise_for_status().json() == chat
 
-        json = client.post(f"/chats/{chat['id']}/prepare").raise_for_status().json()
-        message, chat = json["message"], json["chat"]
-        assert message["role"] == "system"
-        assert message["sources"] == []
+        job = client.post(f"/chats/{chat['id']}/prepare").raise_for_status().json()
+        assert job["chat_id"] == chat["id"]
+        assert [job_document["document"] for job_document in job["documents"]] == [
+            document
+        ]
+        while job["status"] in {"pending", "running"}:
+            time.sleep(0.1)
+            job = client.get(f"/jobs/{job['id']}").raise_for_status().json()
+        assert job["status"] == "succeeded"
+        assert job["stage"] == "done"
+        assert all(job_document["stored"] for job_document in job["documents"])
+        assert client.post(f"/jobs/{job['id']}/cancel").raise_for_status().json() == job
+
+        chat = client.get(f"/chats/{chat['id']}").raise_for_status().json()
         assert chat["prepared"]
         assert len(chat["messages"]) == 1
-        assert chat["messages"][-1] == message
+        message = chat["messages"][-1]
+        assert message["role"] == "system"
+        assert message["sources"] == []
+
+        assert client.post(f"/chats/{chat['id']}/prepare").status_code == 400
 
         prompt = "?"
         json = (
@@ -124,5 +145,39 @@ def check_api(config):
         )
         assert chat["messages"][-1] == message
 
+        with client.stream(
+            "POST",
+            f"/chats/{chat['id']}/answer",
+            params={"prompt": prompt, "stream": True},
+        ) as response:
+            chunks = parse_jsonl(response.raise_for_status().iter_lines())
+        assert len(chunks) > 1
+        message = chunks[0]
+        assert message["role"] == "assistant"
+        assert {source["document"]["name"] for source in message["sources"]} == {
+            document_path.name
+        }
+        assert all(chunk["id"] == message["id"] for chunk in chunks)
+        assert all(chunk["sources"] == [] for chunk in chunks[1:])
+
+        chat = client.get(f"/chats/{chat['id']}").raise_for_status().json()
+        assert len(chat["messages"]) == 5
+        assert chat["messages"][-1]["id"] == message["id"]
+        assert chat["messages"][-1]["content"] == "".join(
+            chunk["content"] for chunk in chunks
+        )
+        assert chat["messages"][-1]["sources"] == message["sources"]
+
         client.delete(f"/chats/{chat['id']}").raise_for_status()
         assert client.get("/chats").raise_for_status().json() == []
+
+        metrics = client.get("/metrics").raise_for_status().text
+        assert (
+            'ragna_http_request_duration_seconds_count{method="POST",'
+            'route="/chats/{id}/answer",status="200"} 2.0'
+        ) in metrics
+        assert (
+            'ragna_component_duration_seconds_count{component="Ragna/DemoAssistant",'
+            'method="answer"} 2.0'
+        ) in metrics
+        assert 'ragna_database_queries_total{statement="SELECT"}' in metrics
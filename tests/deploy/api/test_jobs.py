@@ -0,0 +1,154 @@
+import asyncio
+import uuid
+
+from ragna import Rag, assistants, source_storages
+from ragna.core import Document, LocalDocument, MessageRole
+from ragna.deploy._api import database, schemas
+from ragna.deploy._api.jobs import JobQueue
+
+
+class RecordingSourceStorage(source_storages.RagnaDemoSourceStorage):
+    def __init__(self):
+        super().__init__()
+        self.stored = []
+
+    async def store(self, documents: list[Document], *, chat_id: uuid.UUID) -> None:
+        self.stored.extend(document.name for document in documents)
+        await super().store(documents, chat_id=chat_id)
+
+
+async def resume_job(tmp_path, user):
+    engine = database.create_engine("sqlite://")
+    await database.create_tables(engine)
+    make_session = database.get_sessionmaker(engine)
+    source_storage = RecordingSourceStorage()
+
+    async def make_core_chat(session, *, user, chat):
+        core_chat = Rag().chat(
+            documents=[
+                LocalDocument(id=document.id, name=document.name, metadata=metadata)
+                for document, metadata in await database.get_documents(
+                    session,
+                    user=user,
+                    ids=[document.id for document in chat.metadata.documents],
+                )
+            ],
+            source_storage=source_storage,
+            assistant=assistants.RagnaDemoAssistant,
+            chat_id=chat.id,
+        )
+        core_chat._prepared = chat.prepared
+        return core_chat
+
+    try:
+        async with make_session() as session:
+            documents = []
+            for name in ["stored.txt", "pending.txt"]:
+                path = tmp_path / name
+                path.write_text(f"{name}\n")
+                document = schemas.Document(name=name)
+                await database.add_document(
+                    session, user=user, document=document, metadata={"path": str(path)}
+                )
+                documents.append(document)
+
+            chat = schemas.Chat(
+                metadata=schemas.ChatMetadata(
+                    name="chat",
+                    documents=documents,
+                    source_storage=source_storage.display_name(),
+                    assistant=assistants.RagnaDemoAssistant.display_name(),
+                    params={},
+                )
+            )
+            await database.add_chat(session, user=user, chat=chat)
+
+            # Simulate a job that was interrupted after storing the first document.
+            job = schemas.Job(
+                chat_id=chat.id,
+                status=schemas.JobStatus.RUNNING,
+                stage=schemas.JobStage.STORING,
+                documents=[
+                    schemas.JobDocument(document=document, stored=idx == 0)
+                    for idx, document in enumerate(documents)
+                ],
+            )
+            await database.add_job(session, user=user, job=job)
+
+        job_queue = JobQueue(
+            make_session=make_session,
+            make_core_chat=make_core_chat,
+            num_workers=1,
+        )
+        await job_queue.start()
+        try:
+            async with make_session() as session:
+                while (
+                    job := await database.get_job(session, user=user, id=job.id)
+                ).status in {schemas.JobStatus.PENDING, schemas.JobStatus.RUNNING}:
+                    await asyncio.sleep(0.01)
+                chat = await database.get_chat(session, user=user, id=chat.id)
+        finally:
+            await job_queue.stop()
+
+        return job, chat, source_storage.stored
+    finally:
+        await engine.dispose()
+
+
+def test_resume_job(tmp_path):
+    job, chat, stored = asyncio.run(resume_job(tmp_path, "user"))
+
+    assert job.status == schemas.JobStatus.SUCCEEDED
+    assert job.stage == schemas.JobStage.DONE
+    assert all(job_document.stored for job_document in job.documents)
+
+    assert stored == ["pending.txt"]
+
+    assert chat.prepared
+    assert [message.role for message in chat.messages] == [MessageRole.SYSTEM]
+
+
+async def add_concurrent_jobs(user):
+    engine = database.create_engine("sqlite://")
+    await database.create_tables(engine)
+    make_session = database.get_sessionmaker(engine)
+    try:
+        async with make_session() as session:
+            chat = schemas.Chat(
+                metadata=schemas.ChatMetadata(
+                    name="chat",
+                    documents=[],
+                    source_storage=source_storages.RagnaDemoSourceStorage.display_name(),
+                    assistant=assistants.RagnaDemoAssistant.display_name(),
+                    params={},
+                )
+            )
+            await database.add_chat(session, user=user, chat=chat)
+
+        async def add_job():
+            async with make_session() as session:
+                return await database.add_job(
+                    session, user=user, job=schemas.Job(chat_id=chat.id, documents=[])
+                )
+
+        jobs = await asyncio.gather(*[add_job() for _ in range(4)])
+
+        async with make_session() as session:
+            # A new job can be added after the previous one is finished.
+            job = jobs[0].model_copy(update=dict(status=schemas.JobStatus.SUCCEEDED))
+            await database.update_job(session, job)
+            new_job = await database.add_job(
+                session, user=user, job=schemas.Job(chat_id=chat.id, documents=[])
+            )
+
+        return jobs, new_job
+    finally:
+        await engine.dispose()
+
+
+def test_single_unfinished_job():
+    jobs, new_job = asyncio.run(add_concurrent_jobs("user"))
+
+    assert len({job.id for job in jobs}) == 1
+    assert new_job.id != jobs[0].id
@@ -0,0 +1,40 @@
+from ragna.core import Span
+from ragna.deploy._api.metrics import ApiMetrics
+
+
+def test_observe_spans():
+    metrics = ApiMetrics()
+
+    metrics.observe_spans(
+        [
+            Span(name="embed_query", start=0.0, duration=0.01),
+            Span(
+                name="retrieve",
+                start=0.0,
+                duration=0.02,
+                attributes=dict(component="Chroma"),
+            ),
+            Span(
+                name="answer",
+                start=0.02,
+                duration=1.5,
+                attributes=dict(
+                    component="Ragna/DemoAssistant",
+                    time_to_first_chunk=0.3,
+                    num_source_tokens=1000,
+                ),
+            ),
+        ]
+    )
+
+    exposed = metrics.expose().decode()
+    assert 'ragna_stage_duration_seconds_count{stage="embed_query"} 1.0' in exposed
+    assert (
+        'ragna_component_duration_seconds_count{component="Chroma",method="retrieve"} 1.0'
+        in exposed
+    )
+    assert (
+        'ragna_answer_time_to_first_chunk_seconds_sum{component="Ragna/DemoAssistant"} 0.3'
+        in exposed
+    )
+    assert 'ragna_retrieved_source_tokens_bucket{le="1024.0"} 1.0' in exposed
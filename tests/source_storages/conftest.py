@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(32, 64))
+    x = centers[rng.integers(len(centers), size=4_000)] + 0.3 * rng.normal(
+        size=(4_000, 64)
+    )
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x.astype(np.float32)
@@ -0,0 +1,148 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ragna.core import RagnaException
+from ragna.source_storages._embedding_cache import (
+    DEFAULT_EMBEDDING_CACHE_SIZE,
+    CachedEmbedder,
+    EmbeddingCache,
+    embedding_cache_size,
+)
+
+
+class CountingEmbeddingFunction:
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [np.full(self.dimensions, len(text), dtype=np.float32) for text in texts]
+
+
+@pytest.fixture
+def embedding_function():
+    return CountingEmbeddingFunction(dimensions=4)
+
+
+def make_embedder(embedding_function, tmp_path, **kwargs):
+    return CachedEmbedder(
+        embedding_function,
+        model="model",
+        dimensions=embedding_function.dimensions,
+        cache_root=tmp_path,
+        **kwargs,
+    )
+
+
+class TestCachedEmbedder:
+    def test_embed(self, embedding_function, tmp_path):
+        embedder = make_embedder(embedding_function, tmp_path)
+        texts = ["a", "bb", "ccc"]
+
+        embeddings = embedder.embed(texts)
+        assert embeddings.shape == (3, 4)
+        np.testing.assert_array_equal(embeddings[:, 0], [1, 2, 3])
+
+        np.testing.assert_array_equal(
+            embedder.embed(["bb", "dddd", "a"])[:, 0], [2, 4, 1]
+        )
+        assert embedding_function.calls == [texts, ["dddd"]]
+
+        stats = embedder.stats()["documents"]
+        assert stats["hits"] == 2
+        assert stats["misses"] == 4
+        assert stats["size"] == 4
+
+    def test_embed_empty(self, embedding_function, tmp_path):
+        embedder = make_embedder(embedding_function, tmp_path)
+
+        assert embedder.embed([]).shape == (0, 4)
+        assert not embedding_function.calls
+
+    def test_persistence(self, embedding_function, tmp_path):
+        make_embedder(embedding_function, tmp_path).embed(["a", "bb"])
+
+        embeddings = make_embedder(embedding_function, tmp_path).embed(["bb", "a"])
+
+        np.testing.assert_array_equal(embeddings[:, 0], [2, 1])
+        assert len(embedding_function.calls) == 1
+
+    def test_disabled(self, embedding_function, tmp_path):
+        embedder = make_embedder(embedding_function, tmp_path, max_size=0)
+
+        for _ in range(2):
+            np.testing.assert_array_equal(embedder.embed(["a", "bb"])[:, 0], [1, 2])
+
+        assert len(embedding_function.calls) == 2
+        assert embedder.stats()["documents"]["size"] == 0
+        assert not any(tmp_path.iterdir())
+
+    def test_embed_query(self, embedding_function, tmp_path):
+        embedder = make_embedder(embedding_function, tmp_path)
+
+        for _ in range(3):
+            np.testing.assert_array_equal(embedder.embed_query("query"), np.full(4, 5))
+
+        assert embedding_function.calls == [["query"]]
+        assert embedder.stats()["queries"]["hits"] == 2
+
+
+def test_lru_eviction(tmp_path):
+    cache = EmbeddingCache(tmp_path, dimensions=2, max_size=2)
+    keys = [cache.key(text) for text in "abc"]
+
+    cache.put_many({keys[0]: np.zeros(2), keys[1]: np.ones(2)})
+    time.sleep(0.05)
+    cache.get_many([keys[0]])
+    cache.put_many({keys[2]: np.full(2, 2)})
+
+    assert len(cache) == 2
+    assert cache.stats()["evictions"] == 1
+
+    embeddings = cache.get_many(keys)
+    assert set(embeddings) == {keys[0], keys[2]}
+    np.testing.assert_array_equal(embeddings[keys[2]], [2, 2])
+
+
+def test_get_many_concurrent_eviction(tmp_path):
+    # Two caches on the same directory behave like two processes sharing it.
+    cache = EmbeddingCache(tmp_path, dimensions=2, max_size=2)
+    other = EmbeddingCache(tmp_path, dimensions=2, max_size=2)
+    key = cache.key("a")
+    cache.put_many({key: np.ones(2)})
+
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(cache.get_many([key])))
+    with other._transaction():
+        thread.start()
+        time.sleep(0.1)
+        # Evict the embedding and reuse its slot while it is being read.
+        other._put_many({other.key("b"): np.full(2, 2), other.key("c"): np.full(2, 3)})
+    thread.join()
+
+    assert result == {}
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [(None, DEFAULT_EMBEDDING_CACHE_SIZE), ("0", 0), ("1000", 1_000)],
+)
+def test_embedding_cache_size(monkeypatch, value, expected):
+    if value is None:
+        monkeypatch.delenv("RAGNA_EMBEDDING_CACHE_SIZE", raising=False)
+    else:
+        monkeypatch.setenv("RAGNA_EMBEDDING_CACHE_SIZE", value)
+
+    assert embedding_cache_size() == expected
+
+
+@pytest.mark.parametrize("value", ["-1", "many"])
+def test_embedding_cache_size_invalid(monkeypatch, value):
+    monkeypatch.setenv("RAGNA_EMBEDDING_CACHE_SIZE", value)
+
+    with pytest.raises(RagnaException, match="RAGNA_EMBEDDING_CACHE_SIZE"):
+        embedding_cache_size()
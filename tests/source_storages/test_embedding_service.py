@@ -0,0 +1,189 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ragna.core import RagnaException
+from ragna.source_storages import _embedding_service
+from ragna.source_storages._embedding_service import (
+    BatchingEmbeddingFunction,
+    EmbeddingServer,
+    RemoteEmbeddingFunction,
+    get_embedding_function,
+    parse_address,
+)
+
+
+class SlowEmbeddingFunction:
+    def __init__(self, *, delay=0.02):
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+        time.sleep(self.delay)
+        if "fail" in texts:
+            raise ValueError("fail")
+        return [np.full(4, len(text), dtype=np.float32) for text in texts]
+
+
+class TestBatchingEmbeddingFunction:
+    def test_concurrent_calls_are_batched(self):
+        embedding_function = SlowEmbeddingFunction()
+        batching = BatchingEmbeddingFunction(embedding_function, max_wait=0.05)
+        texts = ["a" * length for length in range(1, 21)]
+
+        with concurrent.futures.ThreadPoolExecutor(len(texts)) as executor:
+            results = list(executor.map(lambda text: batching([text]), texts))
+
+        for text, (embedding,) in zip(texts, results):
+            np.testing.assert_array_equal(embedding, np.full(4, len(text)))
+        assert len(embedding_function.calls) < len(texts)
+        assert sorted(
+            text for call in embedding_function.calls for text in call
+        ) == sorted(texts)
+
+    def test_large_calls_are_split(self):
+        embedding_function = SlowEmbeddingFunction(delay=0)
+        batching = BatchingEmbeddingFunction(
+            embedding_function, max_batch_size=4, max_wait=0
+        )
+        texts = ["a" * length for length in range(1, 11)]
+
+        embeddings = batching(texts)
+
+        np.testing.assert_array_equal(
+            np.stack(embeddings)[:, 0], [len(text) for text in texts]
+        )
+        assert all(len(call) <= 4 for call in embedding_function.calls)
+
+    def test_empty(self):
+        embedding_function = SlowEmbeddingFunction()
+        batching = BatchingEmbeddingFunction(embedding_function)
+
+        assert batching([]) == []
+        assert not embedding_function.calls
+
+    def test_error(self):
+        batching = BatchingEmbeddingFunction(SlowEmbeddingFunction(), max_wait=0)
+
+        with pytest.raises(ValueError, match="fail"):
+            batching(["fail"])
+
+        # The worker survives errors.
+        assert len(batching(["a"])) == 1
+
+    def test_aembed(self):
+        embedding_function = SlowEmbeddingFunction()
+        batching = BatchingEmbeddingFunction(embedding_function, max_wait=0.05)
+        texts = ["a" * length for length in range(1, 11)]
+
+        async def main():
+            return await asyncio.gather(*[batching.aembed([text]) for text in texts])
+
+        results = asyncio.run(main())
+
+        assert [int(embedding[0]) for (embedding,) in results] == list(range(1, 11))
+        assert len(embedding_function.calls) < len(texts)
+
+    def test_aembed_cancelled(self):
+        embedding_function = SlowEmbeddingFunction(delay=0.1)
+        batching = BatchingEmbeddingFunction(embedding_function, max_wait=0.05)
+
+        async def main():
+            cancelled = asyncio.create_task(batching.aembed(["a"]))
+            other = asyncio.create_task(batching.aembed(["bb"]))
+            # Cancel the call while its batch is queued as well as while it is
+            # embedded.
+            await asyncio.sleep(0.01)
+            cancelled.cancel()
+            queued = asyncio.create_task(batching.aembed(["ccc"]))
+            await asyncio.sleep(0)
+            queued.cancel()
+            return await asyncio.wait_for(other, timeout=5)
+
+        (embedding,) = asyncio.run(main())
+
+        np.testing.assert_array_equal(embedding, np.full(4, 2))
+        assert batching._worker is not None and batching._worker.is_alive()
+        assert len(batching(["dddd"])) == 1
+
+
+@pytest.mark.parametrize(
+    ("address", "expected"),
+    [
+        ("127.0.0.1:31477", ("127.0.0.1", 31477)),
+        ("localhost:0", ("localhost", 0)),
+        ("/tmp/embedding-service.sock", "/tmp/embedding-service.sock"),
+    ],
+)
+def test_parse_address(address, expected):
+    assert parse_address(address) == expected
+
+
+@pytest.fixture
+def server(tmp_local_root):
+    server = EmbeddingServer(
+        SlowEmbeddingFunction(delay=0), address="127.0.0.1:0", max_wait=0
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.close()
+
+
+class TestRemoteEmbeddingFunction:
+    def test_embed(self, server):
+        host, port = server.address
+        remote = RemoteEmbeddingFunction(f"{host}:{port}")
+
+        embeddings = remote(["a", "bb", "ccc"])
+
+        np.testing.assert_array_equal(np.stack(embeddings)[:, 0], [1, 2, 3])
+
+    def test_concurrent(self, server):
+        host, port = server.address
+        remote = RemoteEmbeddingFunction(f"{host}:{port}")
+        texts = ["a" * length for length in range(1, 11)]
+
+        with concurrent.futures.ThreadPoolExecutor(len(texts)) as executor:
+            results = list(executor.map(lambda text: remote([text]), texts))
+
+        assert [int(embedding[0]) for (embedding,) in results] == list(range(1, 11))
+
+    def test_error(self, server):
+        host, port = server.address
+        remote = RemoteEmbeddingFunction(f"{host}:{port}")
+
+        with pytest.raises(RagnaException, match="Embedding service failed"):
+            remote(["fail"])
+
+    def test_unavailable(self, tmp_local_root):
+        remote = RemoteEmbeddingFunction(str(tmp_local_root / "missing.sock"))
+
+        with pytest.raises(RagnaException, match="Unable to connect"):
+            remote(["a"])
+
+
+@pytest.mark.parametrize(
+    ("address", "expected_type"),
+    [(None, BatchingEmbeddingFunction), ("127.0.0.1:31477", RemoteEmbeddingFunction)],
+)
+def test_get_embedding_function(monkeypatch, address, expected_type):
+    monkeypatch.setattr(_embedding_service, "_EMBEDDING_FUNCTIONS", {})
+    if address is None:
+        monkeypatch.delenv("RAGNA_EMBEDDING_SERVICE_ADDRESS", raising=False)
+    else:
+        monkeypatch.setenv("RAGNA_EMBEDDING_SERVICE_ADDRESS", address)
+
+    embedding_function = get_embedding_function("model", SlowEmbeddingFunction)
+
+    assert isinstance(embedding_function, expected_type)
+    assert get_embedding_function("model", SlowEmbeddingFunction) is embedding_function
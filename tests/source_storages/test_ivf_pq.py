@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from ragna.source_storages._ivf_pq import IvfPq
+
+
+@pytest.fixture(scope="module")
+def index(vectors):
+    return IvfPq.train(vectors)
+
+
+def recall(index, vectors, *, nprobe, k=10, limit=100, num_queries=50):
+    # Fraction of the exact k nearest neighbors among the approximate results. The
+    # queries are perturbed, since otherwise every query would trivially find itself.
+    rng = np.random.default_rng(0)
+    queries = vectors[:num_queries]
+    noise = rng.normal(size=queries.shape)
+    queries = queries + 0.5 * noise / np.linalg.norm(noise, axis=1, keepdims=True)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    hits = 0
+    for query in queries.astype(np.float32):
+        expected = np.argsort(-(vectors @ query))[:k]
+        actual = index.search(query, limit=limit, nprobe=nprobe)
+        hits += len(set(expected) & set(actual))
+    return hits / (k * num_queries)
+
+
+def test_train(index, vectors):
+    num_lists = int(np.sqrt(len(vectors)))
+    assert index.centroids.shape == (num_lists, 64)
+    assert index.codebooks.shape == (8, 256, 8)
+    assert index.codes.shape == (len(vectors), 8)
+    assert index.codes.dtype == np.uint8
+    assert index.list_offsets[-1] == len(vectors)
+    assert sorted(index.list_idcs) == list(range(len(vectors)))
+
+
+def test_recall(index, vectors):
+    low = recall(index, vectors, nprobe=1)
+    high = recall(index, vectors, nprobe=8)
+
+    assert high > low
+    assert high > 0.9
+
+
+def test_mask(index, vectors):
+    mask = np.zeros(len(vectors), dtype=bool)
+    mask[::2] = True
+
+    idcs = index.search(vectors[1], limit=20, nprobe=8, mask=mask)
+
+    assert len(idcs) == 20
+    assert mask[idcs].all()
+
+
+def test_persistence(tmp_path, index, vectors):
+    path = tmp_path / "index.npz"
+    index.save(path)
+
+    loaded = IvfPq.load(path)
+
+    np.testing.assert_array_equal(
+        loaded.search(vectors[0], limit=10, nprobe=4),
+        index.search(vectors[0], limit=10, nprobe=4),
+    )
@@ -0,0 +1,52 @@
+import numpy as np
+
+from ragna.source_storages._keyword_index import KeywordIndex, reciprocal_rank_fusion
+
+
+def tokens(*ids):
+    return np.array(ids, dtype=np.uint32)
+
+
+def make_index(path):
+    index = KeywordIndex(path / "index.npz")
+    index.add("d0", ["c0", "c1"], [tokens(1, 2, 3, 3), tokens(2, 4)])
+    index.add("d1", ["c2", "c3"], [tokens(5, 6), tokens(3, 5, 7, 8, 9, 10)])
+    return index
+
+
+class TestKeywordIndex:
+    def test_search(self, tmp_path):
+        index = make_index(tmp_path)
+
+        assert index.search([3], limit=10) == ["c0", "c3"]
+        assert index.search([5, 6], limit=10) == ["c2", "c3"]
+        assert index.search([2, 3], limit=1) == ["c0"]
+        assert index.search([11], limit=10) == []
+
+    def test_search_document_ids(self, tmp_path):
+        index = make_index(tmp_path)
+
+        assert index.search([3], limit=10, document_ids=["d1"]) == ["c3"]
+
+    def test_remove(self, tmp_path):
+        index = make_index(tmp_path)
+
+        index.remove(["d0"])
+
+        assert len(index) == 2
+        assert "d0" not in index
+        assert index.search([3, 6], limit=10) == ["c2", "c3"]
+
+    def test_persistence(self, tmp_path):
+        index = make_index(tmp_path)
+        index.save()
+
+        index = KeywordIndex(tmp_path / "index.npz")
+
+        assert len(index) == 4
+        assert "d1" in index
+        assert index.search([3], limit=10) == ["c0", "c3"]
+
+
+def test_reciprocal_rank_fusion():
+    assert reciprocal_rank_fusion(["a", "b", "c"], ["c", "d"]) == ["c", "a", "b", "d"]
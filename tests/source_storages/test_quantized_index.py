@@ -0,0 +1,112 @@
+import uuid
+
+import numpy as np
+import pytest
+
+from ragna.core import LocalDocument
+from ragna.source_storages import QuantizedFlatIndex, _quantized_index
+from ragna.source_storages._quantized_index import (
+    Quantizer,
+    exact_top_k,
+    recall_check,
+    search,
+)
+
+
+@pytest.mark.parametrize(
+    ("quantization", "pca_dimensions", "compression"),
+    [("int8", None, 4), ("binary", None, 32), ("int8", 16, 16)],
+)
+def test_train(vectors, quantization, pca_dimensions, compression):
+    quantizer = Quantizer.train(
+        vectors, quantization=quantization, pca_dimensions=pca_dimensions
+    )
+
+    assert len(quantizer) == len(vectors)
+    assert quantizer.nbytes * compression == vectors.nbytes
+
+
+@pytest.mark.parametrize(
+    ("quantization", "pca_dimensions"),
+    [("int8", None), ("binary", None), ("int8", 32), ("binary", 32)],
+)
+def test_recall(vectors, quantization, pca_dimensions):
+    quantizer = Quantizer.train(
+        vectors, quantization=quantization, pca_dimensions=pca_dimensions
+    )
+
+    low = recall_check(quantizer, vectors, rescore_factor=1)
+    high = recall_check(quantizer, vectors, rescore_factor=10)
+
+    assert high >= low
+    assert high > 0.9
+
+
+def test_exact_top_k(vectors):
+    queries = vectors[:7] + 0.1
+
+    idcs = exact_top_k(vectors, queries, k=10, block_size=300)
+
+    np.testing.assert_array_equal(
+        np.sort(idcs, axis=1),
+        np.sort(np.argsort(-(queries @ vectors.T), axis=1)[:, :10], axis=1),
+    )
+
+
+def test_rescoring_is_exact(vectors):
+    quantizer = Quantizer.train(vectors, quantization="binary")
+    query = vectors[0]
+
+    idcs = search(quantizer, vectors, query, limit=10, rescore_factor=len(vectors))
+
+    np.testing.assert_array_equal(idcs, np.argsort(-(vectors @ query))[:10])
+
+
+def test_mask(vectors):
+    quantizer = Quantizer.train(vectors, quantization="int8")
+    mask = np.zeros(len(vectors), dtype=bool)
+    mask[::2] = True
+
+    idcs = search(quantizer, vectors, vectors[1], limit=20, rescore_factor=4, mask=mask)
+
+    assert len(idcs) == 20
+    assert mask[idcs].all()
+
+
+def test_persistence(tmp_path, vectors):
+    quantizer = Quantizer.train(vectors, quantization="binary", pca_dimensions=32)
+    path = tmp_path / "quantized.npz"
+    quantizer.save(path)
+
+    loaded = Quantizer.load(path)
+
+    assert loaded.quantization == "binary"
+    assert loaded.recall is None
+    np.testing.assert_array_equal(
+        search(loaded, vectors, vectors[0], limit=10, rescore_factor=4),
+        search(quantizer, vectors, vectors[0], limit=10, rescore_factor=4),
+    )
+
+
+@pytest.mark.parametrize("check_recall", [False, True])
+def test_store_recall(tmp_local_root, mocker, check_recall):
+    path = tmp_local_root / "document.txt"
+    with open(path, "w") as file:
+        file.write(" ".join(f"word{idx}" for idx in range(500)))
+    document = LocalDocument.from_path(path)
+    chat_id = uuid.uuid4()
+    source_storage = QuantizedFlatIndex()
+    spy = mocker.spy(_quantized_index, "recall_check")
+
+    params = dict(chunk_size=20, chunk_overlap=10)
+    source_storage.store(
+        [document], chat_id=chat_id, check_recall=check_recall, **params
+    )
+
+    # The check is expensive and thus only run on request.
+    assert spy.call_count == int(check_recall)
+    recall = source_storage.recall(chat_id=chat_id, **params)
+    if check_recall:
+        assert recall == spy.spy_return
+    else:
+        assert recall is None
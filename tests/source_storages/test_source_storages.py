@@ -1,13 +1,34 @@
+import asyncio
+import concurrent.futures
+import inspect
+import itertools
 import uuid
+from collections import deque
 
 import pytest
 
-from ragna.core import LocalDocument
-from ragna.source_storages import Chroma, LanceDB
+from ragna.core import LocalDocument, Source
+from ragna.source_storages import (
+    Chroma,
+    FlatIndex,
+    IvfPqIndex,
+    LanceDB,
+    QuantizedFlatIndex,
+    _flat_index,
+)
+from ragna.source_storages._vector_database import Hit, _window_bounds
 
 
-@pytest.mark.parametrize("source_storage_cls", [Chroma, LanceDB])
-def test_smoke(tmp_local_root, source_storage_cls):
+def run(result):
+    # Some source storages implement store() and retrieve() as coroutine functions.
+    return asyncio.run(result) if inspect.isawaitable(result) else result
+
+
+@pytest.mark.parametrize("shared_index", [False, True])
+@pytest.mark.parametrize(
+    "source_storage_cls", [Chroma, LanceDB, FlatIndex, IvfPqIndex, QuantizedFlatIndex]
+)
+def test_smoke(tmp_local_root, source_storage_cls, shared_index):
     document_root = tmp_local_root / "documents"
     document_root.mkdir()
     documents = []
@@ -33,9 +54,355 @@ def test_smoke(tmp_local_root, source_storage_cls):
     #  parametrization.
     chat_id = uuid.uuid4()
 
-    source_storage.store(documents, chat_id=chat_id)
+    run(source_storage.store(documents, chat_id=chat_id, shared_index=shared_index))
 
     prompt = "What is the secret?"
-    sources = source_storage.retrieve(documents, prompt, chat_id=chat_id)
+    sources = run(
+        source_storage.retrieve(
+            documents, prompt, chat_id=chat_id, shared_index=shared_index
+        )
+    )
 
     assert secret in sources[0].content
+
+
+@pytest.mark.parametrize(
+    "source_storage_cls", [Chroma, LanceDB, FlatIndex, IvfPqIndex, QuantizedFlatIndex]
+)
+def test_shared_index(tmp_local_root, mocker, source_storage_cls):
+    document_root = tmp_local_root / "documents"
+    document_root.mkdir()
+    documents = []
+    for name, content in [
+        ("secret.txt", "The secret is Ragna!"),
+        ("other.txt", "The secret is something else entirely!"),
+    ]:
+        path = document_root / name
+        with open(path, "w") as file:
+            file.write(content)
+        documents.append(LocalDocument.from_path(path))
+    secret_document, other_document = documents
+
+    source_storage = source_storage_cls()
+    run(source_storage.store(documents, chat_id=uuid.uuid4(), shared_index=True))
+
+    # Storing already indexed documents for another chat is a no-op.
+    extract_pages = mocker.spy(LocalDocument, "extract_pages")
+    chat_id = uuid.uuid4()
+    run(source_storage.store([other_document], chat_id=chat_id, shared_index=True))
+    extract_pages.assert_not_called()
+
+    # Only sources of the chat's documents are retrieved.
+    sources = run(
+        source_storage.retrieve(
+            [other_document], "What is the secret?", chat_id=chat_id, shared_index=True
+        )
+    )
+    assert sources
+    assert all(source.document is other_document for source in sources)
+
+
+async def delete_chunk(source_storage, chunk_id, *, collection_name):
+    if isinstance(source_storage, Chroma):
+        client = await source_storage._get_client()
+        collection = await source_storage._call(client.get_collection, collection_name)
+        await source_storage._call(collection.delete, ids=[chunk_id])
+    else:
+        db = await source_storage._connect()
+        table = await db.open_table(collection_name)
+        await table.delete(f"id = '{chunk_id}'")
+
+
+@pytest.mark.parametrize("source_storage_cls", [Chroma, LanceDB])
+def test_shared_index_partially_stored(tmp_local_root, mocker, source_storage_cls):
+    path = tmp_local_root / "document.txt"
+    with open(path, "w") as file:
+        file.write(" ".join(f"word{idx}" for idx in range(100)))
+    document = LocalDocument.from_path(path)
+
+    source_storage = source_storage_cls()
+    params = dict(shared_index=True, chunk_size=20, chunk_overlap=10)
+    run(source_storage.store([document], chat_id=uuid.uuid4(), **params))
+
+    # Simulate a store that was interrupted before all chunks were written.
+    run(
+        delete_chunk(
+            source_storage,
+            source_storage._chunk_id(document.id, 0, chunk_size=20, chunk_overlap=10),
+            collection_name=source_storage._shared_collection_name(
+                chunk_size=20, chunk_overlap=10
+            ),
+        )
+    )
+
+    extract_pages = mocker.spy(LocalDocument, "extract_pages")
+    run(source_storage.store([document], chat_id=uuid.uuid4(), **params))
+    extract_pages.assert_called_once()
+
+    extract_pages.reset_mock()
+    run(source_storage.store([document], chat_id=uuid.uuid4(), **params))
+    extract_pages.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "source_storage_cls", [Chroma, LanceDB, FlatIndex, IvfPqIndex, QuantizedFlatIndex]
+)
+def test_store_incrementally(tmp_local_root, source_storage_cls):
+    document_root = tmp_local_root / "documents"
+    document_root.mkdir()
+    documents = []
+    for idx in range(2):
+        path = document_root / f"document{idx}.txt"
+        with open(path, "w") as file:
+            file.write(f"This is document number {idx}.\n")
+        documents.append(LocalDocument.from_path(path))
+
+    source_storage = source_storage_cls()
+    chat_id = uuid.uuid4()
+
+    # Storing a document again replaces it rather than duplicating its content.
+    run(source_storage.store(documents[:1], chat_id=chat_id))
+    run(source_storage.store(documents, chat_id=chat_id))
+
+    sources = run(source_storage.retrieve(documents, "document", chat_id=chat_id))
+
+    assert sorted(source.document.name for source in sources) == [
+        document.name for document in documents
+    ]
+
+
+def windowed_ragged(iterable, *, n, step):
+    # Reference implementation adapted from more_itertools.windowed to allow a ragged
+    # last window.
+    window = deque(maxlen=n)
+    i = n
+    for _ in map(window.append, iterable):
+        i -= 1
+        if not i:
+            i = step
+            yield tuple(window)
+
+    if len(window) < n:
+        yield tuple(window)
+    elif 0 < i < min(step, n):
+        yield tuple(window)[i:]
+
+
+@pytest.mark.parametrize(
+    ("num_tokens", "size", "step"),
+    [
+        (num_tokens, size, step)
+        for num_tokens, size in itertools.product(range(1, 20), range(1, 6))
+        for step in range(1, size + 1)
+    ],
+)
+def test_window_bounds(num_tokens, size, step):
+    expected = [
+        [window[0], window[-1] + 1]
+        for window in windowed_ragged(range(num_tokens), n=size, step=step)
+    ]
+
+    actual = _window_bounds(num_tokens, size=size, step=step).tolist()
+
+    assert actual == expected
+
+
+@pytest.mark.parametrize(
+    "source_storage_cls", [Chroma, LanceDB, FlatIndex, IvfPqIndex, QuantizedFlatIndex]
+)
+def test_merge_overlapping_sources(tmp_local_root, source_storage_cls):
+    document_root = tmp_local_root / "documents"
+    document_root.mkdir()
+    path = document_root / "document.txt"
+    content = " ".join(f"word{idx}" for idx in range(100))
+    with open(path, "w") as file:
+        file.write(content)
+    document = LocalDocument.from_path(path)
+
+    source_storage = source_storage_cls()
+    chat_id = uuid.uuid4()
+    params = dict(chat_id=chat_id, chunk_size=50, chunk_overlap=20)
+    run(source_storage.store([document], **params))
+
+    (source,) = run(
+        source_storage.retrieve([document], "word42", num_tokens=10_000, **params)
+    )
+
+    assert source.content == content
+    assert source.num_tokens == len(source_storage._tokenizer.encode(content))
+
+
+def test_merge_hits_budget(tmp_local_root):
+    source_storage = Chroma()
+    document = LocalDocument(name="document.txt", metadata={})
+    other_document = LocalDocument(name="other.txt", metadata={})
+
+    def hit(document, start, stop, location=""):
+        return Hit(
+            Source(
+                id=f"{document.name}-{start}",
+                document=document,
+                location=location,
+                content="",
+                num_tokens=stop - start,
+            ),
+            start=start,
+            stop=stop,
+        )
+
+    hits = [
+        hit(document, 10, 20, "2"),
+        hit(other_document, 15, 25),
+        hit(document, 0, 15, "1"),
+        # Connects the first hit with the next one.
+        hit(document, 20, 30),
+        hit(document, 25, 35, "3"),
+        hit(document, 50, 60),
+    ]
+
+    sources = source_storage._take_sources_up_to_max_tokens(hits, max_tokens=50)
+
+    assert [source.document for source in sources] == [document, other_document]
+    merged, other = sources
+    assert merged.num_tokens == 35
+    assert merged.location == "1-3"
+    assert other.num_tokens == 10
+
+
+@pytest.mark.parametrize("shared_index", [False, True])
+@pytest.mark.parametrize(
+    "source_storage_cls", [Chroma, LanceDB, FlatIndex, IvfPqIndex, QuantizedFlatIndex]
+)
+def test_hybrid_search(tmp_local_root, source_storage_cls, shared_index):
+    document_root = tmp_local_root / "documents"
+    document_root.mkdir()
+    documents = []
+    for idx in range(10):
+        path = document_root / f"part{idx}.txt"
+        with open(path, "w") as file:
+            file.write(f"Part number QX-{idx:04d}-Z is a spare part for the engine.\n")
+        documents.append(LocalDocument.from_path(path))
+
+    source_storage = source_storage_cls()
+    chat_id = uuid.uuid4()
+    params = dict(chat_id=chat_id, shared_index=shared_index, hybrid_search=True)
+    run(source_storage.store(documents, **params))
+
+    sources = run(
+        source_storage.retrieve(
+            documents, "Where is QX-0007-Z used?", num_tokens=200, **params
+        )
+    )
+
+    assert "QX-0007-Z" in sources[0].content
+
+
+def test_flat_index_persistence(tmp_local_root):
+    document_root = tmp_local_root / "documents"
+    document_root.mkdir()
+    path = document_root / "document.txt"
+    with open(path, "w") as file:
+        file.write("The secret is Ragna!\n")
+    document = LocalDocument.from_path(path)
+    chat_id = uuid.uuid4()
+
+    collection_path = tmp_local_root / "flat_index" / str(chat_id)
+    generations = []
+    for _ in range(3):
+        # Storing the document again writes a new generation.
+        FlatIndex().store([document], chat_id=chat_id)
+        generations.append((collection_path / "CURRENT").read_text())
+
+    source_storage = FlatIndex()
+    (source,) = source_storage.retrieve([document], "secret", chat_id=chat_id)
+
+    assert source.content == "The secret is Ragna!\n"
+    # The previous generation is kept for concurrent readers.
+    assert {path.name for path in collection_path.iterdir()} == {
+        "CURRENT",
+        "LOCK",
+        *generations[1:],
+    }
+
+
+def make_documents(root, num_documents):
+    root.mkdir()
+    documents = []
+    for idx in range(num_documents):
+        path = root / f"document{idx}.txt"
+        with open(path, "w") as file:
+            file.write(f"This is document number {idx}.\n")
+        documents.append(LocalDocument.from_path(path))
+    return documents
+
+
+def test_flat_index_concurrent_stores(tmp_local_root):
+    documents = make_documents(tmp_local_root / "documents", 8)
+    # Separate instances don't share any locks, just like separate processes.
+    source_storages = [FlatIndex() for _ in documents]
+
+    with concurrent.futures.ThreadPoolExecutor(len(documents)) as executor:
+        for future in [
+            executor.submit(
+                source_storage.store,
+                [document],
+                chat_id=uuid.uuid4(),
+                shared_index=True,
+            )
+            for source_storage, document in zip(source_storages, documents)
+        ]:
+            future.result()
+
+    sources = FlatIndex().retrieve(
+        documents, "document", chat_id=uuid.uuid4(), shared_index=True
+    )
+    assert {source.document.name for source in sources} == {
+        document.name for document in documents
+    }
+
+
+def test_keyword_index_reload(tmp_local_root):
+    documents = make_documents(tmp_local_root / "documents", 3)
+    source_storage = FlatIndex()
+    other = FlatIndex()
+    params = dict(chat_id=uuid.uuid4(), shared_index=True, hybrid_search=True)
+
+    source_storage.store(documents[:1], **params)
+    other.store(documents[1:2], **params)
+    # The keyword index of the first source storage is stale by now and must not
+    # overwrite the postings of the other one.
+    source_storage.store(documents[2:], **params)
+
+    keyword_index = FlatIndex()._keyword_index(
+        FlatIndex()._shared_collection_name(chunk_size=500, chunk_overlap=250)
+    )
+    assert all(str(document.id) in keyword_index for document in documents)
+
+
+def test_flat_index_load_retry(tmp_local_root, monkeypatch):
+    document_root = tmp_local_root / "documents"
+    document_root.mkdir()
+    path = document_root / "document.txt"
+    with open(path, "w") as file:
+        file.write("The secret is Ragna!\n")
+    document = LocalDocument.from_path(path)
+    chat_id = uuid.uuid4()
+    FlatIndex().store([document], chat_id=chat_id)
+
+    # Simulate a generation that was deleted between reading the pointer and loading
+    # it, because two stores finished in the meantime.
+    collection_cls = _flat_index._Collection
+    calls = []
+
+    def collection(path):
+        calls.append(path)
+        if len(calls) == 1:
+            raise FileNotFoundError(path)
+        return collection_cls(path)
+
+    monkeypatch.setattr(_flat_index, "_Collection", collection)
+
+    (source,) = FlatIndex().retrieve([document], "secret", chat_id=chat_id)
+
+    assert source.content == "The secret is Ragna!\n"
+    assert len(calls) == 2